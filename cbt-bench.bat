@@ -0,0 +1,32 @@
+@echo off
+
+:check
+(
+    python -h >nul 2>nul
+) || (
+    goto err
+)
+
+:ok
+python .\src\bench.py %*
+exit
+
+:err
+echo You have to download Python 2.x.x to start CBT benchmarks.
+echo If you have already downloaded Python, add
+echo Python directory to %%PATH%%.
+echo Would you like to add it now?
+set /p response=[y - yes, n - no]: 
+if %response%==y (
+    goto add
+)
+exit
+
+:add
+set /p newpath=Enter Python 2.x.x path: 
+if not exist %newpath%\python.exe (
+    echo This path is incorrect.
+    goto add
+)
+setx path "%path%;%newpath%"
+goto ok
\ No newline at end of file
@@ -11,6 +11,7 @@ Functions:
 
 Supported element types:
     int
+    long
     str
     list
     tuple
@@ -69,8 +70,10 @@ def _encode_element(element):
     element_type = type(element)
     switch = {
         int: _encode_int,
+        long: _encode_int,
         str: _encode_str,
         list: _encode_list,
+        tuple: _encode_list,
         dict: _encode_dict,
         ordered_dict: _encode_dict
     }
@@ -81,7 +84,7 @@ def _encode_element(element):
 
 def _encode_int(int_val):
     """Convert integer into bencode bytes."""
-    assert type(int_val) is int
+    assert type(int_val) in (int, long)
     return "i%de" % int_val
 
 
@@ -104,10 +107,18 @@ def _encode_list(list_obj):
 
 
 def _encode_dict(dict_obj):
-    """Convert dictionary into bencode bytes."""
+    """Convert dictionary into bencode bytes.
+    Keys of a regular dictionary are sorted as bencode requires,
+    ordered dictionary keeps its order (e.g. decoded "info" dictionary
+    must be encoded back byte to byte to calculate its hash).
+
+    """
     assert type(dict_obj) in (dict, ordered_dict)
     elements = ["d"]
-    for key, value in dict_obj.iteritems():
+    items = dict_obj.iteritems()
+    if type(dict_obj) is dict:
+        items = sorted(items)
+    for key, value in items:
         if type(key) != str:
             key = str(key)
         encoded_key = _encode_str(key)
@@ -0,0 +1,399 @@
+#!/usr/bin/python2
+"""
+cbt-bench: microbenchmarks of the hot primitives of the client.
+
+Every benchmark is run REPEAT times, each run calls the operation
+as many times as it takes MIN_TIME seconds. The result of a benchmark
+is the best time of one operation, the median time and the noise -
+how much the median is above the best time.
+
+Results may be saved as JSON and compared with a saved baseline.
+The baseline of the repository is tests/bench_baseline.json, it's
+recorded on the reference machine with the default options.
+A benchmark regresses if it's slower than the baseline by more than
+the threshold or by more than NOISE_FACTOR times the noise of both
+runs, whichever is greater. The exit status is 1 if anything regresses.
+
+Usage:
+
+    python bench.py [options]
+
+Options:
+
+    --filter=<text>       Run benchmarks whose names contain the text.
+    --quick               Smaller data sets (100 peers x 10k pieces).
+    --repeat=<count>      Runs of every benchmark (5).
+    --torrent=<file>      Real .torrent file for bcode benchmarks,
+                          may be given many times.
+    --save=<file>         Save results as JSON.
+    --compare=<file>      Compare results with the baseline.
+    --baseline            Compare results with the baseline of the
+                          repository.
+    --threshold=<percent> Minimal slowdown that is a regression (10).
+
+"""
+
+import errno
+import getopt
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import bcode
+import bitfield
+import convert
+import downloader
+import file
+import node
+import peer
+import piece
+import writer
+
+__all__ = ["Benchmark", "BENCHMARKS", "run", "compare"]
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "bench_baseline.json")
+MIN_TIME = 0.2
+NOISE_FACTOR = 3
+REPEAT = 5
+THRESHOLD = 10
+
+OPTIONS = [
+    "filter=",
+    "quick",
+    "repeat=",
+    "torrent=",
+    "save=",
+    "compare=",
+    "baseline",
+    "threshold="
+]
+
+
+_temp_paths = []
+
+
+class Benchmark(object):
+    """A named operation. setup(quick, torrents) is called once and
+    returns the function to be timed.
+
+    """
+
+    def __init__(self, name, setup, unit="op"):
+        self.name = name
+        self.setup = setup
+        self.unit = unit
+
+
+def measure(func, repeat):
+    """Return a dict of timings of func in seconds per call."""
+    number = 1
+    while True:
+        started_at = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - started_at
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2 if elapsed < MIN_TIME / 4 else 1 + int(MIN_TIME / max(elapsed, 1e-9))
+    runs = [elapsed / number]
+    for _ in xrange(repeat - 1):
+        started_at = time.time()
+        for _ in xrange(number):
+            func()
+        runs.append((time.time() - started_at) / number)
+    runs.sort()
+    best = runs[0]
+    median = runs[len(runs) / 2]
+    return {
+        "min": best,
+        "median": median,
+        "noise": (median - best) / best if best else 0.0,
+        "number": number,
+        "runs": runs
+    }
+
+
+def synthetic_meta(files=1000, pieces=4000):
+    """Return meta data of a big multifile torrent."""
+    rand = random.Random(0)
+    return {
+        "announce": "http://tracker.example.com:6969/announce",
+        "announce-list": [
+            ["http://tracker.example.com:6969/announce"],
+            ["udp://tracker.example.org:1337/announce"]
+        ],
+        "comment": "Synthetic torrent",
+        "created by": "cbt-bench",
+        "creation date": 1400000000,
+        "info": {
+            "name": "synthetic",
+            "piece length": 1 << 18,
+            "pieces": _random_bytes(rand, pieces * 20),
+            "files": [
+                {
+                    "length": rand.randint(1, 1 << 24),
+                    "path": ["folder%d" % (x % 10), "file%d.bin" % x]
+                }
+                for x in xrange(files)
+            ]
+        }
+    }
+
+
+def _random_bytes(rand, size):
+    if not size:
+        return ""
+    return ("%0*x" % (size * 2, rand.getrandbits(size * 8))).decode("hex")
+
+
+def _meta_list(torrents):
+    if torrents:
+        result = []
+        for path in torrents:
+            with open(path, "rb") as f:
+                result.append(bcode.decode(f.read()))
+        return result
+    return [synthetic_meta()]
+
+
+def _setup_decode(quick, torrents):
+    data = [bcode.encode(meta) for meta in _meta_list(torrents)]
+
+    def run():
+        for buf in data:
+            bcode.decode(buf)
+    return run
+
+
+def _setup_encode(quick, torrents):
+    metas = _meta_list(torrents)
+
+    def run():
+        for meta in metas:
+            bcode.encode(meta)
+    return run
+
+
+def _setup_convert(quick, torrents):
+    values = [random.Random(0).getrandbits(32) for _ in xrange(1000)]
+
+    def run():
+        for value in values:
+            convert.uint_ord(convert.uint_chr(value))
+    return run
+
+
+class StreamConn(object):
+    """Socket replacement that returns the stream and then would block."""
+
+    def __init__(self, stream):
+        self.position = 0
+        self.stream = stream
+
+    def recv(self, size):
+        if self.position >= len(self.stream):
+            raise socket.error(errno.EAGAIN, "End of the stream")
+        data = self.stream[self.position:self.position+size]
+        self.position += len(data)
+        return data
+
+
+def _setup_framing(size):
+    """Framing of MESSAGES messages of the size by Peer."""
+    MESSAGES = 100
+
+    def setup(quick, torrents):
+        p = peer.Peer()
+        received = [0]
+
+        def on_recv(n, buf):
+            received[0] += 1
+        p.on_recv(on_recv)
+        message = convert.uint_chr(size - 4) + "\x07" + "x" * (size - 5)
+        n = node.Node("127.0.0.1", 6881)
+        n.conn = StreamConn(message * MESSAGES)
+
+        def run():
+            received[0] = 0
+            n.conn.position = 0
+            n.inbox = node.Buf()
+            while received[0] < MESSAGES:
+                p._message_recv(n)
+                p._message_parse(n)
+        return run
+    return setup
+
+
+def _setup_next(quick, torrents):
+    """Downloader.next() from the cold state: pieces are activated
+    from the availability of all peers and chunks are requested.
+    The downloader is closed after every call, so the requests and
+    active pieces are dropped.
+
+    """
+    node_count, piece_count = (100, 10000) if quick else (1000, 100000)
+    rand = random.Random(0)
+    pieces = piece.PieceList("\0" * 20 * piece_count, 1 << 18, piece_count << 18)
+    nodes = []
+    for x in xrange(node_count):
+        n = node.Node("10.0.%d.%d" % (x / 256, x % 256), 6881)
+        n.handshaked = True
+        n.p_choke = node.Node.FALSE
+        n.bitfield = bitfield.Bitfield.from_bytes(_random_bytes(rand, (piece_count + 7) / 8))
+        nodes.append(n)
+    d = downloader.Downloader(nodes, pieces)
+
+    def run():
+        d.next()
+        d.close()
+    return run
+
+
+def _setup_write(quick, torrents):
+    """Writer.write() of pieces at random offsets of a many-file layout."""
+    file_count = 100 if quick else 1000
+    piece_length = 1 << 18
+    rand = random.Random(0)
+    path = tempfile.mkdtemp(prefix="cbt-bench-")
+    _temp_paths.append(path)
+    w = writer.Writer()
+    offset = 0
+    for x in xrange(file_count):
+        size = rand.randint(1, 1 << 20)
+        f = file.File(["folder%d" % (x % 10), "file%d.bin" % x], path, size, offset)
+        f.create()
+        w.append_file(f)
+        offset += size
+    data = _random_bytes(rand, piece_length)
+    offsets = [
+        rand.randrange(0, offset / piece_length) * piece_length
+        for _ in xrange(100)
+    ]
+    position = [0]
+
+    def run():
+        position[0] = (position[0] + 1) % len(offsets)
+        w.write(offsets[position[0]], data)
+    return run
+
+
+BENCHMARKS = [
+    Benchmark("bcode.decode", _setup_decode, "torrents"),
+    Benchmark("bcode.encode", _setup_encode, "torrents"),
+    Benchmark("convert.uint_chr+uint_ord", _setup_convert, "1000 ints"),
+    Benchmark("peer.framing.5B", _setup_framing(5), "100 messages"),
+    Benchmark("peer.framing.16KB", _setup_framing(4 + 9 + (1 << 14)), "100 messages"),
+    Benchmark("peer.framing.128KB", _setup_framing(4 + 9 + (1 << 17)), "100 messages"),
+    Benchmark("downloader.next", _setup_next, "call"),
+    Benchmark("writer.write", _setup_write, "piece")
+]
+
+
+def run(names=None, quick=False, repeat=REPEAT, torrents=None):
+    """Run benchmarks and return {name: timings dict}."""
+    results = {}
+    for bench in BENCHMARKS:
+        if names is not None and bench.name not in names:
+            continue
+        try:
+            func = bench.setup(quick, torrents)
+            results[bench.name] = measure(func, repeat)
+            results[bench.name]["unit"] = bench.unit
+        finally:
+            while _temp_paths:
+                shutil.rmtree(_temp_paths.pop(), ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Return a list of tuples (name, change, tolerance, regressed)
+    for benchmarks present in both results. change and tolerance
+    are ratios: 0.1 is 10% slower.
+
+    """
+    report = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new, old = results[name], baseline[name]
+        change = new["min"] / old["min"] - 1.0
+        tolerance = max(
+            threshold / 100.0,
+            NOISE_FACTOR * max(new["noise"], old["noise"])
+        )
+        report.append((name, change, tolerance, change > tolerance))
+    return report
+
+
+def main(argv):
+    torrents = []
+    try:
+        opts, argv = getopt.gnu_getopt(argv, "", OPTIONS)
+        for name, value in opts:
+            if name == "--torrent":
+                torrents.append(value)
+        opts = dict((name[2:], value) for name, value in opts)
+        repeat = int(opts.get("repeat", REPEAT))
+        threshold = float(opts.get("threshold", THRESHOLD))
+    except (getopt.GetoptError, ValueError):
+        print __doc__
+        return 2
+
+    # A broken baseline is reported before benchmarks are run
+    baseline = None
+    if "baseline" in opts:
+        opts["compare"] = BASELINE
+    if "compare" in opts:
+        try:
+            with open(opts["compare"]) as f:
+                baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            print "Unable to read the baseline %s: %s" % (opts["compare"], e)
+            return 2
+
+    names = None
+    if "filter" in opts:
+        names = [b.name for b in BENCHMARKS if opts["filter"] in b.name]
+    results = {}
+    for bench in BENCHMARKS:
+        if names is not None and bench.name not in names:
+            continue
+        result = run([bench.name], "quick" in opts, repeat, torrents)[bench.name]
+        results[bench.name] = result
+        print "[%s] [%.3f ms per %s] [Median: %.3f ms] [Noise: %.1f%%]" % (
+            bench.name,
+            result["min"] * 1000,
+            result["unit"],
+            result["median"] * 1000,
+            result["noise"] * 100
+        )
+
+    if "save" in opts:
+        try:
+            with open(opts["save"], "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        except IOError as e:
+            print "Unable to save results to %s: %s" % (opts["save"], e)
+            return 2
+
+    status = 0
+    if baseline is not None:
+        for name, change, tolerance, regressed in compare(results, baseline, threshold):
+            print "[%s] [%+.1f%%] [Tolerance: %.1f%%]%s" % (
+                name,
+                change * 100,
+                tolerance * 100,
+                " [REGRESSION]" if regressed else ""
+            )
+            if regressed:
+                status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
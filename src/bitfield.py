@@ -0,0 +1,176 @@
+import binascii
+
+__all__ = ["Availability", "Bitfield", "union"]
+
+
+class Bitfield(object):
+    """Packed set of pieces, 8 pieces per byte in the order
+    of the BitTorrent bitfield message (the high bit of the first
+    byte is piece 0). Set operations are made on the whole buffer
+    converted to a number, so they run in C instead of a loop
+    over pieces.
+
+    Attributes:
+
+        data:
+            bytearray with the bits.
+
+    Methods:
+
+        from_bytes(buf):
+            Make a bitfield from a bitfield message payload.
+
+        get(index):
+            Return True if the piece is in the set.
+
+        set(index, have=True):
+            Add the piece to the set or remove it. Grows if needed.
+
+        count():
+            Return number of pieces in the set.
+
+        first():
+            Return the lowest piece index in the set or None.
+
+        intersection(other), union(other), difference(other):
+            Return a new Bitfield.
+
+        tostring():
+            Return the bitfield message payload.
+
+    """
+
+    def __init__(self, length=0, fill=False):
+        self.data = bytearray(("\xff" if fill else "\0") * ((length + 7) / 8))
+        if fill and length % 8:
+            self.data[-1] = (0xff << (8 - length % 8)) & 0xff
+
+    def __len__(self):
+        return len(self.data) * 8
+
+    @classmethod
+    def from_bytes(cls, buf):
+        """Make a bitfield from a bitfield message payload."""
+        bf = cls()
+        bf.data = bytearray(buf)
+        return bf
+
+    def get(self, index):
+        """Return True if the piece is in the set."""
+        byte = index >> 3
+        if index < 0 or byte >= len(self.data):
+            return False
+        return bool(self.data[byte] & (0x80 >> (index & 7)))
+
+    def set(self, index, have=True):
+        """Add the piece to the set or remove it. Grows if needed."""
+        if index < 0:
+            return
+        byte = index >> 3
+        if byte >= len(self.data):
+            if not have:
+                return
+            self.data.extend("\0" * (byte - len(self.data) + 1))
+        if have:
+            self.data[byte] |= 0x80 >> (index & 7)
+        else:
+            self.data[byte] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def count(self):
+        """Return number of pieces in the set."""
+        return bin(self._long(len(self.data))).count("1")
+
+    def first(self):
+        """Return the lowest piece index in the set or None."""
+        value = self._long(len(self.data))
+        if not value:
+            return None
+        return len(self.data) * 8 - value.bit_length()
+
+    def intersection(self, other):
+        """Return a new Bitfield of pieces in both sets."""
+        size = len(self.data)
+        return Bitfield._from_long(self._long(size) & other._long(size), size)
+
+    def union(self, other):
+        """Return a new Bitfield of pieces in any set."""
+        size = max(len(self.data), len(other.data))
+        return Bitfield._from_long(self._long(size) | other._long(size), size)
+
+    def difference(self, other):
+        """Return a new Bitfield of pieces which are not in other."""
+        size = len(self.data)
+        return Bitfield._from_long(self._long(size) & ~other._long(size), size)
+
+    def tostring(self):
+        """Return the bitfield message payload."""
+        return str(self.data)
+
+    @staticmethod
+    def _from_long(value, size):
+        bf = Bitfield()
+        if size:
+            bf.data = bytearray(binascii.unhexlify("%0*x" % (size * 2, value)))
+        return bf
+
+    def _long(self, size):
+        """Return the first size bytes as a number (zero padded)."""
+        data = self.data[:size]
+        if len(data) < size:
+            data.extend("\0" * (size - len(data)))
+        if not data:
+            return 0
+        return int(binascii.hexlify(data), 16)
+
+
+def union(bitfields, size=0):
+    """Return a Bitfield of pieces in any of the bitfields."""
+    bitfields = list(bitfields)
+    value = 0
+    for bf in bitfields:
+        size = max(size, len(bf.data))
+    for bf in bitfields:
+        value |= bf._long(size)
+    return Bitfield._from_long(value, size)
+
+
+class Availability(object):
+    """Number of bitfields that have every piece, kept as bit-sliced
+    counters: plane x holds bit x of all the numbers. Bitfields
+    are added with a few operations on whole numbers, so counting
+    pieces of many peers doesn't loop over pieces.
+
+    Methods:
+
+        add(bf):
+            Count pieces of the bitfield.
+
+        rarest(candidates):
+            Return a new Bitfield of the candidates with the least count.
+
+    """
+
+    def __init__(self, length=0):
+        self.planes = []
+        self.size = (length + 7) / 8
+
+    def add(self, bf):
+        """Count pieces of the bitfield."""
+        carry = bf._long(self.size)
+        for x in xrange(len(self.planes)):
+            if not carry:
+                return
+            self.planes[x], carry = self.planes[x] ^ carry, self.planes[x] & carry
+        if carry:
+            self.planes.append(carry)
+
+    def rarest(self, candidates):
+        """Return a new Bitfield of the candidates with the least count."""
+        mask = candidates._long(self.size)
+        # Going from the highest bit, drop candidates that have
+        # the bit set while others don't
+        for plane in reversed(self.planes):
+            rest = mask & ~plane
+            if rest:
+                mask = rest
+        return Bitfield._from_long(mask, self.size)
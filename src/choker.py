@@ -0,0 +1,76 @@
+import random
+import time
+
+__all__ = ["Choker"]
+
+
+class Choker(object):
+    """Decides to which peers the client uploads (tit-for-tat).
+    Every INTERVAL seconds interested peers are ranked by how fast
+    we download from them (how fast we upload to them when seeding)
+    and the best SLOTS peers are unchoked. One more peer chosen at
+    random is unchoked optimistically and rotated every
+    OPTIMISTIC_INTERVAL seconds, so new peers get a chance to show
+    their speed. Rates are stored in node download_rate and
+    upload_rate attributes.
+
+    Methods:
+
+        message(nodes, seeding):
+            Return a tuple of lists (peers to choke, peers to unchoke).
+            Both lists are empty between rounds.
+
+    """
+
+    INTERVAL = 10
+    OPTIMISTIC_INTERVAL = 30
+    SLOTS = 4
+
+    def __init__(self, slots=None, interval=None, optimistic_interval=None):
+        self.interval = interval or Choker.INTERVAL
+        self.optimistic = None
+        self.optimistic_interval = optimistic_interval or Choker.OPTIMISTIC_INTERVAL
+        self.slots = slots if slots is not None else Choker.SLOTS
+        self._choked_at = time.time()
+        self._optimistic_at = 0
+        self._totals = {}
+
+    def message(self, nodes, seeding):
+        """Return a tuple of lists (peers to choke, peers to unchoke).
+        Both lists are empty between rounds.
+
+        """
+        now = time.time()
+        elapsed = now - self._choked_at
+        if elapsed < self.interval:
+            return [], []
+        self._choked_at = now
+
+        totals = {}
+        for n in nodes:
+            downloaded, uploaded = self._totals.get(n, (0, 0))
+            n.download_rate = (n.downloaded - downloaded) / elapsed
+            n.upload_rate = (n.uploaded - uploaded) / elapsed
+            totals[n] = (n.downloaded, n.uploaded)
+        self._totals = totals
+
+        candidates = [n for n in nodes if n.handshaked and n.conn and n.p_interested]
+        if seeding:
+            candidates.sort(key=lambda n: n.upload_rate, reverse=True)
+        else:
+            candidates.sort(key=lambda n: n.download_rate, reverse=True)
+        unchoked = set(candidates[:self.slots])
+
+        others = [n for n in candidates if n not in unchoked]
+        if (
+            now - self._optimistic_at >= self.optimistic_interval
+            or self.optimistic not in others
+        ):
+            self.optimistic = random.choice(others) if others else None
+            self._optimistic_at = now
+        if self.optimistic:
+            unchoked.add(self.optimistic)
+
+        choke = [n for n in nodes if n.handshaked and not n.c_choke and n not in unchoked]
+        unchoke = [n for n in unchoked if n.c_choke]
+        return choke, unchoke
@@ -0,0 +1,459 @@
+"""
+Long-running daemon that keeps one session for all torrents.
+
+Torrents share everything the session has: the listener and the UDP
+socket (uTP and DHT) on one port, the peer ID, the DHT routing table,
+tracker DNS, health and scrape caches, the scheduler with its
+bandwidth and memory limits. A new torrent starts with all of them
+warm instead of paying for a new process.
+
+The daemon is controlled over a local Unix socket (~/.cbt/daemon.sock
+by default) with JSON-RPC 2.0, one request or response per line:
+
+    --> {"jsonrpc": "2.0", "id": 1, "method": "pause", "params": {"hash": "..."}}
+    <-- {"jsonrpc": "2.0", "id": 1, "result": true}
+
+Methods:
+
+    add(path, download_path=None):
+        Start the torrent of the .torrent file. Return its info-hash
+        in hex.
+
+    remove(hash), pause(hash), resume(hash):
+        Control the torrent with the info-hash in hex.
+
+    stats():
+        Return a list of stats of all torrents.
+
+    shutdown():
+        Stop all torrents and exit.
+
+.torrent files put into the watch folder are added automatically.
+
+Functions:
+
+    call(method, params=None, path=None):
+        Call the method of the daemon listening on the socket path
+        with a dict of params. Return the result or raise RPCError.
+
+"""
+
+import errno
+import json
+import os
+import socket
+import time
+
+import metrics
+import storage
+import timer
+import torrent
+
+__all__ = ["Daemon", "RPCError", "call", "socket_path"]
+
+CALL_TIMEOUT = 60
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+TORRENT_ERROR = -32000
+
+
+class RPCError(Exception):
+    """Error of a JSON-RPC call with its code."""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def socket_path():
+    """Return the default path of the control socket."""
+    return storage.path("daemon.sock")
+
+
+def call(method, params=None, path=None):
+    """Call the method of the daemon listening on the socket path
+    with a dict of params. Return the result or raise RPCError.
+    Raise socket.error if the daemon isn't running.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CALL_TIMEOUT)
+    try:
+        sock.connect(path or socket_path())
+        request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+        sock.sendall(json.dumps(request) + "\n")
+        buf = ""
+        while "\n" not in buf:
+            data = sock.recv(65536)
+            if not data:
+                raise socket.error(errno.ECONNRESET, "Connection closed by the daemon")
+            buf += data
+    finally:
+        sock.close()
+    try:
+        response = json.loads(buf.split("\n", 1)[0])
+    except ValueError:
+        raise RPCError(PARSE_ERROR, "Invalid response")
+    if "error" in response:
+        raise RPCError(response["error"]["code"], response["error"]["message"])
+    return response.get("result")
+
+
+class Client(object):
+    """A connection to the control socket."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.inbox = ""
+        self.outbox = ""
+
+
+class Daemon(object):
+    """Runs torrents of one session until shutdown and serves
+    JSON-RPC requests of the control socket. Torrents are keyed
+    by their info-hashes in hex.
+
+    Attributes:
+
+        download_path:
+            Where torrents are downloaded to by default.
+
+        path:
+            Path of the control socket.
+
+        torrents:
+            A dict of all torrents {info-hash in hex: torrent.Torrent}.
+
+        watch_path:
+            A folder to add .torrent files from or None.
+
+    Methods:
+
+        add(path, download_path=None):
+            Start the torrent. Return its info-hash in hex.
+
+        remove(hash):
+            Stop the torrent and forget it.
+
+        pause(hash), resume(hash):
+            Disconnect peers of the torrent and stop it until resumed.
+
+        stats():
+            Return a list of stats dicts of all torrents.
+
+        shutdown():
+            Make run() return.
+
+        start():
+            Listen the control socket and watch the folder.
+
+        message():
+            You have to call this method in a loop.
+
+        scan():
+            Add new .torrent files of the watch folder.
+
+        stop():
+            Stop all torrents and close the control socket.
+
+        run():
+            Run the session until shutdown() or Ctrl-C. The daemon
+            is started if it's not yet.
+
+    """
+
+    BACKLOG = 8
+    EXPORT_METRICS_EVERY = 10
+    MAX_CLIENTS = 16
+    MAX_REQUEST = 1 << 16
+    # {method: (required params, optional params)}, all are strings
+    METHODS = {
+        "add": (("path",), ("download_path",)),
+        "remove": (("hash",), ()),
+        "pause": (("hash",), ()),
+        "resume": (("hash",), ()),
+        "stats": ((), ()),
+        "shutdown": ((), ())
+    }
+    WATCH_INTERVAL = 2
+
+    def __init__(self, download_path, path=None, watch_path=None):
+        self.download_path = download_path
+        self.path = path or socket_path()
+        self.sock = None
+        self.torrents = {}
+        self.watch_path = watch_path
+        self._clients = []
+        self._jobs = []
+        self._running = False
+        self._watched = {}
+
+    def add(self, path, download_path=None):
+        """Start the torrent of the .torrent file. Return its
+        info-hash in hex. The same torrent is added once. Trackers
+        are probed and announced in background.
+
+        """
+        path = os.path.abspath(path)
+        try:
+            meta, hash = torrent.read_meta(path)
+        except IOError:
+            raise RPCError(TORRENT_ERROR, "Invalid .torrent file: %s" % path)
+        key = hash.encode("hex")
+        if key in self.torrents:
+            return key
+        try:
+            t = torrent.Torrent(path, os.path.abspath(download_path or self.download_path))
+        except (KeyError, TypeError, ValueError):
+            # Required fields of info are missing or have wrong types
+            raise RPCError(TORRENT_ERROR, "Invalid .torrent file: %s" % path)
+        try:
+            t.start(background=True)
+        except EnvironmentError as e:
+            t.close()
+            raise RPCError(TORRENT_ERROR, "Unable to start %s: %s" % (path, e))
+        self.torrents[key] = t
+        return key
+
+    def remove(self, hash):
+        """Stop the torrent and forget it. Downloaded files are kept."""
+        self._torrent(hash).close(background=True)
+        del self.torrents[hash]
+        return True
+
+    def pause(self, hash):
+        """Disconnect peers of the torrent and stop it until resumed."""
+        t = self._torrent(hash)
+        if not torrent.session.paused(t):
+            t.pause(background=True)
+        return True
+
+    def resume(self, hash):
+        """Go on with the paused torrent."""
+        t = self._torrent(hash)
+        if torrent.session.paused(t):
+            t.resume(background=True)
+        return True
+
+    def stats(self):
+        """Return a list of stats dicts of all torrents."""
+        active = torrent.session.active()
+        result = []
+        for key, t in sorted(self.torrents.iteritems()):
+            item = t.stats()
+            item["hash"] = key
+            item["paused"] = torrent.session.paused(t)
+            item["active"] = t in active
+            item["status"] = str(t)
+            result.append(item)
+        return result
+
+    def shutdown(self):
+        """Make run() return."""
+        self._running = False
+        return True
+
+    def start(self):
+        """Listen the control socket and watch the folder. Raise
+        socket.error if another daemon listens the socket.
+
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                # Left by a daemon that crashed
+                os.remove(self.path)
+            else:
+                raise socket.error(errno.EADDRINUSE, "The daemon is running already")
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.sock.listen(Daemon.BACKLOG)
+        self.sock.setblocking(False)
+        self._running = True
+        if self.watch_path:
+            self.scan()
+            self._jobs.append(timer.wheel.call_every(Daemon.WATCH_INTERVAL, self.scan))
+        if torrent.metrics_path:
+            self._jobs.append(timer.wheel.call_every(
+                Daemon.EXPORT_METRICS_EVERY,
+                metrics.export,
+                torrent.metrics_path
+            ))
+
+    def message(self):
+        """You have to call this method in a loop.
+        Return False if there is nothing to do.
+
+        """
+        result = False
+        while len(self._clients) < Daemon.MAX_CLIENTS:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                break
+            conn.setblocking(False)
+            self._clients.append(Client(conn))
+            result = True
+        for client in self._clients[:]:
+            if self._message_client(client):
+                result = True
+        return result
+
+    def scan(self):
+        """Add new .torrent files of the watch folder. A file is
+        tried again when it's modified, e.g. it was incomplete.
+
+        """
+        try:
+            names = os.listdir(self.watch_path)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(".torrent"):
+                continue
+            path = os.path.join(self.watch_path, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if self._watched.get(path) == mtime:
+                continue
+            self._watched[path] = mtime
+            try:
+                self.add(path)
+            except (RPCError, EnvironmentError):
+                pass
+
+    def stop(self):
+        """Stop all torrents and close the control socket."""
+        for job in self._jobs:
+            job.cancel()
+        self._jobs = []
+        for client in self._clients:
+            client.conn.close()
+        self._clients = []
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            os.remove(self.path)
+        for t in self.torrents.values():
+            t.close()
+        self.torrents = {}
+        if torrent.metrics_path:
+            metrics.export(torrent.metrics_path)
+
+    def run(self):
+        """Run the session until shutdown() or Ctrl-C.
+        The daemon is started if it's not yet.
+
+        """
+        if not self.sock:
+            self.start()
+        try:
+            while self._running:
+                busy = torrent.message()
+                if self.message():
+                    busy = True
+                if not busy:
+                    time.sleep(0.001)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _torrent(self, hash):
+        t = self.torrents.get(hash)
+        if t is None:
+            raise RPCError(TORRENT_ERROR, "Unknown torrent: %s" % hash)
+        return t
+
+    def _message_client(self, client):
+        """Read requests of the client and send responses.
+        Return False if there is nothing to do.
+
+        """
+        result = False
+        try:
+            data = client.conn.recv(65536)
+        except socket.error as e:
+            data = None if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) else ""
+        if data == "" or len(client.inbox) > Daemon.MAX_REQUEST:
+            self._close_client(client)
+            return True
+        if data:
+            client.inbox += data
+            result = True
+        while "\n" in client.inbox:
+            line, client.inbox = client.inbox.split("\n", 1)
+            if line.strip():
+                client.outbox += self._handle(line) + "\n"
+        if client.outbox:
+            try:
+                sent = client.conn.send(client.outbox)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close_client(client)
+                return True
+            client.outbox = client.outbox[sent:]
+            result = True
+        return result
+
+    def _close_client(self, client):
+        client.conn.close()
+        self._clients.remove(client)
+
+    def _handle(self, line):
+        """Return the JSON-RPC response to the request line."""
+        id = None
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise RPCError(PARSE_ERROR, "Parse error")
+            if not isinstance(request, dict):
+                raise RPCError(INVALID_REQUEST, "Invalid request")
+            id = request.get("id")
+            method = request.get("method")
+            params = request.get("params") or {}
+            if not isinstance(method, basestring) or method not in Daemon.METHODS:
+                raise RPCError(METHOD_NOT_FOUND, "Method not found: %s" % method)
+            result = getattr(self, method)(**self._params(method, params))
+            return json.dumps({"jsonrpc": "2.0", "id": id, "result": result})
+        except RPCError as e:
+            error = {"code": e.code, "message": e.args[0]}
+        except (UnicodeError, EnvironmentError) as e:
+            error = {"code": INTERNAL_ERROR, "message": str(e)}
+        return json.dumps({"jsonrpc": "2.0", "id": id, "error": error})
+
+    def _params(self, method, params):
+        """Return keyword arguments of the method from the params
+        object. Raise RPCError if they don't match the method.
+
+        """
+        required, optional = Daemon.METHODS[method]
+        if not isinstance(params, dict):
+            raise RPCError(INVALID_PARAMS, "Params must be an object")
+        kwargs = {}
+        for name, value in params.iteritems():
+            if name not in required and name not in optional:
+                raise RPCError(INVALID_PARAMS, "Unknown param of %s: %s" % (method, name))
+            if value is None and name in optional:
+                continue
+            if not isinstance(value, basestring):
+                raise RPCError(INVALID_PARAMS, "Param %s must be a string" % name)
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            kwargs[str(name)] = value
+        for name in required:
+            if name not in kwargs:
+                raise RPCError(INVALID_PARAMS, "Missing param of %s: %s" % (method, name))
+        return kwargs
@@ -0,0 +1,623 @@
+import hashlib
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+import bcode
+import convert
+import events
+
+__all__ = ["DHT"]
+
+
+def encode_nodes(contacts):
+    """Convert contacts to "compact node info" string:
+    20-byte ID, 4-byte IP and 2-byte port of each contact.
+
+    """
+    return "".join((
+        "".join((c.id, socket.inet_aton(c.ip), convert.uint_chr(c.port, 2)))
+        for c in contacts
+    ))
+
+
+def decode_nodes(buf):
+    """Convert "compact node info" string to a list of (id, ip, port)."""
+    nodes = []
+    if type(buf) is not str:
+        return nodes
+    for x in xrange(0, len(buf) - 25, 26):
+        id = buf[x:x+20]
+        ip = socket.inet_ntoa(buf[x+20:x+24])
+        port = convert.uint_ord(buf[x+24:x+26])
+        if port:
+            nodes.append((id, ip, port))
+    return nodes
+
+
+def encode_peer(ip, port):
+    """Convert peer address to 6-byte "compact peer info" string."""
+    return "".join((socket.inet_aton(ip), convert.uint_chr(port, 2)))
+
+
+def decode_peer(buf):
+    """Convert 6-byte "compact peer info" string to (ip, port) or None."""
+    if type(buf) is not str or len(buf) != 6:
+        return None
+    return socket.inet_ntoa(buf[0:4]), convert.uint_ord(buf[4:6])
+
+
+def decode_peers(buf):
+    """Convert a string of 6-byte "compact peer info" entries to
+    a list of (ip, port). Entries with port 0 and the tail shorter
+    than an entry are skipped.
+
+    """
+    if type(buf) is not str:
+        return []
+    count = len(buf) / 6
+    fields = struct.unpack("!" + "4sH" * count, buf[:count*6])
+    return [
+        (socket.inet_ntoa(ip), port)
+        for ip, port in zip(fields[0::2], fields[1::2])
+        if port
+    ]
+
+
+def _long(id):
+    """Return 160-bit ID as a number to calculate XOR distances."""
+    return long(id.encode("hex"), 16)
+
+
+class Contact(object):
+    """A remote DHT node in the routing table.
+
+    Attributes:
+
+        id:
+            20-byte node ID.
+
+        ip, port:
+            UDP address of the node.
+
+        failed:
+            Number of queries in a row the node didn't answer.
+
+        seen:
+            When the last message was received from the node.
+
+    """
+
+    def __init__(self, id, ip, port):
+        self.failed = 0
+        self.id = id
+        self.ip = ip
+        self.long = _long(id)
+        self.port = port
+        self.seen = time.time()
+
+    def address(self):
+        return self.ip, self.port
+
+
+class RoutingTable(object):
+    """Kademlia routing table of 160 k-buckets. Bucket i holds
+    contacts whose XOR distance to our ID has bit length i + 1,
+    so buckets near our ID are as precise as the far ones.
+    A full bucket accepts a new contact only in place of one
+    that failed MAX_FAILS queries in a row.
+
+    Methods:
+
+        add(id, ip, port):
+            Insert or refresh a contact. Return the Contact or None
+            if there is no room for it.
+
+        closest(target, count):
+            Return count good contacts closest to target.
+
+        contacts():
+            Return a list of all contacts.
+
+        failed(address):
+            Note that the contact at address didn't answer.
+
+    """
+
+    MAX_FAILS = 2
+
+    def __init__(self, id, k):
+        self.buckets = [[] for _ in xrange(160)]
+        self.id = id
+        self.k = k
+        self._addresses = {}
+        self._long = _long(id)
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def add(self, id, ip, port):
+        """Insert or refresh a contact. Return the Contact or None
+        if there is no room for it.
+
+        """
+        if type(id) is not str or len(id) != 20 or id == self.id:
+            return None
+        contact = self._addresses.get((ip, port))
+        if contact and contact.id != id:
+            self._remove(contact)
+            contact = None
+        if contact:
+            contact.failed = 0
+            contact.seen = time.time()
+            return contact
+        bucket = self.buckets[self._index(_long(id))]
+        for c in bucket:
+            if c.id == id:
+                # Known ID from another address, keep the old one
+                return None
+        if len(bucket) >= self.k:
+            bad = None
+            for c in bucket:
+                if c.failed >= RoutingTable.MAX_FAILS:
+                    bad = c
+                    break
+            if not bad:
+                return None
+            self._remove(bad)
+        contact = Contact(id, ip, port)
+        bucket.append(contact)
+        self._addresses[(ip, port)] = contact
+        return contact
+
+    def closest(self, target, count):
+        """Return count good contacts closest to target."""
+        target = _long(target)
+        contacts = [
+            c for c in self._addresses.itervalues()
+            if c.failed < RoutingTable.MAX_FAILS
+        ]
+        contacts.sort(key=lambda c: c.long ^ target)
+        return contacts[:count]
+
+    def contacts(self):
+        """Return a list of all contacts."""
+        return self._addresses.values()
+
+    def failed(self, address):
+        """Note that the contact at address didn't answer."""
+        contact = self._addresses.get(address)
+        if contact:
+            contact.failed += 1
+
+    def _index(self, long_id):
+        return max((long_id ^ self._long).bit_length() - 1, 0)
+
+    def _remove(self, contact):
+        self.buckets[self._index(contact.long)].remove(contact)
+        del self._addresses[contact.address()]
+
+
+class Lookup(object):
+    """Iterative Kademlia search of the nodes closest to target.
+    Up to ALPHA queries are in flight and the search is finished
+    when the K closest known nodes have all been queried.
+    A get_peers lookup reports found peers through the DHT "peers"
+    event and, if port is set, announces it to the K closest nodes
+    that returned a token.
+
+    """
+
+    def __init__(self, dht, target, method, port=None):
+        self.candidates = {}
+        self.dht = dht
+        self.done = False
+        self.in_flight = 0
+        self.method = method
+        self.port = port
+        self.queried = set()
+        self.target = target
+        self.tokens = {}
+        self._target_long = _long(target)
+
+    def start(self):
+        """Take initial candidates from the routing table and send
+        first queries. Return False if the routing table is empty.
+
+        """
+        for c in self.dht.table.closest(self.target, DHT.K):
+            self.candidates[c.id] = c.address()
+        if not self.candidates:
+            return False
+        self.step()
+        return True
+
+    def step(self):
+        if self.done:
+            return
+        pending = [id for id in self._closest() if id not in self.queried]
+        while self.in_flight < DHT.ALPHA and pending:
+            id = pending.pop(0)
+            self.queried.add(id)
+            self.in_flight += 1
+            if self.method == "get_peers":
+                args = {"info_hash": self.target}
+            else:
+                args = {"target": self.target}
+            self.dht.query(
+                self.candidates[id],
+                self.method,
+                args,
+                lambda r, address, id=id: self._on_response(id, r, address)
+            )
+        if not pending and not self.in_flight:
+            self._finish()
+
+    def _closest(self):
+        ids = sorted(self.candidates, key=lambda id: _long(id) ^ self._target_long)
+        return ids[:DHT.K]
+
+    def _finish(self):
+        self.done = True
+        if self.method != "get_peers" or not self.port:
+            return
+        ids = sorted(self.tokens, key=lambda id: _long(id) ^ self._target_long)
+        for id in ids[:DHT.K]:
+            address, token = self.tokens[id]
+            self.dht.query(address, "announce_peer", {
+                "info_hash": self.target,
+                "implied_port": 0,
+                "port": self.port,
+                "token": token
+            })
+
+    def _on_response(self, id, r, address):
+        self.in_flight -= 1
+        if r is None:
+            self.candidates.pop(id, None)
+            self.step()
+            return
+        for node_id, ip, port in decode_nodes(r.get("nodes")):
+            self.dht.table.add(node_id, ip, port)
+            if node_id not in self.candidates and node_id != self.dht.id:
+                self.candidates[node_id] = (ip, port)
+        if self.method == "get_peers":
+            token = r.get("token")
+            if type(token) is str:
+                self.tokens[id] = (address, token)
+            values = r.get("values")
+            if isinstance(values, list):
+                peers = decode_peers("".join(
+                    v for v in values if type(v) is str and len(v) == 6
+                ))
+                if peers:
+                    self.dht.event_call("peers", self.target, peers)
+        self.step()
+
+
+class DHT(events.EventsModel):
+    """Mainline DHT (BEP 5) node. KRPC messages are bencoded
+    dictionaries sent through the shared udp.Socket. The node
+    answers ping, find_node, get_peers and announce_peer queries
+    and runs iterative lookups to find peers of torrents.
+
+    Attributes:
+
+        id:
+            20-byte node ID. It's kept in the cache between runs.
+
+        peers:
+            Peers announced to us: {info-hash: {(ip, port): expires}}.
+
+        table:
+            RoutingTable object.
+
+    Events:
+
+        peers:
+            Peers of a torrent are found.
+            Prototype: on_peers(info_hash, peers)
+            where peers - a list of (ip, port).
+            To add a handler use: dht.event_connect("peers", function).
+
+    Methods:
+
+        bootstrap(addresses=None):
+            Fill the routing table starting from the addresses.
+
+        get_peers(info_hash, port=None):
+            Search peers of the torrent now and every ANNOUNCE_INTERVAL
+            seconds. If port is set announce that we are a peer too.
+
+        message():
+            You have to call this method in a loop.
+
+        query(address, method, args, callback=None):
+            Send a KRPC query.
+
+        save():
+            Write our ID and the routing table to the cache file.
+
+    """
+
+    ALPHA = 3
+    ANNOUNCE_INTERVAL = 15 * 60
+    BOOTSTRAP = [
+        ("router.bittorrent.com", 6881),
+        ("dht.transmissionbt.com", 6881),
+        ("router.utorrent.com", 6881)
+    ]
+    K = 8
+    MAX_VALUES = 50
+    PEER_TTL = 30 * 60
+    REFRESH_INTERVAL = 15 * 60
+    SAVE_INTERVAL = 5 * 60
+    SECRET_INTERVAL = 5 * 60
+    TIMEOUT = 5
+
+    ERROR_GENERIC = 201
+    ERROR_PROTOCOL = 203
+    ERROR_METHOD = 204
+
+    def __init__(self, sock, id=None, cache_path=None):
+        super(DHT, self).__init__()
+
+        self.cache_path = cache_path
+        self.id = id
+        self.peers = {}
+        self.sock = sock
+        self._lookups = []
+        self._pending = []
+        self._refreshed_at = 0
+        self._resolved = []
+        self._saved_at = time.time()
+        self._searches = {}
+        self._secret_at = time.time()
+        self._secrets = [os.urandom(8), os.urandom(8)]
+        self._tid = random.randint(0, 0xFFFF)
+        self._transactions = {}
+
+        cached = self._load()
+        if not self.id:
+            self.id = hashlib.sha1(os.urandom(20)).digest()
+        self.table = RoutingTable(self.id, DHT.K)
+        for id, ip, port in cached:
+            self.table.add(id, ip, port)
+
+        self.event_init("peers")
+        self.sock.on_recv(lambda data: data[:1] == "d", self._handle)
+
+    def bootstrap(self, addresses=None):
+        """Fill the routing table starting from the addresses.
+        Contacts loaded from the cache are used first. If addresses
+        is None and the cache is not enough, the well-known routers
+        in BOOTSTRAP are resolved in background.
+
+        """
+        self._lookup(self.id, "find_node")
+        self._refreshed_at = time.time()
+        if addresses is not None:
+            self._resolved.extend(addresses)
+            return
+        if len(self.table) >= DHT.K:
+            return
+
+        def resolve():
+            for host, port in DHT.BOOTSTRAP:
+                try:
+                    self._resolved.append((socket.gethostbyname(host), port))
+                except socket.error:
+                    pass
+        thread = threading.Thread(target=resolve)
+        thread.daemon = True
+        thread.start()
+
+    def get_peers(self, info_hash, port=None):
+        """Search peers of the torrent now and every ANNOUNCE_INTERVAL
+        seconds. If port is set announce that we are a peer too.
+
+        """
+        self._searches[info_hash] = [port, time.time()]
+        self._lookup(info_hash, "get_peers", port)
+
+    def message(self):
+        """You have to call this method in a loop.
+        Return False if there is nothing to do.
+
+        """
+        now = time.time()
+        while self._resolved:
+            address = self._resolved.pop(0)
+            self.query(address, "find_node", {"target": self.id})
+
+        # Expire transactions
+        for tid, (address, sent_at, callback) in self._transactions.items():
+            if now - sent_at >= DHT.TIMEOUT:
+                del self._transactions[tid]
+                self.table.failed(address)
+                if callback:
+                    callback(None, address)
+
+        # Start lookups which were waiting for contacts
+        if self._pending and len(self.table):
+            pending = self._pending
+            self._pending = []
+            for lookup in pending:
+                if lookup.start():
+                    self._lookups.append(lookup)
+                else:
+                    self._pending.append(lookup)
+        self._lookups = [l for l in self._lookups if not l.done]
+
+        # Periodic jobs
+        for info_hash, search in self._searches.iteritems():
+            if now - search[1] >= DHT.ANNOUNCE_INTERVAL:
+                search[1] = now
+                self._lookup(info_hash, "get_peers", search[0])
+        if now - self._refreshed_at >= DHT.REFRESH_INTERVAL:
+            self._refreshed_at = now
+            self._lookup(self.id, "find_node")
+        if now - self._secret_at >= DHT.SECRET_INTERVAL:
+            self._secret_at = now
+            self._secrets = [os.urandom(8), self._secrets[0]]
+            self._expire_peers(now)
+        if self.cache_path and now - self._saved_at >= DHT.SAVE_INTERVAL:
+            self.save()
+        return bool(self._transactions)
+
+    def query(self, address, method, args, callback=None):
+        """Send a KRPC query. callback(response, address) is called
+        with the "r" dictionary of the response or with None if the
+        node doesn't answer in TIMEOUT seconds.
+
+        """
+        self._tid = (self._tid + 1) % 0x10000
+        tid = convert.uint_chr(self._tid, 2)
+        args = dict(args)
+        args["id"] = self.id
+        self._transactions[tid] = (address, time.time(), callback)
+        self._send(address, {"t": tid, "y": "q", "q": method, "a": args})
+
+    def save(self):
+        """Write our ID and the routing table to the cache file."""
+        self._saved_at = time.time()
+        if not self.cache_path:
+            return
+        cache = {
+            "id": self.id,
+            "nodes": encode_nodes(self.table.contacts())
+        }
+        try:
+            with open(self.cache_path, "wb") as f:
+                f.write(bcode.encode(cache))
+        except IOError:
+            pass
+
+    def _expire_peers(self, now):
+        for info_hash in self.peers.keys():
+            peers = self.peers[info_hash]
+            for address, expires in peers.items():
+                if expires < now:
+                    del peers[address]
+            if not peers:
+                del self.peers[info_hash]
+
+    def _handle(self, data, address):
+        """Handle a KRPC message from the shared socket."""
+        try:
+            msg = bcode.decode(data)
+        except (IOError, ValueError):
+            return
+        if not isinstance(msg, dict) or type(msg.get("t")) is not str:
+            return
+        y = msg.get("y")
+        if y == "q":
+            self._handle_query(msg, address)
+        elif y in ("r", "e"):
+            self._handle_response(msg, address)
+
+    def _handle_query(self, msg, address):
+        args = msg.get("a")
+        if not isinstance(args, dict) or type(args.get("id")) is not str:
+            self._send_error(msg, address, DHT.ERROR_PROTOCOL, "Invalid arguments")
+            return
+        method = msg.get("q")
+        r = {"id": self.id}
+        if method == "ping":
+            pass
+        elif method == "find_node":
+            target = args.get("target")
+            if type(target) is not str or len(target) != 20:
+                self._send_error(msg, address, DHT.ERROR_PROTOCOL, "Invalid target")
+                return
+            r["nodes"] = encode_nodes(self.table.closest(target, DHT.K))
+        elif method == "get_peers":
+            info_hash = args.get("info_hash")
+            if type(info_hash) is not str or len(info_hash) != 20:
+                self._send_error(msg, address, DHT.ERROR_PROTOCOL, "Invalid info_hash")
+                return
+            r["token"] = self._token(address[0], self._secrets[0])
+            peers = self.peers.get(info_hash)
+            if peers:
+                values = [encode_peer(ip, port) for ip, port in peers.keys()]
+                random.shuffle(values)
+                r["values"] = values[:DHT.MAX_VALUES]
+            else:
+                r["nodes"] = encode_nodes(self.table.closest(info_hash, DHT.K))
+        elif method == "announce_peer":
+            info_hash = args.get("info_hash")
+            token = args.get("token")
+            port = args.get("port")
+            if args.get("implied_port"):
+                port = address[1]
+            if (
+                type(info_hash) is not str or len(info_hash) != 20
+                or type(port) not in (int, long) or not 0 < port < 0x10000
+            ):
+                self._send_error(msg, address, DHT.ERROR_PROTOCOL, "Invalid arguments")
+                return
+            if token not in [self._token(address[0], s) for s in self._secrets]:
+                self._send_error(msg, address, DHT.ERROR_PROTOCOL, "Bad token")
+                return
+            peers = self.peers.setdefault(info_hash, {})
+            peers[(address[0], port)] = time.time() + DHT.PEER_TTL
+        else:
+            self._send_error(msg, address, DHT.ERROR_METHOD, "Method Unknown")
+            return
+        self.table.add(args["id"], address[0], address[1])
+        self._send(address, {"t": msg["t"], "y": "r", "r": r})
+
+    def _handle_response(self, msg, address):
+        transaction = self._transactions.get(msg["t"])
+        if not transaction or transaction[0] != address:
+            return
+        del self._transactions[msg["t"]]
+        callback = transaction[2]
+        r = msg.get("r")
+        if msg["y"] == "e" or not isinstance(r, dict):
+            r = None
+        elif type(r.get("id")) is str:
+            self.table.add(r["id"], address[0], address[1])
+        if r is not None and not callback:
+            # Nodes from bootstrap queries
+            for id, ip, port in decode_nodes(r.get("nodes")):
+                self.table.add(id, ip, port)
+        if callback:
+            callback(r, address)
+
+    def _load(self):
+        """Read our ID and contacts from the cache file.
+        Return a list of (id, ip, port).
+
+        """
+        if not self.cache_path:
+            return []
+        try:
+            with open(self.cache_path, "rb") as f:
+                cache = bcode.decode(f.read())
+        except IOError:
+            return []
+        if not isinstance(cache, dict):
+            return []
+        if not self.id and type(cache.get("id")) is str and len(cache["id"]) == 20:
+            self.id = cache["id"]
+        return decode_nodes(cache.get("nodes"))
+
+    def _lookup(self, target, method, port=None):
+        lookup = Lookup(self, target, method, port)
+        if lookup.start():
+            self._lookups.append(lookup)
+        else:
+            self._pending.append(lookup)
+
+    def _send(self, address, msg):
+        self.sock.sendto(bcode.encode(msg), address)
+
+    def _send_error(self, msg, address, code, text):
+        self._send(address, {"t": msg["t"], "y": "e", "e": [code, text]})
+
+    def _token(self, ip, secret):
+        return hashlib.sha1("".join((secret, ip))).digest()[:8]
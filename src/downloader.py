@@ -1,7 +1,11 @@
 import hashlib
 import random
+import time
 
+import bitfield
 import events
+import file
+import metrics
 import piece
 import request
 
@@ -13,6 +17,49 @@ class Downloader(events.EventsModel):
     was sent to each peer. If a chunk was downloaded
     you have to tell it to this with finish() method.
 
+    Smart ban: the peer that sent every chunk is remembered. When
+    a piece fails SHA1 check, SHA1-hashes of its chunks are kept and
+    the peers that sent them are suspects. The piece is downloaded
+    again from one peer, not a suspect if anybody else has it, so
+    if it fails again that peer is proven guilty. Chunks that two
+    peers have sent the same are kept, corrupt chunks hardly match.
+    When the piece is verified at last, peers whose chunks differ
+    from the right ones are proven to send corrupt data too.
+    Proven peers are banned.
+
+    Memory: buffers of a piece take up to its length until it's
+    verified and written. The length is reserved in the memory
+    budget (if it's set) when the piece is started. No pieces are
+    started while the budget is exhausted, so the number of active
+    pieces is MAX_ACTIVE_PIECES at most and as many as the budget
+    allows.
+
+    Request timeouts: every peer has its own timeout derived from
+    its smoothed request latency and deviation like RTO of TCP.
+    A request that takes longer is overdue: its chunk is requested
+    from another peer too while the first request goes on. After
+    HARD_TIMEOUT timeouts (TIMEOUT seconds at most) the request is
+    canceled and the timeout of the peer is doubled until it sends
+    any chunk.
+
+    Attributes:
+
+        completed:
+            bitfield.Bitfield of downloaded and verified pieces.
+
+        cursor:
+            The first piece of the deadline window in streaming mode
+            or None. It moves forward past downloaded pieces.
+
+        label:
+            Name of the torrent in metrics.
+
+        memory:
+            scheduler.MemoryBudget shared with other torrents
+            or None (no limit).
+
+        window:
+            Number of pieces in the deadline window.
 
     Events:
 
@@ -32,6 +79,11 @@ class Downloader(events.EventsModel):
             Prototype: on_finished()
             To add a handler use: downloader.event_connect("finish", function).
 
+        ban:
+            The peer has sent corrupt data. It should be disconnected.
+            Prototype: on_ban(node)
+            To add a handler use: downloader.event_connect("ban", function).
+
         piece:
             A whole piece was downloaded and verified.
             Prototype: on_piece_downloaded(node, piece, data)
@@ -41,6 +93,42 @@ class Downloader(events.EventsModel):
 
     Methods:
 
+        set_priorities(priorities):
+            Set priorities (file.File.PRIORITY_*) of all pieces.
+            Skipped pieces are not downloaded, pieces of higher
+            priority are started first.
+
+        forget(piece):
+            Mark a downloaded piece as missing to download it again.
+
+        choke(node):
+            The peer has choked the client. Release its requests
+            unless the peer supports the Fast Extension.
+
+        release(node):
+            Release all requests of the peer, e.g. it's snubbed
+            or going to be disconnected.
+
+        reject(node, piece, chunk):
+            The peer has rejected a request. Release it.
+
+        stream(cursor=0, window=None):
+            Switch on streaming mode. Pieces of the deadline window
+            from the cursor are downloaded first, pieces beyond it
+            are downloaded rarest first.
+
+        have(piece):
+            Return True if the piece is downloaded and verified.
+
+        have_count():
+            Return number of downloaded and verified pieces.
+
+        interesting(node):
+            Return number of pieces the peer has that are not started yet.
+
+        available():
+            Return number of pieces not started yet that someone has.
+
         next():
             Tell what chunks need to be downloaded now.
             Return a list of request.Request objects.
@@ -53,43 +141,88 @@ class Downloader(events.EventsModel):
             to the disk.
 
         message():
-            Call this in main cycle. It removes timeouts from downloads.
+            Call this in main cycle. It requests overdue chunks from
+            other peers and cancels timed out requests.
+
+        close():
+            Drop all requests and active pieces and release their memory.
+
+        reserved():
+            Return bytes of memory reserved for active pieces.
+
+        requests_count():
+            Return number of chunk requests in flight.
+
+        active_count():
+            Return number of pieces being downloaded.
 
         downloaded():
             Return length of all downloaded data in bytes including bad.
 
+        verified():
+            Return length of downloaded data in bytes that passed SHA1 check.
+
         nodes_count():
             Return a tuple (active peers, all peers).
 
         progress():
-            Return download progress from 0.0 to 1.0 (by downloaded pieces).
+            Return download progress from 0.0 to 1.0 (by downloaded
+            pieces that are not skipped).
 
         total():
             Return length of all torrent in bytes.
 
     """
 
+    AVAILABILITY_INTERVAL = 5
+    DEADLINE = 2
+    HARD_TIMEOUT = 4
+    INITIAL_TIMEOUT = 15
     MAX_ACTIVE_PIECES = 16
-    MAX_ACTIVE_CHUNKS = 16
+    MAX_BACKOFF = 6
+    MAX_DUPLICATES = 2
     MAX_REQUESTS = 4
+    MIN_TIMEOUT = 2
+    NEARLY_DONE = 0.25
     TIMEOUT = 60
+    WINDOW = 8
 
     def __init__(self, nodes, pieces):
         super(Downloader, self).__init__()
 
         if not isinstance(nodes, list):
             raise TypeError("nodes: expected list")
-        if not isinstance(pieces, list):
-            raise TypeError("pieces: expected list")
-
+        if not isinstance(pieces, piece.PieceList):
+            raise TypeError("pieces: expected piece.PieceList")
+
+        self.completed = bitfield.Bitfield(len(pieces))
+        self.cursor = None
+        self.label = ""
+        self.memory = None
+        self.window = Downloader.WINDOW
         self._active_pieces = []
         self._all_nodes = nodes
         self._all_pieces = pieces
+        self._availability = None
+        self._availability_at = 0
+        self._banned = set()
         self._downloaded_bytes = 0
-        self._inactive_pieces = pieces[:]
+        self._completed_count = 0
+        self._failures = {}
+        self._overdue = []
+        self._owners = {}
+        self._inactive_count = len(pieces)
+        self._levels = None
+        self._needed = bitfield.Bitfield(len(pieces), fill=True)
         self._requests = []
+        self._reserved = 0
+        self._suspects = {}
+        self._verified_bytes = 0
+        self._wanted = bitfield.Bitfield(len(pieces), fill=True)
+        self._wanted_count = len(pieces)
 
         self.event_init(
+            "ban",
             "cancel",
             "finish",
             "piece"
@@ -114,45 +247,263 @@ class Downloader(events.EventsModel):
         to the disk.
 
         """
-        n.active -= 1
-        if len(self._all_pieces) <= index:
-            return
-        p = self._all_pieces[index]
-        if len(p.chunks_map) <= chunk:
+        for r in self._requests:
+            if r.node is n and (r.piece, r.chunk) == (index, chunk):
+                self._requests.remove(r)
+                # Late data of released or canceled requests
+                # was uncounted already
+                n.active -= 1
+                n.update_rtt(r.elapsed())
+                n.timeouts = 0
+                if metrics.enabled:
+                    metrics.histogram(
+                        "cbt_request_rtt_seconds",
+                        "Time from request to piece message",
+                        torrent=self.label
+                    ).observe(r.elapsed())
+                break
+        p = self._all_pieces.get(index)
+        if p is None or len(p.chunks_map) <= chunk:
             return
         p.chunks_map[chunk] = piece.Piece.STATUS_COMPLETE
         p.chunks_buf[chunk] = data
+        p.chunks_from[chunk] = n
         self._downloaded_bytes += len(data)
         is_full = True
         for buf in p.chunks_buf:
             if not buf:
                 is_full = False
                 break
-        for r in self._requests:
-            if (r.node, r.piece, r.chunk) == (n, index, chunk):
-                self._requests.remove(r)
-                break
+        for r in self._requests[:]:
+            if (r.piece, r.chunk) == (index, chunk):
+                # A duplicate request of a late or endgame chunk
+                self._cancel(r)
         if is_full:
             p_data = "".join(p.chunks_buf)
             p_hash = hashlib.sha1(p_data).digest()
+            origins = p.chunks_from
             p.clear()
             if p_hash != p.hash:
                 p.alloc()
+                self._suspect(p, origins, p_data)
+                if metrics.enabled:
+                    metrics.counter(
+                        "cbt_hash_failures_total",
+                        "Pieces that failed SHA1 check",
+                        torrent=self.label
+                    ).inc()
+                    metrics.counter(
+                        "cbt_wasted_bytes_total",
+                        "Bytes of pieces that failed SHA1 check",
+                        torrent=self.label
+                    ).inc(len(p_data))
             else:
+                self._verified_bytes += len(p_data)
                 self._active_pieces.remove(p)
+                self._all_pieces.complete(p.index)
+                self.completed.set(p.index)
+                self._completed_count += 1
+                if p.index in self._failures:
+                    self._convict(p.index, p_data)
                 self.event_call("piece", n, p.index, p_data)
+                # The piece is written
+                self._release_memory(p.length)
+
+    def set_priorities(self, priorities):
+        """Set priorities (file.File.PRIORITY_*) of all pieces, one
+        per piece. Skipped pieces are not downloaded, pieces of higher
+        priority are started first. Pieces being downloaded go on.
+
+        """
+        count = len(self._all_pieces)
+        levels = {}
+        for priority in (
+            file.File.PRIORITY_HIGH,
+            file.File.PRIORITY_NORMAL,
+            file.File.PRIORITY_LOW
+        ):
+            levels[priority] = bitfield.Bitfield(count)
+        for index, priority in enumerate(priorities):
+            if priority != file.File.PRIORITY_SKIP:
+                levels[priority].set(index)
+        self._wanted = bitfield.union(levels.values())
+        self._wanted_count = self._wanted.count()
+        active = bitfield.Bitfield(count)
+        for p in self._active_pieces:
+            active.set(p.index)
+        self._needed = self._wanted.difference(self.completed).difference(active)
+        self._inactive_count = self._needed.count()
+        # No need to sort pieces if all wanted ones are equal
+        self._levels = None
+        if levels[file.File.PRIORITY_NORMAL].count() != self._wanted_count:
+            self._levels = [
+                levels[file.File.PRIORITY_HIGH],
+                levels[file.File.PRIORITY_NORMAL],
+                levels[file.File.PRIORITY_LOW]
+            ]
+
+    def forget(self, index):
+        """Mark the downloaded piece as missing, e.g. its data was
+        not stored because it's shared with a skipped file. The piece
+        is downloaded again if it's wanted.
+
+        """
+        if not self.completed.get(index):
+            return
+        self.completed.set(index, False)
+        self._completed_count -= 1
+        self._all_pieces.reset(index)
+        if self._wanted.get(index):
+            self._needed.set(index)
+            self._inactive_count += 1
+
+    def choke(self, n):
+        """The peer has choked the client. Without the Fast Extension
+        all its requests are discarded, so release them at once
+        instead of waiting for TIMEOUT. Fast peers reject requests
+        explicitly. Return True if any request was released.
+
+        """
+        if n.fast:
+            return False
+        return self.release(n)
+
+    def release(self, n):
+        """Release all requests of the peer, e.g. it's snubbed or
+        going to be disconnected, so the chunks can be requested
+        from other peers right now. Return True if any request
+        was released.
+
+        """
+        released = False
+        for r in self._requests[:]:
+            if r.node is n:
+                self._release(r)
+                released = True
+        return released
+
+    def reject(self, n, index, chunk):
+        """The peer has rejected a request. Release it so the chunk
+        can be requested from another peer right now.
+        Return True if the request was found.
+
+        """
+        for r in self._requests:
+            if (r.node, r.piece, r.chunk) == (n, index, chunk):
+                self._release(r)
+                return True
+        return False
+
+    def stream(self, cursor=0, window=None):
+        """Switch on streaming mode. Pieces of the deadline window
+        from the cursor are downloaded first, pieces beyond it
+        are downloaded rarest first. Late pieces of the window
+        are requested from the fastest peers once more.
+
+        """
+        self.cursor = cursor
+        if window:
+            self.window = window
+
+    def have(self, index):
+        """Return True if the piece is downloaded and verified."""
+        return self.completed.get(index)
+
+    def have_count(self):
+        """Return number of downloaded and verified pieces."""
+        return self._completed_count
+
+    def interesting(self, n):
+        """Return number of pieces the peer has that are not started yet."""
+        if n.have_all:
+            return self._needed.count()
+        return self._needed.intersection(n.bitfield).count()
+
+    def available(self):
+        """Return number of pieces not started yet that someone has."""
+        return self._available(self._all_nodes).count()
 
     def message(self):
-        """Call this in main cycle. It removes timeouts from downloads."""
+        """Call this in main cycle. Requests that take longer than
+        the timeout of their peers become overdue, their chunks may
+        be requested from other peers. Requests that take longer than
+        HARD_TIMEOUT timeouts are canceled. Return True if any request
+        became overdue.
+
+        """
+        overdue = False
+        expired = []
+        timeouts = {}
+        now = time.time()
         for r in self._requests:
-            if r.elapsed() >= Downloader.TIMEOUT:
-                self._cancel(r)
+            elapsed = now - r.started_at
+            if elapsed < Downloader.MIN_TIMEOUT:
+                # Requests are in order of time, the rest are younger
                 break
+            timeout = timeouts.get(r.node)
+            if timeout is None:
+                timeout = timeouts[r.node] = self._timeout(r.node)
+            if elapsed >= min(timeout * Downloader.HARD_TIMEOUT, Downloader.TIMEOUT):
+                expired.append(r)
+            elif elapsed >= timeout and not r.overdue:
+                r.overdue = True
+                self._overdue.append(r)
+                overdue = True
+        # A peer's timeout doubles once per pass however many
+        # of its requests expired
+        for n in set(r.node for r in expired):
+            n.timeouts += 1
+        for r in expired:
+            if r not in self._requests:
+                continue
+            if metrics.enabled:
+                metrics.counter(
+                    "cbt_request_timeouts_total",
+                    "Requests canceled by timeout",
+                    torrent=self.label
+                ).inc()
+            self._cancel(r)
+        return overdue
+
+    def close(self):
+        """Drop all requests and active pieces and release their
+        memory, e.g. the torrent is paused or removed. The pieces
+        are started again when the download goes on.
+
+        """
+        for r in self._requests:
+            if r.node in self._all_nodes:
+                r.node.active -= 1
+        self._requests = []
+        self._overdue = []
+        for p in self._active_pieces:
+            self._all_pieces.reset(p.index)
+            if self._wanted.get(p.index):
+                self._needed.set(p.index)
+                self._inactive_count += 1
+        self._active_pieces = []
+        self._release_memory(self._reserved)
+
+    def reserved(self):
+        """Return bytes of memory reserved for active pieces."""
+        return self._reserved
+
+    def requests_count(self):
+        """Return number of chunk requests in flight."""
+        return len(self._requests)
+
+    def active_count(self):
+        """Return number of pieces being downloaded."""
+        return len(self._active_pieces)
 
     def downloaded(self):
         """Return length of all downloaded data in bytes including bad."""
         return self._downloaded_bytes
 
+    def verified(self):
+        """Return length of downloaded data in bytes that passed SHA1 check."""
+        return self._verified_bytes
+
     def nodes_count(self):
         """Return a tuple (active peers, all peers)."""
         all_len = len(self._all_nodes)
@@ -160,75 +511,244 @@ class Downloader(events.EventsModel):
         return all_len - empty_len, all_len
 
     def progress(self):
-        """Return download progress from 0.0 to 1.0 (by downloaded pieces)."""
-        all_len = float(len(self._all_pieces))
-        not_downloaded_len = float(len(self._active_pieces) + len(self._inactive_pieces))
-        return 1.0 - not_downloaded_len / all_len
+        """Return download progress from 0.0 to 1.0 (by downloaded
+        pieces that are not skipped).
+
+        """
+        if self._wanted_count == len(self._all_pieces):
+            return self._completed_count / float(len(self._all_pieces))
+        if not self._wanted_count:
+            return 1.0
+        completed = self.completed.intersection(self._wanted).count()
+        return completed / float(self._wanted_count)
 
     def total(self):
         """Return length of all torrent in bytes."""
-        return len(self._all_pieces) * self._all_pieces[0].chunks_count * piece.Piece.CHUNK
+        return self._all_pieces.total
 
     def _cancel(self, r):
         """Remove the request (r) from active requests, rollback
         all statuses to initial state and call on_cancel handlers.
 
+        """
+        self._release(r)
+        self.event_call("cancel", r.node, r.piece, r.chunk)
+
+    def _release(self, r):
+        """Remove the request (r) from active requests and rollback
+        all statuses to initial state.
+
         """
         self._requests.remove(r)
         if r.node in self._all_nodes:
             r.node.active -= 1
+        p = self._all_pieces.get(r.piece)
         if (
-            r.piece < len(self._all_pieces)
-            and r.chunk < len(self._all_pieces[r.piece].chunks_map)
+            p
+            and r.chunk < len(p.chunks_map)
+            and p.chunks_map[r.chunk] == piece.Piece.STATUS_DOWNLOAD
         ):
-            self._all_pieces[r.piece].chunks_map[r.chunk] = piece.Piece.STATUS_EMPTY
-        self.event_call("cancel", r.node, r.piece, r.chunk)
+            for other in self._requests:
+                if (other.piece, other.chunk) == (r.piece, r.chunk):
+                    # Another request of the chunk is still active
+                    break
+            else:
+                p.chunks_map[r.chunk] = piece.Piece.STATUS_EMPTY
+
+    def _activate(self, index):
+        """Start to download a new piece. Return False if its memory
+        doesn't fit into the budget.
+
+        """
+        length = self._all_pieces.size(index)
+        if self.memory and not self.memory.reserve(length):
+            return False
+        self._reserved += length
+        self._active_pieces.append(self._all_pieces.start(index))
+        self._inactive_count -= 1
+        self._needed.set(index, False)
+        return True
+
+    def _release_memory(self, length):
+        self._reserved -= length
+        if self.memory:
+            self.memory.release(length)
+
+    def _available(self, nodes):
+        """Return Bitfield of pieces not started yet that the nodes have."""
+        for n in nodes:
+            if n.have_all:
+                return self._needed.intersection(self._needed)
+        return self._needed.intersection(bitfield.union(n.bitfield for n in nodes))
 
     def _idle_nodes(self, only_empty=False):
         """Return list of all peers which download less than MAX_REQUESTS chunks
-        at the moment. If only_empty is True return only peers to which were
-        sent no one request.
+        (one chunk if snubbed) at the moment. If only_empty is True return
+        only peers to which were sent no one request.
 
         """
         nodes = []
         for n in self._all_nodes:
-            if n.active < Downloader.MAX_REQUESTS and not only_empty:
+            if n.active < self._max_requests(n) and not only_empty:
                 nodes.append(n)
             if n.active == 0 and only_empty:
                 nodes.append(n)
         return nodes
 
-    def _is_endgame(self):
-        return len(self._inactive_pieces) == 0
+    def _timeout(self, n):
+        """Return the request timeout of the peer: its smoothed latency
+        plus four deviations (INITIAL_TIMEOUT before the first chunk),
+        doubled for every timeout in a row.
 
-    def _next_endgame(self):
-        new_requests = []
+        """
+        if n.rtt:
+            timeout = max(n.rtt + 4 * n.rtt_var, Downloader.MIN_TIMEOUT)
+        else:
+            timeout = Downloader.INITIAL_TIMEOUT
+        timeout *= 2 ** min(n.timeouts, Downloader.MAX_BACKOFF)
+        return min(timeout, Downloader.TIMEOUT)
+
+    def _max_requests(self, n):
+        """Snubbed peers get one request at a time."""
+        if n.snubbed:
+            return 1
+        return Downloader.MAX_REQUESTS
+
+    def _suspect(self, p, origins, data):
+        """Remember hashes of chunks of the failed piece and who
+        sent them. The peers are not asked for the piece again
+        while others have it. Chunks that another peer has sent
+        the same in a failed attempt are kept.
+
+        """
+        hashes = _chunk_hashes(data)
+        attempts = self._failures.setdefault(p.index, [])
+        confirmed = []
+        for chunk, digest in enumerate(hashes):
+            for attempt in attempts:
+                n, other = attempt[chunk]
+                if other == digest and n is not origins[chunk]:
+                    confirmed.append(chunk)
+                    break
+        # If all chunks match, the matches are wrong
+        if len(confirmed) < len(hashes):
+            for chunk in confirmed:
+                begin = chunk * piece.Piece.CHUNK
+                p.chunks_buf[chunk] = data[begin:begin+piece.Piece.CHUNK]
+                p.chunks_from[chunk] = origins[chunk]
+                p.chunks_map[chunk] = piece.Piece.STATUS_COMPLETE
+        attempts.append(zip(origins, hashes))
+        suspects = self._suspects.setdefault(p.index, set())
+        for n in set(origins):
+            if n is not None:
+                n.hashfails += 1
+                suspects.add(n)
+        if len(set(origins)) == 1 and origins[0] is not None:
+            # The only peer has sent the whole piece
+            self._owners.pop(p.index, None)
+            self._ban(origins[0])
+
+    def _convict(self, index, data):
+        """Compare chunks of failed attempts with the verified piece
+        and ban the peers that sent different ones.
+
+        """
+        right = _chunk_hashes(data)
+        guilty = set()
+        for attempt in self._failures.pop(index):
+            for (n, digest), good in zip(attempt, right):
+                if n is not None and digest != good:
+                    guilty.add(n)
+        self._suspects.pop(index, None)
+        self._owners.pop(index, None)
+        for n in guilty:
+            self._ban(n)
+
+    def _ban(self, n):
+        if n in self._banned:
+            return
+        self._banned.add(n)
+        if metrics.enabled:
+            metrics.counter(
+                "cbt_banned_peers_total",
+                "Peers banned for corrupt data",
+                torrent=self.label
+            ).inc()
+        self.event_call("ban", n)
+
+    def _trusted(self, index, nodes):
+        """Return the peers (of nodes) the failed piece may be requested
+        from: the only peer that downloads it again. It's chosen from
+        peers that aren't suspects, from suspects if nobody else has
+        the piece.
 
-        for p in self._inactive_pieces:
-            p.alloc()
-            self._active_pieces.append(p)
-        self._inactive_pieces = []
+        """
+        suspects = self._suspects.get(index)
+        if suspects is None:
+            return nodes
+        owner = self._owners.get(index)
+        if owner in nodes:
+            return [owner]
+        if owner in self._all_nodes and self._can_request(owner, index):
+            # Busy, wait for it
+            return []
+        trusted = [n for n in nodes if n not in suspects]
+        if not trusted:
+            for n in self._all_nodes:
+                if n not in suspects and self._can_request(n, index):
+                    # Wait for it
+                    return []
+            trusted = nodes
+        if not trusted:
+            return []
+        owner = max(trusted, key=lambda n: n.score)
+        self._owners[index] = owner
+        return [owner]
+
+    def _can_request(self, n, index):
+        """Return True if the piece may be requested from the peer now:
+        the peer has it and unchokes the client or allows it fast.
+
+        """
+        if n in self._banned or not n.get_piece(index):
+            return False
+        return n.p_choke == n.FALSE or index in n.allowed_fast
 
-        print "EG!!"
+    def _eligible(self, index, nodes):
+        """Return a new list of the peers (of nodes) the piece may be
+        requested from now.
+
+        """
+        return self._trusted(index, [n for n in nodes if self._can_request(n, index)])
+
+    def _is_endgame(self):
+        return self._inactive_count == 0
+
+    def _next_endgame(self):
+        """Compile a list of new requests in endgame mode: every free
+        chunk is requested from MAX_DUPLICATES peers that have it,
+        the least busy ones first.
 
+        """
+        new_requests = []
         for p in self._active_pieces:
+            if piece.Piece.STATUS_EMPTY not in p.chunks_map:
+                continue
+            # The same peers for all chunks of the piece
+            nodes = self._eligible(p.index, self._all_nodes)
             for chunk in xrange(len(p.chunks_map)):
-                if p.active >= Downloader.MAX_ACTIVE_CHUNKS:
+                if not nodes:
                     break
                 if p.chunks_map[chunk] == piece.Piece.STATUS_EMPTY:
-                    nodes = []
-                    for n in self._all_nodes:
-                        if n.get_piece(p.index):
-                            nodes.append(n)
-                    for n in nodes:
-                        p.chunks_map[chunk] = piece.Piece.STATUS_DOWNLOAD
+                    p.chunks_map[chunk] = piece.Piece.STATUS_DOWNLOAD
+                    nodes.sort(key=lambda n: n.active)
+                    for n in nodes[:Downloader.MAX_DUPLICATES]:
                         n.active += 1
-                        if n.active == Downloader.MAX_REQUESTS:
-                            nodes.remove(n)
                         r = request.Request(n, p.index, chunk)
                         new_requests.append(r)
                         self._requests.append(r)
 
+        new_requests.extend(self._next_overdue(self._idle_nodes()))
         return new_requests
 
     def _next_normal(self):
@@ -237,54 +757,226 @@ class Downloader(events.EventsModel):
         # Get all idle nodes
         idle_nodes = self._idle_nodes()
 
-        # Start to download pieces
-        for _ in xrange(Downloader.MAX_ACTIVE_PIECES):
-            if (
-                len(self._active_pieces) < Downloader.MAX_ACTIVE_PIECES
-                and len(self._inactive_pieces)
-            ):
-                # Check if someone has this piece
-                p = self._inactive_pieces[0]
-                has_someone = False
-                for n in idle_nodes:
-                    if n.get_piece(p.index):
-                        has_someone = True
-                        break
-                if not has_someone:
+        # Start to download pieces that choking peers allow to download
+        for n in idle_nodes:
+            if n.p_choke == n.FALSE or not n.allowed_fast:
+                continue
+            for index in n.allowed_fast:
+                if len(self._active_pieces) >= Downloader.MAX_ACTIVE_PIECES:
+                    break
+                if not 0 <= index < len(self._all_pieces) or not n.get_piece(index):
                     continue
-                # Start to download a new piece
-                p.alloc()
-                self._active_pieces.append(p)
-                del self._inactive_pieces[0]
-            else:
-                break
+                if self._needed.get(index) and not self._activate(index):
+                    break
+
+        window = self._window()
+        limit = Downloader.MAX_ACTIVE_PIECES
+        if window:
+            # Pieces of the deadline window don't count against the limit
+            start, end = window
+            limit += len([p for p in self._active_pieces if start <= p.index < end])
+
+        # Start to download the first pieces that idle peers have.
+        # In streaming mode the window goes first, then the rarest pieces
+        if window or len(self._active_pieces) < limit:
+            unchoked = [n for n in idle_nodes if n.p_choke == n.FALSE]
+            available = self._available(unchoked)
+            if window:
+                for index in xrange(*window):
+                    if available.get(index):
+                        available.set(index, False)
+                        if not self._activate(index):
+                            break
+                        limit += 1
+            while len(self._active_pieces) < limit:
+                index = self._pick(available, rarest=bool(window))
+                if index is None or index >= len(self._all_pieces):
+                    break
+                available.set(index, False)
+                if not self._activate(index):
+                    break
+
+        if window:
+            # The window first in order of the cursor
+            start, end = window
+            self._active_pieces.sort(key=lambda p: (not start <= p.index < end, p.index))
 
         # Start to download chunks
         for p in self._active_pieces:
+            left = p.chunks_map.count(piece.Piece.STATUS_EMPTY)
+            if not left or not idle_nodes:
+                continue
+            # Compile list of free peers which have this piece,
+            # once for all its chunks
+            nodes = self._eligible(p.index, idle_nodes)
             for chunk in xrange(len(p.chunks_map)):
                 # Take a free chunk from an active piece if it exists
-                # and if the limit of active chunks wasn't reached
-                if p.active >= Downloader.MAX_ACTIVE_CHUNKS:
+                # and if there are free peers
+                if not nodes:
                     break
                 if p.chunks_map[chunk] == piece.Piece.STATUS_EMPTY:
-                    # Compile list of free peers which have this piece
-                    nodes = []
-                    for n in idle_nodes:
-                        if n.get_piece(p.index):
-                            nodes.append(n)
-                    if len(nodes):
-                        p.chunks_map[chunk] = piece.Piece.STATUS_DOWNLOAD
-                        # Take random peer from this list and
-                        # remove it from the list if the limit
-                        # of requests to one peer was reached
+                    p.chunks_map[chunk] = piece.Piece.STATUS_DOWNLOAD
+                    # Take random peer from this list (the fastest
+                    # one for the window, the best one for the last
+                    # chunks of a piece) and remove it from the list
+                    # if the limit of requests to one peer was reached
+                    if window and window[0] <= p.index < window[1]:
+                        n = max(nodes, key=lambda n: n.download_rate)
+                    elif left <= len(p.chunks_map) * Downloader.NEARLY_DONE:
+                        n = max(nodes, key=lambda n: n.score)
+                    else:
                         n = random.choice(nodes)
-                        n.active += 1
-                        if n.active == Downloader.MAX_REQUESTS:
-                            idle_nodes.remove(n)
-                        # Create new request with this peer, piece,
-                        # and chunk and add it to requests lists
-                        r = request.Request(n, p.index, chunk)
-                        new_requests.append(r)
-                        self._requests.append(r)
+                    left -= 1
+                    n.active += 1
+                    if n.active >= self._max_requests(n):
+                        idle_nodes.remove(n)
+                        nodes.remove(n)
+                    # Create new request with this peer, piece,
+                    # and chunk and add it to requests lists
+                    r = request.Request(n, p.index, chunk)
+                    new_requests.append(r)
+                    self._requests.append(r)
+
+        new_requests.extend(self._next_overdue(idle_nodes))
+        if window:
+            new_requests.extend(self._next_late(idle_nodes, window))
+        return new_requests
+
+    def _next_late(self, idle_nodes, window):
+        """Request chunks of late pieces of the window once more
+        from the fastest peers. A piece is late if it's downloaded
+        longer than DEADLINE seconds for every piece before it.
+
+        """
+        new_requests = []
+        requested = None
+        now = time.time()
+        start, end = window
+        for p in self._active_pieces:
+            if not start <= p.index < end:
+                continue
+            if now - p.started_at < Downloader.DEADLINE * (p.index - start + 1):
+                continue
+            if requested is None:
+                requested = self._requested()
+            for chunk in xrange(len(p.chunks_map)):
+                if p.chunks_map[chunk] != piece.Piece.STATUS_DOWNLOAD:
+                    continue
+                nodes = requested.setdefault((p.index, chunk), [])
+                r = self._request_again(p, chunk, idle_nodes, nodes)
+                if r:
+                    new_requests.append(r)
+        return new_requests
+
+    def _next_overdue(self, idle_nodes):
+        """Request chunks of overdue requests once more from other
+        peers. The overdue requests are not canceled.
 
+        """
+        if not self._overdue:
+            return []
+        if not idle_nodes:
+            if len(self._overdue) > len(self._requests):
+                # Forget finished ones
+                active = set(self._requests)
+                self._overdue = [r for r in self._overdue if r in active]
+            return []
+        new_requests = []
+        requested = self._requested()
+        waiting = []
+        for r in self._overdue:
+            nodes = requested.get((r.piece, r.chunk))
+            if not nodes or r.node not in nodes:
+                # Finished or canceled
+                continue
+            if len(nodes) >= Downloader.MAX_DUPLICATES:
+                continue
+            p = self._all_pieces.get(r.piece)
+            if idle_nodes and p:
+                again = self._request_again(p, r.chunk, idle_nodes, nodes)
+                if again:
+                    new_requests.append(again)
+                    continue
+            waiting.append(r)
+        self._overdue = waiting
         return new_requests
+
+    def _requested(self):
+        """Return {(piece, chunk): [peers]} of active requests."""
+        requested = {}
+        for r in self._requests:
+            requested.setdefault((r.piece, r.chunk), []).append(r.node)
+        return requested
+
+    def _request_again(self, p, chunk, idle_nodes, requested):
+        """Request the chunk being downloaded from one more peer,
+        the fastest of idle ones that don't download it yet
+        (requested is a list of peers that do). Return the new
+        request or None.
+
+        """
+        if len(requested) >= Downloader.MAX_DUPLICATES:
+            return None
+        nodes = [
+            n for n in idle_nodes
+            if n not in requested and self._can_request(n, p.index)
+        ]
+        nodes = self._trusted(p.index, nodes)
+        if not nodes:
+            return None
+        n = max(nodes, key=lambda n: n.download_rate)
+        n.active += 1
+        if n.active >= self._max_requests(n):
+            idle_nodes.remove(n)
+        requested.append(n)
+        r = request.Request(n, p.index, chunk)
+        self._requests.append(r)
+        return r
+
+    def _window(self):
+        """Return (start, end) pieces of the deadline window
+        or None if streaming mode is off.
+
+        """
+        if self.cursor is None:
+            return None
+        while self.cursor < len(self._all_pieces) and self.completed.get(self.cursor):
+            self.cursor += 1
+        return self.cursor, min(self.cursor + self.window, len(self._all_pieces))
+
+    def _pick(self, available, rarest=False):
+        """Return the first (or the rarest) of the available pieces
+        of the highest priority or None.
+
+        """
+        candidates = available
+        if self._levels:
+            for level in self._levels:
+                candidates = available.intersection(level)
+                if candidates.first() is not None:
+                    break
+        if rarest:
+            return self._rarest(candidates)
+        return candidates.first()
+
+    def _rarest(self, candidates):
+        """Return the index of the first of the rarest candidates
+        or None. Peers are counted once in AVAILABILITY_INTERVAL seconds.
+
+        """
+        if time.time() - self._availability_at >= Downloader.AVAILABILITY_INTERVAL:
+            self._availability = bitfield.Availability(len(self._all_pieces))
+            for n in self._all_nodes:
+                # Seeds have everything, they don't change the order
+                if not n.have_all:
+                    self._availability.add(n.bitfield)
+            self._availability_at = time.time()
+        return self._availability.rarest(candidates).first()
+
+
+def _chunk_hashes(data):
+    """Return a list of SHA1-hashes of chunks of the piece data."""
+    return [
+        hashlib.sha1(data[x:x+piece.Piece.CHUNK]).digest()
+        for x in xrange(0, len(data), piece.Piece.CHUNK)
+    ]
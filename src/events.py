@@ -12,6 +12,10 @@ class EventsModel(object):
         if event in self._handlers and handler not in self._handlers[event]:
             self._handlers[event].append(handler)
 
+    def event_disconnect(self, event, handler):
+        if event in self._handlers and handler in self._handlers[event]:
+            self._handlers[event].remove(handler)
+
     def event_init(self, *events):
         for event in events:
             self._handlers[event] = []
@@ -21,6 +21,11 @@ class File(object):
         offset:
             Index of the first byte of the file in the whole torrent
 
+        priority:
+            Download priority of the file (PRIORITY_*).
+            Skipped files are not created and not downloaded
+            except parts of pieces shared with other files.
+
     Methods:
 
         create():
@@ -28,6 +33,11 @@ class File(object):
 
     """
 
+    PRIORITY_SKIP = 0
+    PRIORITY_LOW = 1
+    PRIORITY_NORMAL = 2
+    PRIORITY_HIGH = 3
+
     def __init__(self, intorrent_path, download_path, size, offset):
         if type(intorrent_path) is str:
             intorrent_path = intorrent_path.split(os.sep)
@@ -37,6 +47,7 @@ class File(object):
         self.path = os.sep.join(full_path[:-1])
         self.size = size
         self.offset = offset
+        self.priority = File.PRIORITY_NORMAL
 
     def create(self):
         """Allocate physical memory on disk for the file.
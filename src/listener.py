@@ -0,0 +1,123 @@
+import socket
+import time
+
+import peer
+
+__all__ = ["Listener"]
+
+
+class Listener(object):
+    """Accepts incoming peer connections on the client port.
+    A connection is held until the peer's handshake is received,
+    then it's passed to on_handshake handlers with the info-hash
+    so that it can be given to the right torrent (or process).
+
+    Events:
+
+        on_handshake:
+            The beginning of a handshake is received.
+            Prototype: on_handshake(info_hash, conn, address, data).
+            Where conn - connected socket; address - (ip, port)
+            of the peer; data - all received bytes that have to be
+            handled as the beginning of the stream.
+            Handlers own the socket, the first one that returns True
+            stops the others. If nobody accepts the connection it's closed.
+            To add a handler use: listener.on_handshake(function).
+
+    Methods:
+
+        add(conn, address):
+            Wait for the handshake on a connection accepted elsewhere
+            (e.g. a uTP connection).
+
+        message():
+            You have to call this method in a loop.
+
+        close():
+            Stop listening and close pending connections.
+
+    """
+
+    BACKLOG = 64
+    HANDSHAKE_TIMEOUT = 10
+    MAX_PENDING = 64
+
+    def __init__(self, port, host="0.0.0.0"):
+        self.handlers = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(Listener.BACKLOG)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self._pending = []
+
+    def on_handshake(self, func):
+        """Add on_handshake handler."""
+        if func not in self.handlers:
+            self.handlers.append(func)
+
+    def add(self, conn, address):
+        """Wait for the handshake on a connection accepted elsewhere
+        (e.g. a uTP connection).
+
+        """
+        if len(self._pending) >= Listener.MAX_PENDING:
+            conn.close()
+            return
+        conn.setblocking(False)
+        self._pending.append([conn, address, "", time.time()])
+
+    def message(self):
+        """You have to call this method in a loop.
+        Return False if there is nothing to do.
+
+        """
+        result = False
+        while len(self._pending) < Listener.MAX_PENDING:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error:
+                break
+            conn.setblocking(False)
+            self._pending.append([conn, address, "", time.time()])
+            result = True
+        for item in self._pending[:]:
+            conn, address, data, accepted_at = item
+            try:
+                chunk = conn.recv(1024)
+                if not chunk:
+                    raise socket.error("Connection closed")
+            except socket.error as err:
+                if err.errno in peer.Peer.WOULD_BLOCK:
+                    if time.time() - accepted_at > Listener.HANDSHAKE_TIMEOUT:
+                        self._pending.remove(item)
+                        conn.close()
+                    continue
+                self._pending.remove(item)
+                conn.close()
+                continue
+            result = True
+            data += chunk
+            item[2] = data
+            pstr_len = ord(data[0])
+            if len(data) < pstr_len + 29:
+                continue
+            self._pending.remove(item)
+            if data[1:pstr_len+1] != peer.Peer.PROTOCOL:
+                conn.close()
+                continue
+            info_hash = data[9+pstr_len:29+pstr_len]
+            for func in self.handlers:
+                if func(info_hash, conn, address, data):
+                    break
+            else:
+                conn.close()
+        return result
+
+    def close(self):
+        """Stop listening and close pending connections."""
+        for item in self._pending:
+            item[0].close()
+        self._pending = []
+        self.sock.close()
@@ -1,38 +1,391 @@
 #!/usr/bin/python2
 
+import getopt
 import os
+import socket
 import sys
 
+import choker
+import daemon
+import file
+import metrics
+import node
+import peer
+import profiler
+import recorder
+import replay
+import supervisor
 import torrent
+import tracker
+
+
+OPTIONS = [
+    "download-limit=",
+    "download-path=",
+    "upload-limit=",
+    "max-active=",
+    "max-connections=",
+    "max-peers=",
+    "memory=",
+    "upload-slots=",
+    "choke-interval=",
+    "workers=",
+    "metrics=",
+    "profile=",
+    "sample=",
+    "sample-rate=",
+    "phases",
+    "record=",
+    "stream",
+    "utp",
+    "only=",
+    "skip=",
+    "low=",
+    "high=",
+    "daemon",
+    "watch=",
+    "socket="
+]
+NUMERIC_OPTIONS = [
+    "download-limit",
+    "upload-limit",
+    "max-active",
+    "max-connections",
+    "max-peers",
+    "memory",
+    "upload-slots",
+    "choke-interval",
+    "workers",
+    "sample-rate"
+]
+# Options passed to worker processes
+WORKERS_OPTIONS = ["utp", "metrics", "profile", "sample", "sample-rate", "phases"]
+# Options of one torrent
+WORKERS_UNSUPPORTED = ["record", "stream", "only", "skip", "low", "high", "daemon"]
+
+CONTROL_COMMANDS = ("add", "remove", "pause", "resume", "stats", "shutdown")
 
 
 def main(argv):
+    if argv and argv[0] in CONTROL_COMMANDS:
+        control(argv[0], argv[1:])
+        return
+    if argv and argv[0] == "scrape":
+        scrape(argv[1:])
+        return
+    if argv and argv[0] == "replay":
+        replay_recording(argv[1:])
+        return
+    if argv and argv[0] == "files":
+        list_files(argv[1:])
+        return
+    try:
+        opts, argv = getopt.gnu_getopt(argv, "", OPTIONS)
+        opts = dict((name[2:], value) for name, value in opts)
+        for name in NUMERIC_OPTIONS:
+            if name in opts:
+                opts[name] = int(opts[name])
+    except (getopt.GetoptError, ValueError):
+        opts, argv = {}, []
     argc = len(argv)
-    if argc == 0 or argc > 2:
-        print "Syntax: cbt <.torrent file> [<download path>]"
+    if (argc == 0 and "daemon" not in opts) or (argc > 2 and not ("workers" in opts or "daemon" in opts)):
+        print "Syntax: cbt [options] <.torrent file> [<download path>]"
+        print "        cbt [options] --workers=<N> <.torrent file> [<.torrent file> ...]"
+        print "        cbt [options] --daemon [--watch=<folder>] [<.torrent file> ...]"
+        print "        cbt add [--socket=<file>] <.torrent file> [<download path>]"
+        print "        cbt remove|pause|resume [--socket=<file>] <info-hash>"
+        print "        cbt stats|shutdown [--socket=<file>]"
+        print "        cbt scrape <.torrent file> [<.torrent file> ...]"
+        print "        cbt replay [--realtime] [--profile=<file>] [--phases] <recording>"
+        print "        cbt files <.torrent file>"
+        print "Options:"
+        print "    --download-limit=<KB/s>  --upload-limit=<KB/s>"
+        print "    --max-active=<torrents>  --max-connections=<peers>"
+        print "    --max-peers=<peers>      (per torrent, %d by default)" % peer.Peer.MAX_CONNECTIONS
+        print "    --memory=<MB>            (piece data in flight of all torrents)"
+        print "    --upload-slots=<peers>   --choke-interval=<seconds>"
+        print "    --workers=<processes>    --download-path=<path>"
+        print "    --metrics=<file>         (Prometheus text or *.json snapshot)"
+        print "    --profile=<file>         (cProfile stats, dumped on exit and SIGUSR1)"
+        print "    --sample=<file>          --sample-rate=<Hz>  (folded stacks)"
+        print "    --phases                 (time of recv/parse/schedule/send/disk)"
+        print "    --record=<file>          (peer traffic for cbt replay)"
+        print "    --stream                 (download from the beginning to the end)"
+        print "    --utp                    (connect over uTP first, TCP is the fallback)"
+        print "    --only=<files>           --skip=<files>"
+        print "    --low=<files>            --high=<files>"
+        print "                             (numbers of cbt files, e.g. 1,3-5)"
+        print "    --socket=<file>          (control socket of the daemon, %s by default)" % daemon.socket_path()
+        return
+    if "metrics" in opts:
+        metrics.enable()
+        torrent.metrics_path = opts["metrics"]
+    if "max-peers" in opts:
+        peer.Peer.MAX_CONNECTIONS = opts["max-peers"]
+    if "upload-slots" in opts:
+        choker.Choker.SLOTS = opts["upload-slots"]
+    if "choke-interval" in opts:
+        choker.Choker.INTERVAL = opts["choke-interval"]
+    limits = {
+        "max_active": opts.get("max-active", 0),
+        "max_connections": opts.get("max-connections", 0),
+        "download_rate": opts.get("download-limit", 0) * 1024,
+        "upload_rate": opts.get("upload-limit", 0) * 1024,
+        "memory": opts.get("memory", 0) * 1024 * 1024
+    }
+    if "workers" in opts:
+        unsupported = [name for name in WORKERS_UNSUPPORTED if name in opts]
+        if unsupported:
+            print "Options not supported with --workers: %s" % ", ".join(
+                "--" + name for name in unsupported
+            )
+            return
+        download_path = opts.get("download-path", os.getcwd())
+        # Flags have empty values
+        options = dict(
+            (name.replace("-", "_"), True if opts[name] == "" else opts[name])
+            for name in WORKERS_OPTIONS if name in opts
+        )
+        print "Starting..."
+        supervisor.Supervisor(argv, download_path, opts["workers"], limits, options).run()
+        print "Stopping..."
+        return
+    torrent.session.set_limits(**limits)
+    if "daemon" in opts:
+        run_daemon(opts, argv)
         return
     torrent_path = argv[0]
     if argc == 2:
         download_path = argv[1]
     else:
-        download_path = os.getcwd()
+        download_path = opts.get("download-path", os.getcwd())
 
     print "Starting..."
+    if "record" in opts:
+        recorder.start(opts["record"])
     try:
         t = torrent.Torrent(torrent_path, download_path)
     except IOError:
         print "Invalid .torrent file"
         return
+    try:
+        priorities = file_priorities(opts, len(t.writer.files))
+    except ValueError:
+        print "Invalid file numbers"
+        return
+    if priorities:
+        t.set_file_priorities(priorities)
+    if "utp" in opts:
+        node.Node.utp = torrent.Torrent.utp
     t.stop()
+    if "stream" in opts:
+        t.downloader.stream()
     try:
         t.start()
     except WindowsError:
         print "Permission denied"
         return
     print "Started"
+    if "phases" in opts:
+        profiler.enable()
+    if "profile" in opts:
+        profiler.start_profile(opts["profile"])
+    if "sample" in opts:
+        profiler.start_sampling(opts["sample"], opts.get("sample-rate"))
     torrent.main_loop()
+    profiler.stop()
     print "Stopping..."
     t.stop()
+    recorder.stop()
+
+
+def run_daemon(opts, paths):
+    """Run the session with the torrents until shutdown."""
+    d = daemon.Daemon(
+        opts.get("download-path", os.getcwd()),
+        path=opts.get("socket"),
+        watch_path=opts.get("watch")
+    )
+    try:
+        d.start()
+    except (socket.error, OSError) as err:
+        print "Unable to listen the control socket: %s" % err
+        return
+    for path in paths:
+        try:
+            d.add(path)
+        except daemon.RPCError as err:
+            print err
+    print "Started"
+    d.run()
+    print "Stopping..."
+
+
+def control(command, argv):
+    """Send the command to the daemon and print the result."""
+    try:
+        opts, argv = getopt.gnu_getopt(argv, "", ["socket="])
+        opts = dict((name[2:], value) for name, value in opts)
+    except getopt.GetoptError:
+        argv = None
+    params = {}
+    if command == "add" and argv and len(argv) <= 2:
+        params["path"] = os.path.abspath(argv[0])
+        if len(argv) == 2:
+            params["download_path"] = os.path.abspath(argv[1])
+    elif command in ("remove", "pause", "resume") and argv and len(argv) == 1:
+        params["hash"] = argv[0].lower()
+    elif command not in ("stats", "shutdown") or argv is None or argv:
+        print "Syntax: cbt add [--socket=<file>] <.torrent file> [<download path>]"
+        print "        cbt remove|pause|resume [--socket=<file>] <info-hash>"
+        print "        cbt stats|shutdown [--socket=<file>]"
+        return
+    try:
+        result = daemon.call(command, params, opts.get("socket"))
+    except socket.error as err:
+        print "The daemon is not running: %s" % err
+        return
+    except daemon.RPCError as err:
+        print err
+        return
+    if command == "add":
+        print result
+    elif command == "stats":
+        for item in result:
+            print "%s %s%s" % (item["hash"], item["status"], " [Paused]" if item["paused"] else "")
+
+
+def parse_files(spec, count):
+    """Return 0-based indexes of files from a list of 1-based
+    numbers and ranges like "1,3-5". Raise ValueError if it's invalid.
+
+    """
+    indexes = []
+    for item in spec.split(","):
+        first, _, last = item.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not 1 <= first <= last <= count:
+            raise ValueError("Invalid file numbers: %s" % item)
+        indexes.extend(xrange(first - 1, last))
+    return indexes
+
+
+def file_priorities(opts, count):
+    """Return the list of file priorities from --only, --skip,
+    --low and --high options or None if there are no such options.
+
+    """
+    names = ("only", "skip", "low", "high")
+    if not any(name in opts for name in names):
+        return None
+    priorities = [file.File.PRIORITY_NORMAL] * count
+    if "only" in opts:
+        priorities = [file.File.PRIORITY_SKIP] * count
+        for index in parse_files(opts["only"], count):
+            priorities[index] = file.File.PRIORITY_NORMAL
+    for name, priority in (
+        ("low", file.File.PRIORITY_LOW),
+        ("high", file.File.PRIORITY_HIGH),
+        ("skip", file.File.PRIORITY_SKIP)
+    ):
+        if name in opts:
+            for index in parse_files(opts[name], count):
+                priorities[index] = priority
+    return priorities
+
+
+def list_files(paths):
+    """Print numbers, sizes and paths of files of the torrent
+    for --only, --skip, --low and --high options.
+
+    """
+    if len(paths) != 1:
+        print "Syntax: cbt files <.torrent file>"
+        return
+    try:
+        meta, hash = torrent.read_meta(paths[0])
+    except IOError:
+        print "Invalid .torrent file"
+        return
+    info = meta["info"]
+    if "files" in info:
+        files = [(os.sep.join(f["path"]), f["length"]) for f in info["files"]]
+    else:
+        files = [(info["name"], info["length"])]
+    for number, (path, size) in enumerate(files, 1):
+        print "[%d] [%d KB] %s" % (number, size / 1024, path)
+
+
+def replay_recording(argv):
+    """Feed a recording of peer traffic into a torrent without
+    sockets and print how long it took.
+
+    """
+    try:
+        opts, argv = getopt.gnu_getopt(argv, "", ["realtime", "profile=", "phases"])
+        opts = dict((name[2:], value) for name, value in opts)
+    except getopt.GetoptError:
+        argv = []
+    if len(argv) != 1:
+        print "Syntax: cbt replay [--realtime] [--profile=<file>] [--phases] <recording>"
+        return
+    if "phases" in opts:
+        profiler.enable()
+    if "profile" in opts:
+        profiler.start_profile(opts["profile"])
+    try:
+        stats = replay.replay(argv[0], "realtime" in opts)
+    except IOError as err:
+        print err
+        return
+    finally:
+        profiler.stop()
+    print "[Records: %d] [Received: %d B] [Sent: %d B] [Verified: %d B] [Time: %.3f s]" % (
+        stats["records"],
+        stats["received"],
+        stats["sent"],
+        stats.get("verified", 0),
+        stats["seconds"]
+    )
+    if profiler.enabled:
+        print profiler.to_string()
+
+
+def scrape(paths):
+    """Print seeders, leechers and completed downloads of torrents.
+    Torrents announced to the same tracker are scraped together.
+
+    """
+    if not paths:
+        print "Syntax: cbt scrape <.torrent file> [<.torrent file> ...]"
+        return
+    names = {}
+    groups = {}
+    for path in paths:
+        try:
+            meta, hash = torrent.read_meta(path)
+        except IOError:
+            print "Invalid .torrent file: %s" % path
+            continue
+        names[hash] = path.split(os.sep)[-1]
+        urls = torrent.tracker_urls(meta)
+        groups.setdefault(urls[0] if urls else None, []).append(hash)
+    for url, hashes in groups.iteritems():
+        result = {}
+        if url:
+            result = tracker.scrape(url, hashes)
+        for hash in hashes:
+            if hash in result:
+                info = result[hash]
+                print "[%s] [Seeders: %s] [Leechers: %s] [Completed: %s]" % (
+                    names[hash],
+                    info.get("complete", "?"),
+                    info.get("incomplete", "?"),
+                    info.get("downloaded", "?")
+                )
+            else:
+                print "[%s] [No scrape data]" % names[hash]
 
 
 if __name__ == "__main__":
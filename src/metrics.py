@@ -0,0 +1,257 @@
+"""
+Metrics of the client: counters, gauges and histograms with labels.
+
+Metrics are disabled by default and the hot code only checks
+metrics.enabled, so they cost nothing until enable() is called:
+
+    if metrics.enabled:
+        metrics.counter("cbt_hash_failures_total", "Pieces failed SHA1", torrent=name).inc()
+
+Functions:
+
+    enable():
+        Start collecting metrics.
+
+    counter(name, help, **labels), gauge(...), histogram(...):
+        Return the metric with the labels, create it if needed.
+
+    remove(**labels):
+        Remove metrics with the labels (e.g. of a disconnected peer).
+
+    on_collect(func):
+        Call func() before each export to update gauges.
+
+    off_collect(func):
+        Don't call func() any more.
+
+    export(path):
+        Write all metrics to a JSON snapshot (*.json) or to
+        a Prometheus text file (any other name).
+
+"""
+
+import json
+import os
+import threading
+import time
+
+__all__ = [
+    "enable",
+    "counter",
+    "gauge",
+    "histogram",
+    "remove",
+    "on_collect",
+    "off_collect",
+    "snapshot",
+    "prometheus",
+    "export"
+]
+
+enabled = False
+
+_collectors = []
+_families = {}
+_lock = threading.Lock()
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dump(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value that goes up and down."""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def dump(self):
+        return self.value
+
+
+class Histogram(object):
+    """Distribution of observed values in fixed buckets
+    (upper bounds, in seconds for latencies).
+
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.buckets = [0] * len(Histogram.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for x, bound in enumerate(Histogram.BUCKETS):
+            if value <= bound:
+                self.buckets[x] += 1
+                break
+
+    def dump(self):
+        return {
+            "buckets": dict(zip(Histogram.BUCKETS, self.buckets)),
+            "count": self.count,
+            "sum": self.sum
+        }
+
+
+def enable():
+    """Start collecting metrics."""
+    global enabled
+    enabled = True
+
+
+def counter(name, help, **labels):
+    return _metric(name, "counter", help, labels, Counter)
+
+
+def gauge(name, help, **labels):
+    return _metric(name, "gauge", help, labels, Gauge)
+
+
+def histogram(name, help, **labels):
+    return _metric(name, "histogram", help, labels, Histogram)
+
+
+def remove(**labels):
+    """Remove metrics with the labels (e.g. of a disconnected peer)."""
+    items = set(labels.items())
+    with _lock:
+        for family in _families.itervalues():
+            for key in family["children"].keys():
+                if items.issubset(key):
+                    del family["children"][key]
+
+
+def on_collect(func):
+    """Call func() before each export to update gauges."""
+    if func not in _collectors:
+        _collectors.append(func)
+
+
+def off_collect(func):
+    """Don't call func() any more."""
+    if func in _collectors:
+        _collectors.remove(func)
+
+
+def snapshot():
+    """Return all metrics as a dict:
+    {name: {"type": ..., "help": ..., "values": [{"labels": {...}, "value": ...}]}}
+
+    """
+    for func in _collectors:
+        func()
+    result = {}
+    with _lock:
+        for name, family in _families.iteritems():
+            values = []
+            for key, metric in family["children"].iteritems():
+                values.append({"labels": dict(key), "value": metric.dump()})
+            result[name] = {
+                "type": family["type"],
+                "help": family["help"],
+                "values": values
+            }
+    return result
+
+
+def prometheus():
+    """Return all metrics in Prometheus text exposition format."""
+    lines = []
+    data = snapshot()
+    for name in sorted(data):
+        family = data[name]
+        lines.append("# HELP %s %s" % (name, family["help"]))
+        lines.append("# TYPE %s %s" % (name, family["type"]))
+        for item in family["values"]:
+            labels = item["labels"]
+            value = item["value"]
+            if family["type"] != "histogram":
+                lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound in Histogram.BUCKETS:
+                cumulative += value["buckets"][bound]
+                bucket_labels = dict(labels, le=_number(bound))
+                lines.append("%s_bucket%s %d" % (name, _labels(bucket_labels), cumulative))
+            bucket_labels = dict(labels, le="+Inf")
+            lines.append("%s_bucket%s %d" % (name, _labels(bucket_labels), value["count"]))
+            lines.append("%s_sum%s %s" % (name, _labels(labels), _number(value["sum"])))
+            lines.append("%s_count%s %d" % (name, _labels(labels), value["count"]))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def export(path):
+    """Write all metrics to a JSON snapshot (*.json) or to
+    a Prometheus text file (any other name). The file is replaced
+    atomically so readers never see a half-written file.
+
+    """
+    if path.endswith(".json"):
+        data = snapshot()
+        data["timestamp"] = time.time()
+        content = json.dumps(data, indent=1, sort_keys=True)
+    else:
+        content = prometheus()
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def _metric(name, type, help, labels, cls):
+    key = tuple(sorted(labels.items()))
+    family = _families.get(name)
+    if family is None:
+        with _lock:
+            family = _families.setdefault(name, {
+                "type": type,
+                "help": help,
+                "children": {}
+            })
+    metric = family["children"].get(key)
+    if metric is None:
+        with _lock:
+            metric = family["children"].setdefault(key, cls())
+    return metric
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    items = []
+    for key in sorted(labels):
+        value = str(labels[key]).replace("\\", "\\\\").replace("\"", "\\\"")
+        items.append("%s=\"%s\"" % (key, value))
+    return "{%s}" % ",".join(items)
+
+
+def _number(value):
+    if type(value) is float:
+        return repr(value)
+    return str(value)
@@ -1,6 +1,10 @@
 import socket
 import time
 
+import bitfield
+import recorder
+import timer
+
 
 class Buf(object):
     def __init__(self):
@@ -25,11 +29,15 @@ class Node(object):
 
     Attributes:
 
+        allowed_fast:
+            A set of pieces the peer allows to download while
+            it chokes the client (Fast Extension).
+
         bitfield:
-            Indicates if each piece is available for download.
+            bitfield.Bitfield of pieces available for download.
 
         conn:
-            Connection.
+            Connection: a TCP socket or utp.Connection.
 
         c_choke:
             Client ignores the peer.
@@ -37,23 +45,65 @@ class Node(object):
         c_interested:
             Client is going to download anything from the peer.
 
+        connected_at:
+            When the peer was added.
+
+        downloaded, uploaded:
+            Piece data received from and sent to the peer in bytes.
+
+        download_rate, upload_rate:
+            Transfer rates in bytes per second measured by the choker.
+
+        errors:
+            Number of protocol errors of the peer.
+
+        extensions:
+            Extension messages (BEP 10) supported by the peer:
+            {name: message ID}. Empty if the peer doesn't support them.
+
+        fast:
+            The peer supports the Fast Extension (BEP 6).
+
         handshaked:
             Is the peer ready to messaging.
 
+        hashfails:
+            Number of pieces that failed SHA1 check with chunks
+            from the peer.
+
+        have_all:
+            The peer has all pieces (HAVE ALL message),
+            bitfield is not used then.
+
         id:
             20-byte identifier in the BitTorrent network.
 
+        incoming:
+            The peer has connected to the client.
+
         inbox:
             Buffer that stores unhandled incoming messages.
 
         ip:
             IP address.
 
+        last_piece:
+            When the last piece data was received from the peer.
+
         last_recv:
-            When the last chunk was received from the peer.
+            When the last chunk was received from the peer
+            (by timer.clock).
+
+        last_request:
+            When the last request was sent to the peer.
 
         last_send:
-            When the last message was sent to the peer.
+            When the last message was sent to the peer
+            (by timer.clock).
+
+        listen_port:
+            TCP port the peer listens on (from extension handshake)
+            or None if unknown.
 
         outbox:
             Buffer that stores unsent outgoing messages.
@@ -67,6 +117,22 @@ class Node(object):
         p_interested:
             The peer is going to download anything from client.
 
+        rtt:
+            Smoothed time from a request to its piece message in seconds
+            (0 - unknown).
+
+        rtt_var:
+            Smoothed mean deviation of the request latency from rtt.
+
+        score:
+            Quality of the peer given by scorer.Scorer.
+
+        snubbed:
+            The peer doesn't send data it was asked for.
+
+        timeouts:
+            Number of requests to the peer that timed out in a row.
+
     Methods:
 
         close():
@@ -74,6 +140,10 @@ class Node(object):
 
         connect():
             Try to connect to the peer in CONNECTION_TIMEOUT seconds.
+            uTP is tried first if Node.utp is set, TCP is the fallback.
+
+        update_rtt(sample):
+            Add a measured request latency to rtt and rtt_var.
 
         send(data):
             Put the data in the outbox buffer queue. The data will be
@@ -93,26 +163,49 @@ class Node(object):
 
     MESSAGE_WAITING_UNCHOKING = -1
 
+    # utp.Transport for outgoing connections or None (TCP only)
+    utp = None
+
     FALSE = 0
     WAITING = 1
     TRUE = 2
 
     def __init__(self, ip, port):
         self.active = 0
-        self.bitfield = []
+        self.allowed_fast = set()
+        self.bitfield = bitfield.Bitfield()
         self.conn = None
         self.c_choke = True
         self.c_interested = False
+        self.connected_at = time.time()
+        self.download_rate = 0.0
+        self.downloaded = 0
+        self.errors = 0
+        self.extensions = {}
+        self.fast = False
         self.handshaked = False
+        self.hashfails = 0
+        self.have_all = False
         self.id = ""
+        self.incoming = False
         self.inbox = Buf()
         self.ip = ip
-        self.last_recv = time.time()
-        self.last_send = time.time()
+        self.last_piece = 0
+        self.last_recv = timer.wheel.now
+        self.last_request = 0
+        self.last_send = timer.wheel.now
+        self.listen_port = None
         self.outbox = []
         self.port = port
         self.p_choke = Node.TRUE
         self.p_interested = False
+        self.rtt = 0.0
+        self.rtt_var = 0.0
+        self.score = 0.0
+        self.snubbed = False
+        self.timeouts = 0
+        self.upload_rate = 0.0
+        self.uploaded = 0
 
     def close(self):
         """Close the connection to the peer and clear buffers."""
@@ -122,7 +215,18 @@ class Node(object):
         self.conn = None
 
     def connect(self):
-        """Try to connect to the peer in CONNECTION_TIMEOUT seconds."""
+        """Try to connect to the peer in CONNECTION_TIMEOUT seconds.
+        uTP is tried first if Node.utp is set, TCP is the fallback.
+        uTP packets are handled by the main loop, so this must be
+        called from another thread then.
+
+        """
+        if Node.utp:
+            conn = Node.utp.connect((self.ip, self.port))
+            if conn.wait(Node.CONNECTION_TIMEOUT):
+                self.conn = conn
+                return
+            conn.close()
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.settimeout(Node.CONNECTION_TIMEOUT)
         self.conn.connect((self.ip, self.port))
@@ -130,26 +234,33 @@ class Node(object):
 
     def get_piece(self, index):
         """Return True if the peer has the piece."""
-        if 0 <= index < len(self.bitfield):
-            return self.bitfield[index]
-        else:
-            return False
+        if self.have_all:
+            return index >= 0
+        return self.bitfield.get(index)
 
     def set_piece(self, index, have=True):
         """Remember that the peer has the piece."""
-        if index < 0:
-            return
-        b_len = len(self.bitfield)
-        if index >= b_len:
-            for _ in xrange(index - b_len + 1):
-                self.bitfield.append(False)
-        self.bitfield[index] = have
+        self.bitfield.set(index, have)
+
+    def update_rtt(self, sample):
+        """Add a measured request latency to rtt and rtt_var
+        the way TCP does (RFC 6298).
+
+        """
+        if self.rtt:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        else:
+            self.rtt = sample
+            self.rtt_var = sample / 2
 
     def send(self, data):
         """Put the data in the outbox buffer queue. The data will be
         divided into pieces of MAX_PART_SIZE bytes or less.
 
         """
+        if recorder.enabled:
+            recorder.send(self, data)
         chunks = []
         for x in xrange(0, len(data), Node.MAX_PART_SIZE):
             chunks.append(data[x:x+Node.MAX_PART_SIZE])
@@ -169,7 +280,7 @@ class Node(object):
             node.send("bar")
 
         """
-        self.outbox.append(int(time.time() + timeout))
+        self.outbox.append(timer.wheel.call_later(timeout))
 
     def wait_for_unchoke(self):
         """Suspend sending of next messages until the peer
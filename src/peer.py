@@ -1,9 +1,16 @@
+import errno
 import socket
 import threading
 import time
 
 import convert
+import metrics
 import node
+import profiler
+import recorder
+import registry
+import scheduler
+import timer
 
 __all__ = ["Peer"]
 
@@ -13,11 +20,37 @@ class Peer(object):
     in current BitTorrent network. It provides API for sending and
     receiving messages only and doesn't implement handling of messages.
 
+    Timers of every connected peer are on timer.wheel: a keep-alive
+    message is sent if nothing was sent for KEEP_ALIVE_TIMEOUT seconds
+    and the peer is disconnected if nothing was received from it for
+    IDLE_TIMEOUT seconds.
+
+    All known peers are kept in the registry. Whenever there is room
+    for connections, its candidates are connected in background.
+    Disconnected peers become candidates again after a back-off.
+
     Attributes:
 
+        banned:
+            A set of IP addresses of banned peers (registry.banned).
+
+        download, upload:
+            scheduler.Throttle objects that limit traffic of all peers.
+
+        label:
+            Name of the torrent in metrics.
+
+        max_connections:
+            How many peers may be connected at once
+            (None - MAX_CONNECTIONS, 0 - nobody).
+
         nodes:
             A list of all connected, active peers (nodes). Each peer is node.Node object.
 
+        registry:
+            registry.Registry of all known peers. message() connects
+            its candidates in background.
+
         handles:
             A dict that contains user event handlers.
 
@@ -44,22 +77,46 @@ class Peer(object):
     Methods:
 
         append_node(ip, port):
-            Add a peer to peers list before connection.
+            Add a peer to be connected by connect_all().
+
+        append_potential_node(ip, port):
+            Add a peer to be connected in background.
+
+        append_incoming_node(conn, address, data):
+            Add a peer that has connected to us.
 
-        connect_all():
-            Connect to all peers in the list.
+        ban(node):
+            Disconnect the peer and never connect it again.
+
+        connect_all(background=False):
+            Connect to known peers up to the connection limit.
+
+        disconnect_all():
+            Disconnect all peers, they may be connected again at once.
 
         message():
             You have to call this method in a loop.
 
     """
 
+    IDLE_TIMEOUT = 300
     KEEP_ALIVE_TIMEOUT = 100
+    MAX_CONNECTING = 16
+    MAX_CONNECTIONS = 50
     PROTOCOL = "BitTorrent protocol"
+    WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
 
     def __init__(self):
+        self.registry = registry.Registry()
+        self.banned = self.registry.banned
+        self.download = scheduler.Throttle()
+        self.label = ""
+        self.max_connections = None
         self.nodes = []
-        self.potential_nodes = []
+        self.upload = scheduler.Throttle()
+        self._connected = []
+        self._connecting = 0
+        self._turn = 0
         self.handlers = {
             "on_connect": [],
             "on_recv": [],
@@ -82,25 +139,56 @@ class Peer(object):
             self.handlers["on_recv_handshake"].append(func)
 
     def append_node(self, ip, port):
-        """Add a peer to peers list before connection."""
-        for n in self.nodes:
-            if (n.ip, n.port) == (ip, port):
-                return
-        new_node = node.Node(ip, port)
-        self.nodes.append(new_node)
-        for n in self.potential_nodes:
-            if (n.ip, n.port) == (ip, port):
-                return
-        self.potential_nodes.append(new_node)
+        """Add a peer to be connected by connect_all()."""
+        self.registry.add(ip, port)
+
+    def append_potential_node(self, ip, port):
+        """Add a peer to be connected in background.
+        on_connect handlers are called when it's connected.
+
+        """
+        self.registry.add(ip, port)
+
+    def append_incoming_node(self, conn, address, data):
+        """Add a peer that has connected to us. data is the part of
+        the stream already received from it (at least the beginning
+        of the handshake). on_connect handlers are called at once.
+        Return False if the connection limit is reached or the peer
+        is banned.
+
+        """
+        if len(self.nodes) >= self._max_connections() or address[0] in self.banned:
+            return False
+        n = node.Node(address[0], address[1])
+        n.conn = conn
+        n.conn.setblocking(False)
+        n.incoming = True
+        n.inbox.append(data)
+        self.nodes.append(n)
+        self._watch(n)
+        for func in self.handlers["on_connect"]:
+            func(n)
+        return True
+
+    def ban(self, n):
+        """Disconnect the peer and never connect it again."""
+        self.registry.ban(n.ip)
+        if n.conn:
+            n.close()
 
     def connect_all(self, background=False):
-        """Connect to all peers in the list.
+        """Connect to known peers up to the connection limit,
+        others are connected later by message().
         Due to the fact that socket.connect() method is blocking
         connections are established in separate threads.
-        Set background flag if you don't need to wait for
-        all these threads.
+        Set background flag if you don't need to wait for them:
+        then all peers are connected by message() which calls
+        on_connect handlers, so the main loop never blocks.
 
         """
+        if background:
+            return
+
         def connect(n):
             if n.conn:
                 return
@@ -108,48 +196,209 @@ class Peer(object):
                 n.connect()
             except (socket.timeout, socket.error):
                 n.close()
+        while len(self.nodes) < self._max_connections():
+            address = self.registry.pop()
+            if address is None:
+                break
+            self.nodes.append(node.Node(*address))
         threads = []
         for n in self.nodes:
             thread = threading.Thread(target=connect, args=(n,))
             threads.append(thread)
             thread.start()
-        if not background:
-            for thread in threads:
-                thread.join()
+        for thread in threads:
+            while thread.is_alive():
+                # uTP handshakes are handled here meanwhile
+                if node.Node.utp:
+                    node.Node.utp.sock.message()
+                    node.Node.utp.message()
+                thread.join(0.001)
+        for n in self.nodes:
+            self._watch(n)
+
+    def disconnect_all(self):
+        """Disconnect all peers, e.g. the torrent is paused. Peers
+        we have connected to are candidates of the registry again.
+
+        """
+        for n in self.nodes:
+            if n.conn:
+                n.close()
+            if metrics.enabled:
+                metrics.remove(peer=self._peer_label(n))
+            if recorder.enabled:
+                recorder.close(n)
+            if n.incoming:
+                self._closed(n)
+            else:
+                self.registry.release((n.ip, n.port))
+        # The list is shared with the downloader
+        del self.nodes[:]
 
     def message(self):
         """You have to call this method in a loop.
         Return False if there is nothing to do.
 
         """
+        self._connect_potential()
         r = range(len(self.nodes))
         r.reverse()
         for i in r:
             if not self.nodes[i].conn:
+                if metrics.enabled:
+                    metrics.remove(peer=self._peer_label(self.nodes[i]))
+                if recorder.enabled:
+                    recorder.close(self.nodes[i])
+                self._closed(self.nodes[i])
                 del self.nodes[i]
         is_buffers_empty = True
-        for n in self.nodes:
-            self._message_recv(n)
-            self._message_send(n)
+        # Start from another peer every time to share bandwidth fairly
+        if self.nodes:
+            self._turn = (self._turn + 1) % len(self.nodes)
+        for n in self.nodes[self._turn:] + self.nodes[:self._turn]:
+            if n.conn:
+                if profiler.enabled:
+                    profiler.begin("recv")
+                self._message_recv(n)
+                if profiler.enabled:
+                    profiler.end()
+            if n.conn:
+                if profiler.enabled:
+                    profiler.begin("parse")
+                self._message_parse(n)
+                if profiler.enabled:
+                    profiler.end()
+            if n.conn:
+                if profiler.enabled:
+                    profiler.begin("send")
+                self._message_send(n)
+                if profiler.enabled:
+                    profiler.end()
             if n.inbox.length or len(n.outbox):
                 is_buffers_empty = False
         return not is_buffers_empty
 
-    def _message_recv(self, n):
-        """Try to receive a single message from the peer
-        and handle it. If the message is not accepted wholly
-        this method will wait.
+    def _connect_potential(self):
+        """Move peers connected in background to nodes and start
+        to connect next candidates of the registry. Connection threads never
+        touch nodes list, so it's changed in the main loop only.
 
         """
-        chunk = ""
-        try:
-            chunk = n.conn.recv(node.Node.MAX_PART_SIZE)
-        except socket.error as err:
-            if err.errno != 10035:
+        while self._connected:
+            n = self._connected.pop(0)
+            self._connecting -= 1
+            if not n.conn:
+                self._closed(n)
+                continue
+            n.connected_at = time.time()
+            self.nodes.append(n)
+            self._watch(n)
+            for func in self.handlers["on_connect"]:
+                func(n)
+
+        def connect(n):
+            try:
+                n.connect()
+            except (socket.timeout, socket.error):
                 n.close()
+            self._connected.append(n)
+
+        while (
+            self.registry.candidates()
+            and self._connecting < Peer.MAX_CONNECTING
+            and len(self.nodes) + self._connecting < self._max_connections()
+        ):
+            address = self.registry.pop()
+            if address is None:
+                break
+            n = node.Node(*address)
+            self._connecting += 1
+            thread = threading.Thread(target=connect, args=(n,))
+            thread.daemon = True
+            thread.start()
+
+    def _watch(self, n):
+        """Start timers of the connected peer."""
+        delay = min(Peer.KEEP_ALIVE_TIMEOUT, Peer.IDLE_TIMEOUT)
+        timer.wheel.call_later(delay, self._check_idle, n)
+
+    def _check_idle(self, n):
+        """Send a keep-alive message to the peer or disconnect it
+        if it's idle. Check it again when it may become idle.
+
+        """
+        if not n.conn:
+            return
+        now = timer.wheel.now
+        if now - n.last_recv >= Peer.IDLE_TIMEOUT:
+            n.close()
+            return
+        if now - n.last_send >= Peer.KEEP_ALIVE_TIMEOUT and not n.outbox:
+            n.send(convert.uint_chr(0))
+        delay = min(
+            n.last_send + Peer.KEEP_ALIVE_TIMEOUT,
+            n.last_recv + Peer.IDLE_TIMEOUT
+        ) - now
+        # Again in a second if the keep-alive message is still queued
+        timer.wheel.call_later(max(delay, 1), self._check_idle, n)
+
+    def _closed(self, n):
+        """Tell the registry the peer is disconnected. Peers that
+        misbehaved are dropped. The address of an incoming peer is
+        known from its extension handshake only.
+
+        """
+        if n.incoming:
+            if not n.listen_port or (n.ip, n.listen_port) in self.registry:
+                return
+            address = (n.ip, n.listen_port)
+        else:
+            address = (n.ip, n.port)
+        if n.errors or n.hashfails:
+            self.registry.drop(address)
+        else:
+            self.registry.closed(address, good=bool(n.downloaded or n.uploaded))
+
+    def _max_connections(self):
+        if self.max_connections is None:
+            return Peer.MAX_CONNECTIONS
+        return self.max_connections
+
+    def _peer_label(self, n):
+        return "%s:%d" % (n.ip, n.port)
+
+    def _message_recv(self, n):
+        """Try to receive a part of a message from the peer."""
+        chunk = ""
+        size = self.download.allowance(node.Node.MAX_PART_SIZE)
+        if size:
+            try:
+                chunk = n.conn.recv(size)
+                if not chunk:
+                    # Peer closed the connection
+                    n.close()
+                    return
+            except socket.error as err:
+                if err.errno not in Peer.WOULD_BLOCK:
+                    n.close()
+                    return
         if chunk:
+            self.download.consume(len(chunk))
             n.inbox.append(chunk)
-            n.last_recv = time.time()
+            n.last_recv = timer.wheel.now
+            if metrics.enabled:
+                metrics.counter(
+                    "cbt_peer_bytes_in_total",
+                    "Bytes received from the peer",
+                    torrent=self.label,
+                    peer=self._peer_label(n)
+                ).inc(len(chunk))
+
+    def _message_parse(self, n):
+        """Handle a single message from the received data.
+        If the message is not accepted wholly this method will wait.
+
+        """
         # Check if I need to process a buffer
         if n.inbox.length and n.inbox.length != n.inbox.bad_length:
 
@@ -166,6 +415,8 @@ class Peer(object):
                     return
                 # Call handshake handlers
                 handshake = buf[0:pstr_len+49]
+                if recorder.enabled:
+                    recorder.recv(n, handshake)
                 for func in self.handlers["on_recv_handshake"]:
                     func(n, handshake)
                 # Clear a buffer and append remaining data if they are
@@ -186,6 +437,8 @@ class Peer(object):
                 return
             # Call other messages handlers
             m_buf = buf[0:4+m_len]
+            if recorder.enabled:
+                recorder.recv(n, m_buf)
             for func in self.handlers["on_recv"]:
                 func(n, m_buf)
             # Clear a buffer and append remaining data if they are
@@ -195,39 +448,45 @@ class Peer(object):
 
     def _message_send(self, n):
         """Try to send the first message in the queue.
-        If the last message was sent a long enough
-        send a keep-alive message.
         Supports "delayed sending" - sending the next
-        message after a certain time. Just send a number
-        to peer to wait n seconds.
+        message after a certain time. Node.sleep() puts
+        a timer.Timer to the queue that holds next messages
+        while it's active.
 
         """
         try:
-            outbox_len = len(n.outbox)
-            elapsed = time.time() - n.last_send
-            if not outbox_len and elapsed > Peer.KEEP_ALIVE_TIMEOUT:
-                # Keep-alive message
-                n.conn.send(convert.uint_chr(0))
-                n.last_send = time.time()
             # Send all messages in the buffer
-            for _ in xrange(outbox_len):
+            while n.outbox:
                 chunk = n.outbox[0]
                 if chunk == node.Node.MESSAGE_WAITING_UNCHOKING:
                     # Wait for unchoke
                     if n.p_choke != node.Node.FALSE:
                         del n.outbox[0]
                     return
-                if type(chunk) is int:
+                if type(chunk) is timer.Timer:
                     # "Sleep" message
-                    timestamp = chunk
-                    if time.time() > timestamp:
+                    if not chunk.active:
                         del n.outbox[0]
                     return
-                # Send the first message in the queue and remove it from the queue
-                n.conn.send(chunk)
-                n.last_send = time.time()
+                # Send as much of the first chunk as the upload limit allows
+                size = self.upload.allowance(len(chunk))
+                if not size:
+                    return
+                sent = n.conn.send(chunk[:size])
+                self.upload.consume(sent)
+                n.last_send = timer.wheel.now
+                if metrics.enabled:
+                    metrics.counter(
+                        "cbt_peer_bytes_out_total",
+                        "Bytes sent to the peer",
+                        torrent=self.label,
+                        peer=self._peer_label(n)
+                    ).inc(sent)
+                if sent < len(chunk):
+                    n.outbox[0] = chunk[sent:]
+                    return
                 del n.outbox[0]
-            n.outbox = []
-        except socket.error:
-            # Peer closed the connection
-            n.close()
+        except socket.error as err:
+            if err.errno not in Peer.WOULD_BLOCK:
+                # Peer closed the connection
+                n.close()
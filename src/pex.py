@@ -0,0 +1,111 @@
+import time
+
+import bcode
+import dht
+
+__all__ = ["PEX"]
+
+
+class PEX(object):
+    """Peer Exchange (BEP 11, "ut_pex" extension message).
+    It tells every connected peer which peers we have connected
+    and disconnected since the last message and parses such lists
+    received from peers. Messages to one peer are sent no more
+    often than SEND_INTERVAL and received lists are ignored if a
+    peer sends them more often than RECV_INTERVAL.
+
+    Methods:
+
+        parse(node, payload):
+            Return a list of new (ip, port) from a ut_pex message.
+
+        updates(nodes):
+            Return a list of (node, payload) to send now.
+
+    """
+
+    CHECK_INTERVAL = 5
+    MAX_PEERS = 50
+    NAME = "ut_pex"
+    RECV_INTERVAL = 45
+    SEND_INTERVAL = 60
+
+    def __init__(self):
+        self._checked_at = 0
+        self._recv_at = {}
+        self._sent = {}
+        self._sent_at = {}
+
+    def parse(self, n, payload):
+        """Return a list of new (ip, port) from a ut_pex message.
+        Only the first MAX_PEERS peers of "added" are taken.
+
+        """
+        now = time.time()
+        if now - self._recv_at.get(n, 0) < PEX.RECV_INTERVAL:
+            return []
+        self._recv_at[n] = now
+        try:
+            msg = bcode.decode(payload)
+        except (IOError, ValueError):
+            return []
+        if not isinstance(msg, dict) or type(msg.get("added")) is not str:
+            return []
+        return dht.decode_peers(msg["added"][:PEX.MAX_PEERS * 6])
+
+    def updates(self, nodes):
+        """Return a list of (node, payload) to send now. Each peer
+        receives the peers connected since the previous message in
+        "added" and the peers it knows from us which are no longer
+        connected in "dropped", MAX_PEERS of each at most. All
+        connected peers are advertised, except incoming ones that
+        haven't told their listen port.
+
+        """
+        now = time.time()
+        if now - self._checked_at < PEX.CHECK_INTERVAL:
+            return []
+        self._checked_at = now
+
+        supported = [n for n in nodes if n.conn and PEX.NAME in n.extensions]
+        connected = set()
+        for n in nodes:
+            address = self._address(n)
+            if n.conn and address:
+                connected.add(address)
+        for n in self._sent.keys():
+            if n not in supported:
+                del self._sent[n]
+                self._sent_at.pop(n, None)
+                self._recv_at.pop(n, None)
+
+        result = []
+        for n in supported:
+            if now - self._sent_at.get(n, 0) < PEX.SEND_INTERVAL:
+                continue
+            sent = self._sent.setdefault(n, set())
+            added = list(connected - sent - set([self._address(n)]))[:PEX.MAX_PEERS]
+            dropped = list(sent - connected)[:PEX.MAX_PEERS]
+            if not added and not dropped and n in self._sent_at:
+                continue
+            sent.update(added)
+            sent.difference_update(dropped)
+            self._sent_at[n] = now
+            payload = bcode.encode({
+                "added": "".join(dht.encode_peer(ip, port) for ip, port in added),
+                "added.f": "\0" * len(added),
+                "dropped": "".join(dht.encode_peer(ip, port) for ip, port in dropped)
+            })
+            result.append((n, payload))
+        return result
+
+    def _address(self, n):
+        """Return the address other peers can connect the peer to or
+        None. The source port of an incoming peer is ephemeral.
+
+        """
+        if not n.incoming:
+            return n.ip, n.port
+        if n.listen_port:
+            return n.ip, n.listen_port
+        return None
@@ -1,6 +1,7 @@
 import math
+import time
 
-__all__ = ["Piece"]
+__all__ = ["Piece", "PieceList"]
 
 
 class Piece(object):
@@ -10,22 +11,28 @@ class Piece(object):
     After verification a piece should be written on
     the disk and clear its buffers.
 
-    Each piece has a status:
+    Piece objects exist only for pieces being downloaded,
+    they are made by PieceList.start().
+
+    Each chunk in chunks_map has a status:
 
         STATUS_EMPTY:
-            The piece isn't started to download yet.
+            The chunk isn't requested yet.
 
         STATUS_DOWNLOAD:
-            Download of the piece is started but not finished.
+            The chunk is requested but not received.
 
         STATUS_COMPLETE:
-            The piece is successfully downloaded.
+            The chunk is received.
 
     Attributes:
 
         chunks:
             List of chunk buffers of the piece.
 
+        chunks_from:
+            List of peers that sent the chunks.
+
         hash:
             SHA1-hash of piece data for verification.
 
@@ -35,17 +42,16 @@ class Piece(object):
         length:
             Size of downloaded piece.
 
-        status:
-            Status of the piece.
+        started_at:
+            When the download of the piece was started.
 
     Methods:
 
-        prepare():
-            Prepare all chunks of the piece to download and set
-            the status to STATUS_DOWNLOAD.
+        alloc():
+            Prepare all chunks of the piece to download.
 
-        complete():
-            Clear chunks list and set the status to STATUS_COMPLETE.
+        clear():
+            Clear chunks list.
 
     """
 
@@ -55,22 +61,113 @@ class Piece(object):
 
     CHUNK = 1 << 14
 
+    __slots__ = (
+        "chunks_buf",
+        "chunks_count",
+        "chunks_from",
+        "chunks_map",
+        "hash",
+        "index",
+        "length",
+        "started_at"
+    )
+
     def __init__(self, hash, length, index):
-        self.active = 0
         self.chunks_buf = []
+        self.chunks_from = []
         self.chunks_map = []
         self.hash = hash
         self.index = index
         self.length = length
-        self.chunks_count = int(math.ceil(self.length / Piece.CHUNK))
+        self.chunks_count = int(math.ceil(self.length / float(Piece.CHUNK)))
+        self.started_at = time.time()
 
     def alloc(self):
         """Prepare all chunks of the piece to download."""
-        for _ in xrange(self.chunks_count):
-            self.chunks_buf.append(None)
-            self.chunks_map.append(Piece.STATUS_EMPTY)
+        self.chunks_buf = [None] * self.chunks_count
+        self.chunks_from = [None] * self.chunks_count
+        self.chunks_map = [Piece.STATUS_EMPTY] * self.chunks_count
 
     def clear(self):
         """Clear chunks list."""
         self.chunks_buf = []
+        self.chunks_from = []
         self.chunks_map = []
+
+
+class PieceList(object):
+    """Metadata of all pieces of a torrent. Hashes are read through
+    a memoryview of the "pieces" string of the .torrent, so memory
+    and time to load a torrent don't depend on the number of pieces
+    much. Piece objects with chunk buffers are made only for pieces
+    being downloaded.
+
+    Attributes:
+
+        piece_length:
+            Length of every piece except the last one.
+
+        total:
+            Length of the torrent in bytes.
+
+    Methods:
+
+        hash(index):
+            Return SHA1-hash of the piece.
+
+        size(index):
+            Return length of the piece in bytes.
+
+        get(index):
+            Return the Piece being downloaded or None.
+
+        start(index):
+            Make the Piece to download and return it.
+
+        complete(index):
+            Drop the Piece of the downloaded piece.
+
+        reset(index):
+            Drop the Piece of the piece that isn't downloaded.
+
+    """
+
+    def __init__(self, hashes, piece_length, total):
+        self.piece_length = piece_length
+        self.total = total
+        self._count = len(hashes) / 20
+        self._hashes = memoryview(hashes)
+        self._pieces = {}
+
+    def __len__(self):
+        return self._count
+
+    def hash(self, index):
+        """Return SHA1-hash of the piece."""
+        return self._hashes[index*20:index*20+20].tobytes()
+
+    def size(self, index):
+        """Return length of the piece in bytes. The last piece is shorter."""
+        return min(self.piece_length, self.total - index * self.piece_length)
+
+    def get(self, index):
+        """Return the Piece being downloaded or None."""
+        return self._pieces.get(index)
+
+    def start(self, index):
+        """Make the Piece to download and return it."""
+        p = self._pieces.get(index)
+        if p is None:
+            p = Piece(self.hash(index), self.size(index), index)
+            self._pieces[index] = p
+        p.alloc()
+        p.started_at = time.time()
+        return p
+
+    def complete(self, index):
+        """Drop the Piece of the downloaded piece."""
+        self._pieces.pop(index, None)
+
+    def reset(self, index):
+        """Drop the Piece of the piece that isn't downloaded."""
+        self._pieces.pop(index, None)
@@ -0,0 +1,233 @@
+"""
+Opt-in profiling of the main loop.
+
+Three tools that can be used together:
+
+    Function profile - the whole session runs under cProfile,
+    stats are dumped on exit and on SIGUSR1 (read them with pstats).
+
+    Stack sampling - a background thread records the stack of
+    the loop thread RATE times per second. Stacks are dumped in
+    the folded format ("a;b;c count") that flame graph tools read.
+
+    Phase timers - every loop iteration is split into recv, parse,
+    schedule, send and disk phases. The hot code only checks
+    profiler.enabled, so they cost nothing when disabled:
+
+        if profiler.enabled:
+            profiler.begin("disk")
+        ...
+        if profiler.enabled:
+            profiler.end()
+
+Functions:
+
+    start_profile(path), start_sampling(path, rate=None), enable():
+        Start the tools.
+
+    begin(name), end():
+        Enter and leave a phase. Phases may be nested, time of
+        a nested phase is not counted in the outer one.
+
+    phases():
+        Return {phase: seconds} of all time spent in phases.
+
+    dump():
+        Write the function profile and the stack samples.
+
+    stop():
+        Stop all tools and dump their results.
+
+"""
+
+import cProfile
+import signal
+import sys
+import thread
+import threading
+import time
+
+__all__ = [
+    "PHASES",
+    "Sampler",
+    "enable",
+    "begin",
+    "end",
+    "phases",
+    "to_string",
+    "start_profile",
+    "start_sampling",
+    "dump",
+    "stop"
+]
+
+PHASES = ("recv", "parse", "schedule", "send", "disk")
+
+enabled = False
+
+_profile = None
+_profile_path = None
+_sampler = None
+_stack = []
+_totals = dict.fromkeys(PHASES, 0.0)
+
+
+class Sampler(object):
+    """Records stacks of a thread at a fixed rate in a background thread.
+
+    Attributes:
+
+        counts:
+            {folded stack: number of samples}.
+
+    Methods:
+
+        start(), stop():
+            Start and stop sampling.
+
+        dump(path):
+            Write stacks in the folded format, the most frequent first.
+
+    """
+
+    MAX_DEPTH = 64
+    RATE = 100
+
+    def __init__(self, thread_id=None, rate=None):
+        self.counts = {}
+        self.rate = rate or Sampler.RATE
+        self.thread_id = thread_id or thread.get_ident()
+        self._running = False
+
+    def start(self):
+        """Start sampling."""
+        self._running = True
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._running = False
+
+    def dump(self, path):
+        """Write stacks in the folded format, the most frequent first."""
+        items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        with open(path, "w") as f:
+            for stack, count in items:
+                f.write("%s %d\n" % (stack, count))
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        while self._running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record(frame)
+            del frame
+            time.sleep(interval)
+
+    def _record(self, frame):
+        names = []
+        while frame is not None and len(names) < Sampler.MAX_DEPTH:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (
+                code.co_name,
+                code.co_filename.split("/")[-1],
+                code.co_firstlineno
+            ))
+            frame = frame.f_back
+        names.reverse()
+        stack = ";".join(names)
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+
+
+def enable():
+    """Start phase timers."""
+    global enabled
+    enabled = True
+
+
+def begin(name):
+    """Enter the phase. Time of the current phase is paused."""
+    now = time.time()
+    if _stack:
+        outer, started_at = _stack[-1]
+        _totals[outer] += now - started_at
+    _stack.append((name, now))
+
+
+def end():
+    """Leave the current phase and resume the outer one."""
+    now = time.time()
+    name, started_at = _stack.pop()
+    _totals[name] = _totals.get(name, 0.0) + now - started_at
+    if _stack:
+        _stack[-1] = (_stack[-1][0], now)
+
+
+def phases():
+    """Return {phase: seconds} of all time spent in phases."""
+    return dict(_totals)
+
+
+def to_string():
+    """Return a status line with phase times and their shares."""
+    totals = phases()
+    total = sum(totals.values()) or 1.0
+    return "[Phases] %s" % " ".join(
+        "[%s: %.2f s %.0f%%]" % (name, totals[name], totals[name] * 100.0 / total)
+        for name in PHASES
+    )
+
+
+def start_profile(path):
+    """Run the rest of the session under cProfile. Stats are
+    written to path on stop() and on SIGUSR1.
+
+    """
+    global _profile, _profile_path
+    _profile = cProfile.Profile()
+    _profile_path = path
+    _install_signal()
+    _profile.enable()
+
+
+def start_sampling(path, rate=None):
+    """Sample stacks of the calling thread. Stacks are written
+    to path on stop() and on SIGUSR1.
+
+    """
+    global _sampler
+    _sampler = Sampler(rate=rate)
+    _sampler.path = path
+    _install_signal()
+    _sampler.start()
+
+
+def dump():
+    """Write the function profile and the stack samples."""
+    if _profile:
+        # dump_stats() disables the profiler
+        _profile.dump_stats(_profile_path)
+        _profile.enable()
+    if _sampler:
+        _sampler.dump(_sampler.path)
+
+
+def stop():
+    """Stop all tools and dump their results."""
+    global _profile, _sampler
+    if _profile:
+        _profile.disable()
+        _profile.dump_stats(_profile_path)
+        _profile = None
+    if _sampler:
+        _sampler.stop()
+        _sampler.dump(_sampler.path)
+        _sampler = None
+
+
+def _install_signal():
+    # There is no SIGUSR1 on Windows
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
@@ -0,0 +1,163 @@
+"""
+Recording of peer traffic for deterministic replay.
+
+The recorder logs every framed peer message with a timestamp and
+a peer number to a compact binary file. Messages are recorded at
+the Peer.on_recv boundary (received) and at Node.send (sent),
+tracker responses are recorded too. The hot code only checks
+recorder.enabled, so recording costs nothing when it's off:
+
+    if recorder.enabled:
+        recorder.recv(n, buf)
+
+Recordings are fed back into Torrent and Downloader by the replay
+module.
+
+File format (all numbers are in network byte order):
+
+    Header: "CBTREC" and a version byte.
+    Record: type (1 byte), time since start in seconds (double),
+    peer number (4 bytes), length (4 bytes) and data.
+
+Record types:
+
+    RECORD_META: bencoded info dict of the torrent (peer number 0).
+    RECORD_PEER: "ip:port" of a new peer.
+    RECORD_RECV: a message or a handshake received from the peer.
+    RECORD_SEND: data the client sent to the peer.
+    RECORD_CLOSE: the peer is disconnected (no data).
+    RECORD_TRACKER: bencoded tracker response (peer number 0).
+
+Functions:
+
+    start(path), stop():
+        Start and stop recording.
+
+    meta(info), recv(n, data), send(n, data), close(n), tracker(response):
+        Record an event.
+
+    read(path):
+        Yield (type, time, peer number, data) of the recording.
+
+"""
+
+import struct
+import time
+
+import bcode
+
+__all__ = [
+    "RECORD_META",
+    "RECORD_PEER",
+    "RECORD_RECV",
+    "RECORD_SEND",
+    "RECORD_CLOSE",
+    "RECORD_TRACKER",
+    "start",
+    "stop",
+    "meta",
+    "recv",
+    "send",
+    "close",
+    "tracker",
+    "read"
+]
+
+HEADER = "CBTREC\x01"
+RECORD = struct.Struct("!BdII")
+
+RECORD_META = 0
+RECORD_PEER = 1
+RECORD_RECV = 2
+RECORD_SEND = 3
+RECORD_CLOSE = 4
+RECORD_TRACKER = 5
+
+enabled = False
+
+_file = None
+_last_number = 0
+_peers = {}
+_started_at = 0
+
+
+def start(path):
+    """Start recording to the file."""
+    global enabled, _file, _last_number, _peers, _started_at
+    _file = open(path, "wb")
+    _file.write(HEADER)
+    _last_number = 0
+    _peers = {}
+    _started_at = time.time()
+    enabled = True
+
+
+def stop():
+    """Stop recording and close the file."""
+    global enabled, _file
+    enabled = False
+    if _file:
+        _file.close()
+        _file = None
+
+
+def meta(info):
+    """Record the info dict of the torrent."""
+    _write(RECORD_META, 0, bcode.encode(info))
+
+
+def recv(n, data):
+    """Record a message or a handshake received from the peer."""
+    _write(RECORD_RECV, _peer(n), data)
+
+
+def send(n, data):
+    """Record data sent to the peer."""
+    _write(RECORD_SEND, _peer(n), data)
+
+
+def close(n):
+    """Record that the peer is disconnected."""
+    if n in _peers:
+        _write(RECORD_CLOSE, _peers.pop(n), "")
+
+
+def tracker(response):
+    """Record a tracker response."""
+    if isinstance(response, dict):
+        _write(RECORD_TRACKER, 0, bcode.encode(response))
+
+
+def read(path):
+    """Yield (type, time, peer number, data) of the recording."""
+    with open(path, "rb") as f:
+        if f.read(len(HEADER)) != HEADER:
+            raise IOError("Invalid recording: %s" % path)
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            type, timestamp, number, length = RECORD.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield type, timestamp, number, data
+
+
+def _peer(n):
+    """Return the number of the peer, record it if it's new."""
+    global _last_number
+    number = _peers.get(n)
+    if number is None:
+        _last_number += 1
+        number = _last_number
+        _peers[n] = number
+        _write(RECORD_PEER, number, "%s:%d" % (n.ip, n.port))
+    return number
+
+
+def _write(type, number, data):
+    if not _file:
+        return
+    _file.write(RECORD.pack(type, time.time() - _started_at, number, len(data)))
+    _file.write(data)
@@ -0,0 +1,183 @@
+import collections
+
+import timer
+
+__all__ = ["Registry"]
+
+
+class Entry(object):
+    """Registry state of one peer address."""
+
+    __slots__ = ("address", "failures", "state")
+
+    def __init__(self, address, state):
+        self.address = address
+        self.failures = 0
+        self.state = state
+
+
+class Registry(object):
+    """All known peers of a torrent keyed by (ip, port). A peer is
+    a candidate to connect, active (connecting or connected), waiting
+    for reconnection or dropped. Candidates are connected in order
+    they were found.
+
+    A disconnected peer is a candidate again in RECONNECT_AFTER
+    seconds. Every failure (the connection couldn't be established
+    or no piece data was exchanged) doubles the delay, a peer is
+    dropped after MAX_FAILURES failures in a row. Peers that
+    misbehave are dropped at once. Dropped and banned peers are
+    never connected again. Back-off timers are on timer.wheel,
+    so every operation takes O(1) however many peers are known.
+
+    Attributes:
+
+        banned:
+            A set of banned IP addresses.
+
+    Methods:
+
+        add(ip, port):
+            Remember a new peer as a candidate. Return False if it's
+            known already or banned.
+
+        pop():
+            Return the address of the next candidate and make it
+            active or None if there is no candidate.
+
+        closed(address, good=False):
+            The active peer is disconnected. good means it has
+            exchanged piece data with the client. Unknown peers
+            (e.g. incoming ones) are remembered.
+
+        release(address):
+            The active peer is disconnected on purpose (e.g. the
+            torrent is paused), it's a candidate again at once.
+
+        drop(address):
+            Never connect the peer again.
+
+        ban(ip):
+            Never connect peers of the IP address again.
+
+        candidates():
+            Return number of candidates.
+
+        count(state):
+            Return number of peers in the state (STATE_*).
+
+    """
+
+    MAX_FAILURES = 5
+    RECONNECT_AFTER = 30
+
+    STATE_CANDIDATE = 0
+    STATE_ACTIVE = 1
+    STATE_WAITING = 2
+    STATE_DROPPED = 3
+
+    def __init__(self):
+        self.banned = set()
+        self._candidates = collections.deque()
+        self._counts = [0, 0, 0, 0]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, address):
+        return address in self._entries
+
+    def add(self, ip, port):
+        """Remember a new peer as a candidate. Return False if it's
+        known already or banned.
+
+        """
+        address = (ip, port)
+        if address in self._entries or ip in self.banned:
+            return False
+        entry = self._entries[address] = Entry(address, Registry.STATE_CANDIDATE)
+        self._counts[Registry.STATE_CANDIDATE] += 1
+        self._candidates.append(entry)
+        return True
+
+    def pop(self):
+        """Return the address of the next candidate and make it active
+        or None if there is no candidate.
+
+        """
+        while self._candidates:
+            entry = self._candidates.popleft()
+            if entry.state != Registry.STATE_CANDIDATE:
+                continue
+            if entry.address[0] in self.banned:
+                self._set(entry, Registry.STATE_DROPPED)
+                continue
+            self._set(entry, Registry.STATE_ACTIVE)
+            return entry.address
+        return None
+
+    def closed(self, address, good=False):
+        """The active peer is disconnected. good means it has exchanged
+        piece data with the client. Unknown peers are remembered.
+
+        """
+        entry = self._entry(address)
+        if entry.state != Registry.STATE_ACTIVE:
+            return
+        if good:
+            entry.failures = 0
+        else:
+            entry.failures += 1
+        if entry.failures >= Registry.MAX_FAILURES or address[0] in self.banned:
+            self._set(entry, Registry.STATE_DROPPED)
+            return
+        self._set(entry, Registry.STATE_WAITING)
+        delay = Registry.RECONNECT_AFTER * 2 ** entry.failures
+        timer.wheel.call_later(delay, self._retry, entry)
+
+    def release(self, address):
+        """The active peer is disconnected on purpose,
+        it's a candidate again at once.
+
+        """
+        entry = self._entries.get(address)
+        if entry is None or entry.state != Registry.STATE_ACTIVE:
+            return
+        self._set(entry, Registry.STATE_CANDIDATE)
+        self._candidates.append(entry)
+
+    def drop(self, address):
+        """Never connect the peer again."""
+        self._set(self._entry(address), Registry.STATE_DROPPED)
+
+    def ban(self, ip):
+        """Never connect peers of the IP address again."""
+        self.banned.add(ip)
+
+    def candidates(self):
+        """Return number of candidates."""
+        return self._counts[Registry.STATE_CANDIDATE]
+
+    def count(self, state):
+        """Return number of peers in the state (STATE_*)."""
+        return self._counts[state]
+
+    def _entry(self, address):
+        """Return the entry of the address, a new active one if unknown."""
+        entry = self._entries.get(address)
+        if entry is None:
+            entry = self._entries[address] = Entry(address, Registry.STATE_ACTIVE)
+            self._counts[Registry.STATE_ACTIVE] += 1
+        return entry
+
+    def _set(self, entry, state):
+        self._counts[entry.state] -= 1
+        self._counts[state] += 1
+        entry.state = state
+
+    def _retry(self, entry):
+        if entry.state != Registry.STATE_WAITING:
+            return
+        self._set(entry, Registry.STATE_CANDIDATE)
+        self._candidates.append(entry)
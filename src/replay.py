@@ -0,0 +1,177 @@
+"""
+Deterministic replay of peer traffic recorded by the recorder module.
+
+A recording is fed into Torrent and Downloader without sockets:
+received messages go to the peer handlers, data the client sends
+is counted and dropped. Random choices are seeded, so the same
+recording is parsed and scheduled the same way every time and
+its profile can be compared between changes.
+
+"""
+
+import errno
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+
+import bcode
+import dht
+import node
+import peer
+import profiler
+import recorder
+import torrent
+
+__all__ = ["replay"]
+
+
+class ReplayConn(object):
+    """Socket replacement of a replayed peer. Sent data is counted
+    and dropped, nothing is ever received from it.
+
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def recv(self, size):
+        raise socket.error(errno.EAGAIN, "Replayed peer")
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplaySocket(object):
+    """udp.Socket replacement for the DHT of a replayed torrent."""
+
+    def __init__(self):
+        self.address = ("127.0.0.1", 0)
+
+    def on_recv(self, match, func):
+        pass
+
+    def sendto(self, data, address):
+        pass
+
+    def message(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class ReplayListener(object):
+    """Listener replacement for a replayed torrent."""
+
+    def message(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def replay(path, realtime=False):
+    """Feed the recording into a Torrent without sockets and return
+    a dict of stats. Without realtime records are replayed as fast
+    as possible, so timeouts of the client don't fire as they did.
+
+    """
+    random.seed(0)
+    # Nothing must go out of the box: there are no trackers, the DHT
+    # and the listener are replaced and peers are never connected
+    if not torrent.Torrent.id:
+        torrent.Torrent.id = torrent.gen_id()
+    if not torrent.Torrent.port:
+        torrent.Torrent.port = 6881
+    if torrent.Torrent.listener is None:
+        torrent.Torrent.listener = ReplayListener()
+    if not torrent.Torrent.udp:
+        torrent.Torrent.udp = ReplaySocket()
+        torrent.Torrent.dht = dht.DHT(torrent.Torrent.udp)
+
+    t = None
+    folder = tempfile.mkdtemp(prefix="cbt-replay-")
+    conns = []
+    peers = {}
+    stats = {
+        "records": 0,
+        "received": 0,
+        "sent": 0,
+        "seconds": 0.0
+    }
+    pstr_len = len(peer.Peer.PROTOCOL)
+    started_at = time.time()
+    try:
+        for type, timestamp, number, data in recorder.read(path):
+            if realtime:
+                delay = started_at + timestamp - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            stats["records"] += 1
+            if type == recorder.RECORD_META:
+                # The torrent has no trackers, so nothing is announced
+                torrent_path = os.path.join(folder, "replay.torrent")
+                with open(torrent_path, "wb") as f:
+                    f.write(bcode.encode({"info": bcode.decode(data)}))
+                t = torrent.Torrent(torrent_path, folder)
+                t.writer.create_files()
+                # Peers of tracker responses and PEX are never connected,
+                # the session would raise the connection limit again
+                torrent.session.remove(t)
+                t.peer.max_connections = 0
+                continue
+            if not t:
+                continue
+            if type == recorder.RECORD_TRACKER:
+                t.handle_tracker_response(bcode.decode(data))
+            elif type == recorder.RECORD_PEER:
+                ip, port = data.rsplit(":", 1)
+                n = node.Node(ip, int(port))
+                n.conn = ReplayConn()
+                conns.append(n.conn)
+                peers[number] = n
+                t.peer.nodes.append(n)
+                for func in t.peer.handlers["on_connect"]:
+                    func(n)
+            elif type == recorder.RECORD_RECV and number in peers:
+                n = peers[number]
+                if not n.conn:
+                    continue
+                stats["received"] += len(data)
+                # The same test as in Peer
+                if ord(data[0]) == pstr_len and len(data) == pstr_len + 49:
+                    handlers = t.peer.handlers["on_recv_handshake"]
+                else:
+                    handlers = t.peer.handlers["on_recv"]
+                if profiler.enabled:
+                    profiler.begin("parse")
+                for func in handlers:
+                    func(n, data)
+                if profiler.enabled:
+                    profiler.end()
+            elif type == recorder.RECORD_CLOSE and number in peers:
+                n = peers.pop(number)
+                if n.conn:
+                    n.close()
+            else:
+                continue
+            t.message()
+    finally:
+        stats["seconds"] = time.time() - started_at
+        stats["sent"] = sum(conn.sent for conn in conns)
+        if t:
+            stats["verified"] = t.downloader.verified()
+            stats["progress"] = t.downloader.progress()
+            torrent.collected.remove(t)
+        shutil.rmtree(folder, ignore_errors=True)
+    return stats
@@ -6,6 +6,7 @@ class Request(object):
         self.node = node
         self.piece = piece
         self.chunk = chunk
+        self.overdue = False
         self.started_at = time.time()
 
     def elapsed(self):
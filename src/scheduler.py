@@ -0,0 +1,344 @@
+import time
+
+import timer
+
+__all__ = ["MemoryBudget", "Scheduler", "Throttle", "TokenBucket"]
+
+
+class TokenBucket(object):
+    """Bandwidth limit. The bucket is filled with rate tokens
+    (bytes) per second up to burst tokens and every transferred
+    byte takes one token. Zero rate means no limit.
+
+    Methods:
+
+        allowance(size):
+            Return how many of size bytes may be transferred now.
+
+        consume(size):
+            Take size tokens from the bucket.
+
+        set_rate(rate, burst=None):
+            Change the limit. burst defaults to one second of traffic.
+
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self._updated_at = time.time()
+        self.set_rate(rate, burst)
+
+    def allowance(self, size):
+        """Return how many of size bytes may be transferred now."""
+        if not self.rate:
+            return size
+        self._refill()
+        return max(min(size, int(self.tokens)), 0)
+
+    def consume(self, size):
+        """Take size tokens from the bucket."""
+        if self.rate:
+            self.tokens -= size
+
+    def set_rate(self, rate, burst=None):
+        """Change the limit. burst defaults to one second of traffic."""
+        self._refill()
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self._updated_at) * self.rate, self.burst)
+        self._updated_at = now
+
+
+class Throttle(object):
+    """A set of token buckets that limit one direction of traffic
+    of a peer connection, e.g. the global and the torrent upload
+    limits. A transfer has to fit into every bucket.
+
+    Methods:
+
+        allowance(size):
+            Return how many of size bytes may be transferred now.
+
+        consume(size):
+            Take size tokens from every bucket.
+
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or []
+        self.total = 0
+
+    def allowance(self, size):
+        """Return how many of size bytes may be transferred now."""
+        for bucket in self.buckets:
+            size = bucket.allowance(size)
+            if not size:
+                break
+        return size
+
+    def consume(self, size):
+        """Take size tokens from every bucket."""
+        self.total += size
+        for bucket in self.buckets:
+            bucket.consume(size)
+
+
+class MemoryBudget(object):
+    """Memory limit of piece data in flight shared by all torrents
+    of the session: buffers of pieces being downloaded and verified
+    pieces until they are written. Memory is reserved when a piece
+    is started and released when it's written. Zero limit means
+    no limit.
+
+    A reservation is refused if it doesn't fit into the limit,
+    unless nothing is reserved at all, so a piece larger than
+    the limit can be downloaded too.
+
+    Attributes:
+
+        limit:
+            The limit in bytes (0 - no limit).
+
+        used:
+            Reserved bytes.
+
+        peak:
+            The most bytes reserved at once.
+
+    Methods:
+
+        reserve(size):
+            Reserve size bytes. Return False if they don't fit.
+
+        release(size):
+            Release reserved bytes.
+
+        available():
+            Return how many bytes may be reserved or None if
+            there is no limit.
+
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.peak = 0
+        self.used = 0
+
+    def reserve(self, size):
+        """Reserve size bytes. Return False if they don't fit."""
+        if self.limit and self.used and self.used + size > self.limit:
+            return False
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        return True
+
+    def release(self, size):
+        """Release reserved bytes."""
+        self.used -= size
+
+    def available(self):
+        """Return how many bytes may be reserved or None if
+        there is no limit.
+
+        """
+        if not self.limit:
+            return None
+        return max(self.limit - self.used, 0)
+
+
+class Entry(object):
+    """Scheduler state of one torrent."""
+
+    def __init__(self, torrent, priority, number):
+        self.active = False
+        self.download = TokenBucket()
+        self.number = number
+        self.paused = False
+        self.priority = priority
+        self.torrent = torrent
+        self.upload = TokenBucket()
+
+
+class Scheduler(object):
+    """Session-level scheduler of all torrents. It activates
+    torrents in order of priority up to max_active (paused ones
+    are never active and don't take a place), splits
+    max_connections between active torrents and calls their
+    message() methods starting from a different torrent every
+    time so nobody is starved. Torrent peers share the global
+    download and upload buckets and have their own ones.
+
+    A torrent has to provide a "peer" attribute (peer.Peer)
+    and a message() method.
+
+    Attributes:
+
+        download, upload:
+            Global TokenBucket objects.
+
+        memory:
+            MemoryBudget of piece data of all torrents.
+
+        max_active:
+            How many torrents may be active at once (0 - no limit).
+
+        max_connections:
+            How many peer connections may be open at once (0 - no limit).
+
+    Methods:
+
+        add(torrent, priority=PRIORITY_NORMAL):
+            Add the torrent to the queue.
+
+        remove(torrent):
+            Remove the torrent from the scheduler.
+
+        set_priority(torrent, priority):
+            Change priority of the torrent.
+
+        pause(torrent), resume(torrent):
+            Deactivate the torrent until it's resumed.
+
+        paused(torrent):
+            Return True if the torrent is paused.
+
+        set_rate(torrent, download_rate, upload_rate):
+            Set torrent bandwidth limits in bytes per second (0 - no limit).
+
+        set_limits(max_active, max_connections, download_rate, upload_rate, memory=0):
+            Change global limits. memory is the limit of piece data
+            in flight in bytes (0 - no limit).
+
+        active():
+            Return a list of active torrents.
+
+        message():
+            You have to call this method in a loop. It advances
+            timer.wheel as well.
+
+    """
+
+    PRIORITY_LOW = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_HIGH = 2
+
+    def __init__(self, max_active=0, max_connections=0, download_rate=0, upload_rate=0, memory=0):
+        self.download = TokenBucket(download_rate)
+        self.entries = []
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.memory = MemoryBudget(memory)
+        self.upload = TokenBucket(upload_rate)
+        self._added = 0
+        self._turn = 0
+
+    def add(self, torrent, priority=PRIORITY_NORMAL):
+        """Add the torrent to the queue."""
+        if self._entry(torrent):
+            return
+        entry = Entry(torrent, priority, self._added)
+        self._added += 1
+        torrent.peer.download.buckets = [self.download, entry.download]
+        torrent.peer.upload.buckets = [self.upload, entry.upload]
+        self.entries.append(entry)
+        self._activate()
+
+    def remove(self, torrent):
+        """Remove the torrent from the scheduler."""
+        entry = self._entry(torrent)
+        if entry:
+            self.entries.remove(entry)
+            self._activate()
+
+    def set_priority(self, torrent, priority):
+        """Change priority of the torrent."""
+        entry = self._entry(torrent)
+        if entry:
+            entry.priority = priority
+            self._activate()
+
+    def pause(self, torrent):
+        """Deactivate the torrent until it's resumed."""
+        self._set_paused(torrent, True)
+
+    def resume(self, torrent):
+        """Let the paused torrent be activated again."""
+        self._set_paused(torrent, False)
+
+    def paused(self, torrent):
+        """Return True if the torrent is paused."""
+        entry = self._entry(torrent)
+        return bool(entry and entry.paused)
+
+    def set_rate(self, torrent, download_rate, upload_rate):
+        """Set torrent bandwidth limits in bytes per second (0 - no limit)."""
+        entry = self._entry(torrent)
+        if entry:
+            entry.download.set_rate(download_rate)
+            entry.upload.set_rate(upload_rate)
+
+    def set_limits(self, max_active, max_connections, download_rate, upload_rate, memory=0):
+        """Change global limits. memory is the limit of piece data
+        in flight in bytes (0 - no limit).
+
+        """
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.memory.limit = memory
+        self.download.set_rate(download_rate)
+        self.upload.set_rate(upload_rate)
+        self._activate()
+
+    def active(self):
+        """Return a list of active torrents."""
+        return [e.torrent for e in self.entries if e.active]
+
+    def message(self):
+        """You have to call this method in a loop. It advances
+        the timer wheel of the session too.
+        Return False if there is nothing to do.
+
+        """
+        busy = timer.wheel.message()
+        active = [e for e in self.entries if e.active]
+        if not active:
+            return busy
+        self._turn = (self._turn + 1) % len(active)
+        result = busy
+        for entry in active[self._turn:] + active[:self._turn]:
+            if entry.torrent.message():
+                result = True
+        return result
+
+    def _activate(self):
+        """Activate torrents by priority and split connection limit."""
+        queue = sorted(self.entries, key=lambda e: (e.paused, -e.priority, e.number))
+        for x, entry in enumerate(queue):
+            entry.active = not entry.paused and (not self.max_active or x < self.max_active)
+        active = [e for e in queue if e.active]
+        for entry in queue:
+            if not entry.active:
+                entry.torrent.peer.max_connections = 0
+            elif self.max_connections:
+                share = max(self.max_connections / len(active), 1)
+                entry.torrent.peer.max_connections = share
+            else:
+                entry.torrent.peer.max_connections = None
+
+    def _set_paused(self, torrent, paused):
+        entry = self._entry(torrent)
+        if entry and entry.paused != paused:
+            entry.paused = paused
+            self._activate()
+
+    def _entry(self, torrent):
+        for entry in self.entries:
+            if entry.torrent is torrent:
+                return entry
+        return None
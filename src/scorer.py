@@ -0,0 +1,95 @@
+import time
+
+__all__ = ["Scorer"]
+
+
+class Scorer(object):
+    """Rates peers and picks the ones to drop. The score of a peer
+    is how fast we exchange data with it (download_rate and a share
+    of upload_rate measured by the choker) reduced by its request
+    latency, protocol errors and pieces that failed SHA1 check with
+    its data. Snubbed peers score nothing.
+
+    A peer is snubbed if it sends no piece data for SNUB_TIMEOUT
+    seconds while it has requests of the client. Its requests should
+    be released so other peers download the chunks.
+
+    Every INTERVAL seconds, while there are peers waiting for
+    connection, up to EVICT worst peers are dropped to make room for
+    them. Peers connected less than GRACE seconds ago are kept, they
+    have no rates yet. Peers with MAX_ERRORS protocol errors are
+    dropped at once.
+
+    Scores are stored in node score attributes.
+
+    Methods:
+
+        score(node):
+            Return the score of the peer.
+
+        snubbed(nodes):
+            Return a list of peers snubbed just now.
+
+        message(nodes, waiting):
+            Return a list of peers to disconnect.
+
+    """
+
+    EVICT = 2
+    GRACE = 60
+    INTERVAL = 30
+    LATENCY = 1.0
+    MAX_ERRORS = 5
+    MIN_SHARE = 0.1
+    SNUB_TIMEOUT = 30
+    UPLOAD_WEIGHT = 0.25
+
+    def __init__(self):
+        self._scored_at = time.time()
+
+    def score(self, n):
+        """Return the score of the peer."""
+        if n.snubbed:
+            return 0.0
+        rate = n.download_rate + n.upload_rate * Scorer.UPLOAD_WEIGHT
+        return rate / (1 + n.rtt / Scorer.LATENCY) / (1 + n.errors + n.hashfails)
+
+    def snubbed(self, nodes):
+        """Return a list of peers snubbed just now."""
+        now = time.time()
+        result = []
+        for n in nodes:
+            if (
+                n.active > 0
+                and not n.snubbed
+                and now - max(n.last_piece, n.last_request) > Scorer.SNUB_TIMEOUT
+            ):
+                n.snubbed = True
+                result.append(n)
+        return result
+
+    def message(self, nodes, waiting):
+        """Return a list of peers to disconnect. waiting is how many
+        peers wait for connection.
+
+        """
+        drop = [n for n in nodes if n.errors >= Scorer.MAX_ERRORS]
+        now = time.time()
+        if now - self._scored_at < Scorer.INTERVAL:
+            return drop
+        self._scored_at = now
+
+        for n in nodes:
+            n.score = self.score(n)
+        if not waiting or not nodes:
+            return drop
+        # Only peers far behind the average make room for new ones
+        average = sum(n.score for n in nodes) / len(nodes)
+        candidates = [
+            n for n in nodes
+            if n not in drop
+            and now - n.connected_at >= Scorer.GRACE
+            and n.score <= average * Scorer.MIN_SHARE
+        ]
+        candidates.sort(key=lambda n: n.score)
+        return drop + candidates[:min(Scorer.EVICT, waiting)]
@@ -0,0 +1,15 @@
+import os
+
+__all__ = ["path"]
+
+DIRECTORY = os.path.join(os.path.expanduser("~"), ".cbt")
+
+
+def path(name):
+    """Return full path of a file in the client data directory
+    (~/.cbt). The directory is created if it doesn't exist.
+
+    """
+    if not os.path.isdir(DIRECTORY):
+        os.makedirs(DIRECTORY)
+    return os.path.join(DIRECTORY, name)
@@ -0,0 +1,294 @@
+import multiprocessing
+import os
+import socket
+import time
+from multiprocessing import reduction
+
+import dht
+import listener
+import metrics
+import node
+import profiler
+import storage
+import timer
+import torrent
+import udp
+import utp
+
+__all__ = ["Supervisor", "worker_path"]
+
+
+class WorkerListener(object):
+    """Listener replacement inside a worker process. Incoming
+    connections are accepted by the supervisor and their sockets
+    are passed through a pipe with the already received data.
+
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def message(self):
+        """Return False if there is nothing to do."""
+        result = False
+        while self.conn.poll():
+            info_hash, address, data = self.conn.recv()
+            fd = reduction.recv_handle(self.conn)
+            conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+            if not torrent.accept(info_hash, conn, address, data):
+                conn.close()
+            result = True
+        return result
+
+
+def worker_path(path, index):
+    """Return the path of a per-worker file: "metrics.prom"
+    becomes "metrics-0.prom" for the first worker.
+
+    """
+    root, ext = os.path.splitext(path)
+    return "%s-%d%s" % (root, index, ext)
+
+
+def _share(limits, count):
+    """Return limits of one of count workers. Zero means no limit."""
+    return dict(
+        (name, max(value / count, 1) if value else 0)
+        for name, value in limits.iteritems()
+    )
+
+
+def _worker(index, paths, download_path, port, stats_conn, sockets_conn, limits, options):
+    """Worker process: run its own main loop over its torrents and
+    send their stats to the supervisor every STATS_INTERVAL seconds.
+    limits are keyword arguments of Scheduler.set_limits() of this
+    worker, options are the Supervisor ones.
+
+    """
+    torrent.Torrent.port = port
+    torrent.Torrent.listener = WorkerListener(sockets_conn)
+    # Every worker has its own UDP socket because datagrams
+    # can't be routed by torrent
+    torrent.Torrent.udp = udp.Socket(0)
+    torrent.Torrent.dht = dht.DHT(
+        torrent.Torrent.udp,
+        cache_path=storage.path("dht-%d" % index)
+    )
+    torrent.Torrent.dht.bootstrap()
+    torrent.session.set_limits(**limits)
+    if options.get("utp"):
+        # Outgoing connections only, peers connect to the supervisor
+        torrent.Torrent.utp = utp.Transport(torrent.Torrent.udp)
+        node.Node.utp = torrent.Torrent.utp
+    if options.get("metrics"):
+        metrics.enable()
+        torrent.metrics_path = worker_path(options["metrics"], index)
+    if options.get("phases"):
+        profiler.enable()
+    if options.get("profile"):
+        profiler.start_profile(worker_path(options["profile"], index))
+    if options.get("sample"):
+        profiler.start_sampling(worker_path(options["sample"], index), options.get("sample_rate"))
+
+    torrents = []
+    for path in paths:
+        try:
+            t = torrent.Torrent(path, download_path)
+        except IOError:
+            continue
+        t.start()
+        torrents.append(t)
+
+    def send_stats():
+        stats = []
+        for t in torrents:
+            item = t.stats()
+            item["status"] = str(t)
+            stats.append(item)
+        phases = profiler.to_string() if profiler.enabled else None
+        stats_conn.send((index, stats, phases))
+
+    send_stats()
+    timer.wheel.call_every(Supervisor.STATS_INTERVAL, send_stats)
+    if torrent.metrics_path:
+        timer.wheel.call_every(Supervisor.EXPORT_METRICS_EVERY, metrics.export, torrent.metrics_path)
+    try:
+        while True:
+            if not torrent.message():
+                time.sleep(0.001)
+    except (KeyboardInterrupt, IOError, EOFError):
+        pass
+    for t in torrents:
+        t.stop()
+    if torrent.metrics_path:
+        metrics.export(torrent.metrics_path)
+    profiler.stop()
+
+
+class Supervisor(object):
+    """Spreads torrents over worker processes so that they run
+    on all CPU cores. Each worker runs its own main loop.
+    The supervisor owns the listening socket: it reads handshakes
+    of incoming connections and passes the sockets to the worker
+    that runs the torrent. Workers report their stats back over pipes.
+
+    Global limits (keyword arguments of Scheduler.set_limits()) are
+    split evenly between workers. Options of workers are a dict:
+    "utp" flag, "metrics", "profile" and "sample" paths (every worker
+    writes its own file, see worker_path()), "sample_rate" and "phases"
+    flag (phase timers are shown with the worker stats).
+
+    Attributes:
+
+        limits:
+            Global limits of all workers.
+
+        options:
+            Options of workers.
+
+        phases:
+            The latest phase timers of workers if "phases" option
+            is set: {worker index: string}.
+
+        stats:
+            The latest stats of all torrents from all workers:
+            {worker index: [torrent stats dict, ...]}.
+
+    Methods:
+
+        start():
+            Start worker processes.
+
+        message():
+            You have to call this method in a loop.
+
+        stop():
+            Stop worker processes.
+
+        run():
+            Start workers and print their stats until Ctrl-C.
+
+    """
+
+    EXPORT_METRICS_EVERY = 10
+    STATS_INTERVAL = 2
+
+    def __init__(self, paths, download_path, workers=None, limits=None, options=None):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.download_path = download_path
+        self.limits = limits or {}
+        self.options = options or {}
+        self.paths = paths
+        self.phases = {}
+        self.stats = {}
+        self.workers = []
+        self._owners = {}
+        self._shards = [[] for _ in xrange(min(workers, len(paths)) or 1)]
+
+        for x, path in enumerate(paths):
+            index = x % len(self._shards)
+            self._shards[index].append(path)
+            try:
+                meta, hash = torrent.read_meta(path)
+            except IOError:
+                continue
+            self._owners[hash] = index
+
+        if not torrent.Torrent.id:
+            torrent.Torrent.id = torrent.gen_id()
+        if not torrent.Torrent.port:
+            torrent.Torrent.port = torrent.gen_port()
+        self.listener = listener.Listener(torrent.Torrent.port)
+        self.listener.on_handshake(self._route)
+
+    def start(self):
+        """Start worker processes."""
+        for index, paths in enumerate(self._shards):
+            stats_parent, stats_child = multiprocessing.Pipe(False)
+            # Descriptors can be passed through a socket pair only
+            sockets_child, sockets_parent = multiprocessing.Pipe(True)
+            process = multiprocessing.Process(
+                target=_worker,
+                args=(
+                    index,
+                    paths,
+                    self.download_path,
+                    torrent.Torrent.port,
+                    stats_child,
+                    sockets_child,
+                    _share(self.limits, len(self._shards)),
+                    self.options
+                )
+            )
+            process.daemon = True
+            process.start()
+            self.workers.append((process, stats_parent, sockets_parent))
+
+    def message(self):
+        """You have to call this method in a loop.
+        Return False if there is nothing to do.
+
+        """
+        result = self.listener.message()
+        for process, stats_conn, _ in self.workers:
+            while stats_conn.poll():
+                try:
+                    index, stats, phases = stats_conn.recv()
+                except EOFError:
+                    break
+                self.stats[index] = stats
+                if phases:
+                    self.phases[index] = phases
+                result = True
+        return result
+
+    def stop(self):
+        """Stop worker processes."""
+        for process, _, _ in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.listener.close()
+
+    def run(self):
+        """Start workers and print their stats until Ctrl-C."""
+        self.start()
+        ts = time.time()
+        try:
+            while True:
+                if not self.message():
+                    time.sleep(0.01)
+                if time.time() - ts >= Supervisor.STATS_INTERVAL:
+                    print self._to_string()
+                    ts = time.time()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _route(self, info_hash, conn, address, data):
+        """Pass an incoming connection to the worker of the torrent."""
+        index = self._owners.get(info_hash)
+        if index is None or index >= len(self.workers):
+            return False
+        process, _, sockets_conn = self.workers[index]
+        sockets_conn.send((info_hash, address, data))
+        reduction.send_handle(sockets_conn, conn.fileno(), process.pid)
+        conn.close()
+        return True
+
+    def _to_string(self):
+        lines = []
+        downloaded = 0
+        for index in sorted(self.stats):
+            for item in self.stats[index]:
+                downloaded += item["downloaded"]
+                lines.append("[Worker %d] %s" % (index, item["status"]))
+        for index in sorted(self.phases):
+            lines.append("[Worker %d] %s" % (index, self.phases[index]))
+        lines.append("[Workers: %d] [Downloaded: %d KB]" % (
+            len(self.workers),
+            downloaded / 1024.0
+        ))
+        return "\n".join(lines)
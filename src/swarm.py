@@ -0,0 +1,619 @@
+#!/usr/bin/python2
+"""
+Loopback swarm simulator for end-to-end throughput benchmarks.
+
+A synthetic torrent is generated in a temporary folder and served
+by local seeders that speak the peer wire protocol, announced by
+a local HTTP tracker stub. A real Torrent downloads it and
+the result is reported. Everything runs on loopback addresses,
+so the benchmark works offline.
+
+Seeders and the tracker run in a child process, so CPU time and
+peak RSS of the report belong to the client only.
+
+Usage:
+
+    python swarm.py [options]
+
+Options:
+
+    --size=<MB>            Size of the torrent (16).
+    --piece-length=<KB>    Piece length (256).
+    --files=<count>        Number of files of different sizes (1).
+    --seeders=<count>      Number of seeders (4).
+    --latency=<ms>         Delay of every answer of a seeder (0).
+    --rate=<KB/s>          Upload limit of every seeder (0 - no limit).
+    --choke-interval=<s>   Seeders choke the client for a second
+                           every interval of 2 s or more (0 - never).
+    --bad-seeders=<count>  Number of seeders that send bad data (0).
+    --bad-ratio=<percent>  Share of bad blocks of a bad seeder (10).
+    --stream=<0|1>         Download in streaming mode (0).
+    --skip=<n>             Skip every n-th file (0 - none).
+    --memory=<KB>          Memory budget of piece data (0 - no limit).
+    --timeout=<s>          Give up after timeout seconds (300).
+    --min-speed=<MB/s>     Exit with status 1 if slower.
+    --json                 Print the report as JSON.
+
+The exit status is 1 if the download isn't completed in time
+or is slower than --min-speed, so the benchmark can gate changes.
+
+"""
+
+import BaseHTTPServer
+import getopt
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import bcode
+import convert
+import dht
+import file
+import listener
+import peer
+import scheduler
+import torrent
+import tracker
+import udp
+
+__all__ = ["Options", "Seeder", "TrackerStub", "make_torrent", "run"]
+
+
+OPTIONS = [
+    "size=",
+    "piece-length=",
+    "files=",
+    "seeders=",
+    "latency=",
+    "rate=",
+    "choke-interval=",
+    "bad-seeders=",
+    "bad-ratio=",
+    "stream=",
+    "skip=",
+    "memory=",
+    "timeout=",
+    "min-speed=",
+    "json"
+]
+
+
+class Options(object):
+    """Parameters of a simulation. Class attributes are defaults."""
+
+    SIZE = 16
+    PIECE_LENGTH = 256
+    FILES = 1
+    SEEDERS = 4
+    LATENCY = 0
+    RATE = 0
+    CHOKE_INTERVAL = 0
+    BAD_SEEDERS = 0
+    BAD_RATIO = 10
+    STREAM = 0
+    SKIP = 0
+    MEMORY = 0
+    TIMEOUT = 300
+
+    def __init__(self, **kwargs):
+        for name in dir(Options):
+            if name.isupper():
+                setattr(self, name.lower(), getattr(Options, name))
+        for name, value in kwargs.iteritems():
+            if not hasattr(self, name):
+                raise TypeError("Unknown option: %s" % name)
+            setattr(self, name, value)
+        if 0 < self.choke_interval <= Seeder.CHOKE_TIME:
+            # The client would be choked all the time
+            raise ValueError("Choke interval must be longer than %d s" % Seeder.CHOKE_TIME)
+
+
+def make_torrent(path, size, piece_length, files=1, announce=""):
+    """Generate random files of the total size in the folder path/seed
+    and their .torrent file. Files have different sizes that don't
+    fit into pieces. Return a tuple (torrent path, payload folder).
+
+    """
+    name = "swarm"
+    seed_path = os.path.join(path, "seed")
+    lengths = []
+    left = size
+    for x in xrange(files - 1):
+        length = random.randint(1, max(1, left / (files - x)))
+        lengths.append(length)
+        left -= length
+    lengths.append(left)
+
+    hashes = []
+    buf = ""
+    files_info = []
+    for x, length in enumerate(lengths):
+        file_name = "file%d.bin" % x
+        if files == 1:
+            file_path = os.path.join(seed_path, name)
+        else:
+            file_path = os.path.join(seed_path, name, file_name)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, "wb") as f:
+            left = length
+            while left:
+                data = os.urandom(min(left, 1 << 20))
+                f.write(data)
+                left -= len(data)
+                buf += data
+                while len(buf) >= piece_length:
+                    hashes.append(hashlib.sha1(buf[:piece_length]).digest())
+                    buf = buf[piece_length:]
+        files_info.append({"length": length, "path": [file_name]})
+    if buf:
+        hashes.append(hashlib.sha1(buf).digest())
+
+    info = {
+        "name": name,
+        "piece length": piece_length,
+        "pieces": "".join(hashes)
+    }
+    if files == 1:
+        info["length"] = size
+    else:
+        info["files"] = files_info
+    torrent_path = os.path.join(path, "%s.torrent" % name)
+    with open(torrent_path, "wb") as f:
+        f.write(bcode.encode({"announce": announce, "info": info}))
+    return torrent_path, seed_path
+
+
+class TrackerStub(object):
+    """HTTP tracker that answers every announce with the same
+    compact list of peers.
+
+    Methods:
+
+        start():
+            Serve requests in a background thread.
+
+        url():
+            Return the announce URL.
+
+    """
+
+    INTERVAL = 1800
+
+    def __init__(self, peers):
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                stub.announces.append(query.get("event", [""])[0])
+                body = bcode.encode({
+                    "interval": TrackerStub.INTERVAL,
+                    "peers": stub.compact
+                })
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.announces = []
+        self.compact = "".join(
+            socket.inet_aton(ip) + convert.uint_chr(port)[2:]
+            for ip, port in peers
+        )
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self):
+        """Return the announce URL."""
+        return "http://127.0.0.1:%d/announce" % self.server.server_address[1]
+
+
+class Seeder(object):
+    """Peer that has the whole torrent and serves requests.
+    Every connection is handled by its own thread.
+
+    Attributes:
+
+        address:
+            (ip, port) of the listening socket.
+
+        latency:
+            Seconds between a request and its piece message.
+
+        rate:
+            Upload limit in bytes per second (0 - no limit).
+
+        choke_interval:
+            Choke the client for CHOKE_TIME seconds every interval
+            (0 - never), it must be longer than CHOKE_TIME. Queued
+            requests are dropped on choke.
+
+        bad_ratio:
+            Share of blocks (0.0 - 1.0) sent with corrupted data.
+
+        host:
+            Address to listen on.
+
+    Methods:
+
+        start():
+            Accept connections in a background thread.
+
+    """
+
+    CHOKE_TIME = 1
+
+    MESSAGE_CHOKE = 0
+    MESSAGE_UNCHOKE = 1
+    MESSAGE_BITFIELD = 5
+    MESSAGE_REQUEST = 6
+    MESSAGE_PIECE = 7
+    MESSAGE_CANCEL = 8
+
+    def __init__(self, info_hash, data, piece_length,
+                 latency=0, rate=0, choke_interval=0, bad_ratio=0.0, host="127.0.0.1"):
+        self.bad_ratio = bad_ratio
+        self.choke_interval = choke_interval
+        self.data = data
+        self.id = hashlib.sha1(os.urandom(20)).digest()
+        self.info_hash = info_hash
+        self.latency = latency
+        self.piece_length = piece_length
+        self.rate = rate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((host, 0))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+
+    def start(self):
+        """Accept connections in a background thread."""
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            self._session(conn)
+        except socket.error:
+            pass
+        conn.close()
+
+    def _session(self, conn):
+        buf = ""
+        pstr_len = len(peer.Peer.PROTOCOL)
+        while len(buf) < pstr_len + 49:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return
+            buf += chunk
+        if buf[1+pstr_len+8:1+pstr_len+28] != self.info_hash:
+            return
+        buf = buf[pstr_len+49:]
+        piece_count = (len(self.data) + self.piece_length - 1) / self.piece_length
+        bitfield = bytearray((piece_count + 7) / 8)
+        for x in xrange(piece_count):
+            bitfield[x >> 3] |= 0x80 >> (x & 7)
+        conn.sendall("".join((
+            chr(pstr_len),
+            peer.Peer.PROTOCOL,
+            "\0" * 8,
+            self.info_hash,
+            self.id,
+            self._message(Seeder.MESSAGE_BITFIELD, str(bitfield)),
+            self._message(Seeder.MESSAGE_UNCHOKE)
+        )))
+
+        bucket = None
+        if self.rate:
+            # A block is sent at once, so the burst holds the longest one
+            bucket = scheduler.TokenBucket(self.rate, max(self.rate, torrent.Torrent.MAX_REQUEST_LENGTH))
+        choked = False
+        started_at = time.time()
+        # [(time to send, index, begin, length)]
+        queue = []
+        conn.setblocking(False)
+        while True:
+            now = time.time()
+            if self.choke_interval:
+                phase = (now - started_at) % self.choke_interval
+                should_choke = phase >= self.choke_interval - Seeder.CHOKE_TIME
+                if should_choke != choked:
+                    choked = should_choke
+                    if choked:
+                        queue = []
+                        conn.setblocking(True)
+                        conn.sendall(self._message(Seeder.MESSAGE_CHOKE))
+                    else:
+                        conn.setblocking(True)
+                        conn.sendall(self._message(Seeder.MESSAGE_UNCHOKE))
+                    conn.setblocking(False)
+
+            # Send answers which are due
+            while queue and queue[0][0] <= now:
+                _, index, begin, length = queue[0]
+                if bucket and bucket.allowance(length) < length:
+                    break
+                del queue[0]
+                if bucket:
+                    bucket.consume(length)
+                offset = index * self.piece_length + begin
+                block = self.data[offset:offset+length]
+                if self.bad_ratio and random.random() < self.bad_ratio:
+                    block = os.urandom(len(block))
+                conn.setblocking(True)
+                conn.sendall(self._message(
+                    Seeder.MESSAGE_PIECE,
+                    "".join((convert.uint_chr(index), convert.uint_chr(begin), block))
+                ))
+                conn.setblocking(False)
+
+            timeout = 0.05
+            if queue:
+                timeout = max(0.0, min(timeout, queue[0][0] - time.time()))
+            readable, _, _ = select.select([conn], [], [], timeout)
+            if not readable:
+                continue
+            chunk = conn.recv(1 << 16)
+            if not chunk:
+                return
+            buf += chunk
+            while len(buf) >= 4:
+                length = convert.uint_ord(buf[0:4])
+                if len(buf) < 4 + length:
+                    break
+                message = buf[4:4+length]
+                buf = buf[4+length:]
+                if not message:
+                    continue
+                message_id = ord(message[0])
+                if message_id == Seeder.MESSAGE_REQUEST and not choked:
+                    index = convert.uint_ord(message[1:5])
+                    begin = convert.uint_ord(message[5:9])
+                    length = convert.uint_ord(message[9:13])
+                    queue.append((time.time() + self.latency, index, begin, length))
+                elif message_id == Seeder.MESSAGE_CANCEL:
+                    request = (
+                        convert.uint_ord(message[1:5]),
+                        convert.uint_ord(message[5:9]),
+                        convert.uint_ord(message[9:13])
+                    )
+                    queue = [item for item in queue if item[1:] != request]
+
+    def _message(self, message_id, payload=""):
+        return "".join((convert.uint_chr(len(payload) + 1), chr(message_id), payload))
+
+
+def _swarm(options, path, conn):
+    """Child process: generate the torrent, start the tracker stub
+    and the seeders, send (torrent path, seed path) to conn and
+    serve until the parent closes conn.
+
+    """
+    piece_length = options.piece_length * 1024
+    seeders = []
+    # Seeders need the tracker URL in .torrent and the tracker needs
+    # the seeders addresses, so seeders are made first
+    for x in xrange(options.seeders):
+        s = Seeder(
+            "",
+            "",
+            piece_length,
+            latency=options.latency / 1000.0,
+            rate=options.rate * 1024,
+            choke_interval=options.choke_interval,
+            bad_ratio=options.bad_ratio / 100.0 if x < options.bad_seeders else 0.0,
+            # Every seeder is a separate host, so bans are per seeder
+            host="127.0.0.%d" % (x + 2)
+        )
+        seeders.append(s)
+    stub = TrackerStub([s.address for s in seeders])
+    stub.start()
+    torrent_path, seed_path = make_torrent(
+        path,
+        options.size * 1024 * 1024,
+        piece_length,
+        options.files,
+        stub.url()
+    )
+    meta, info_hash = torrent.read_meta(torrent_path)
+    info = meta["info"]
+    if "files" in info:
+        paths = [os.path.join(seed_path, info["name"], *f["path"]) for f in info["files"]]
+    else:
+        paths = [os.path.join(seed_path, info["name"])]
+    # Pieces run over files in the order of the .torrent
+    data = []
+    for file_path in paths:
+        with open(file_path, "rb") as f:
+            data.append(f.read())
+    data = "".join(data)
+    for s in seeders:
+        s.info_hash = info_hash
+        s.data = data
+        s.start()
+    conn.send((torrent_path, seed_path))
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+
+
+def run(options):
+    """Run a simulation and return the report dict."""
+    path = tempfile.mkdtemp(prefix="cbt-swarm-")
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_swarm, args=(options, path, child_conn))
+    process.daemon = True
+    process.start()
+    try:
+        torrent_path, seed_path = parent_conn.recv()
+        return _download(options, path, torrent_path, seed_path)
+    finally:
+        parent_conn.close()
+        process.terminate()
+        process.join()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _download(options, path, torrent_path, seed_path):
+    # Sockets are bound to loopback and nothing is written to ~/.cbt.
+    # DHT is never bootstrapped, so its routing table stays empty
+    # and it sends nothing.
+    tracker.health = tracker.Health(os.path.join(path, "trackers"))
+    if torrent.Torrent.listener is None:
+        torrent.Torrent.listener = listener.Listener(0, "127.0.0.1")
+        torrent.Torrent.listener.on_handshake(torrent.accept)
+        torrent.Torrent.port = torrent.Torrent.listener.address[1]
+    if not torrent.Torrent.udp:
+        torrent.Torrent.udp = udp.Socket(0, "127.0.0.1")
+        torrent.Torrent.dht = dht.DHT(torrent.Torrent.udp)
+    download_path = os.path.join(path, "download")
+    os.makedirs(download_path)
+
+    torrent.session.memory.limit = options.memory * 1024
+    cpu_started = sum(os.times()[:2])
+    started_at = time.time()
+    t = torrent.Torrent(torrent_path, download_path)
+    if options.stream:
+        t.downloader.stream()
+    if options.skip:
+        t.set_file_priorities([
+            file.File.PRIORITY_SKIP if x % options.skip == options.skip - 1
+            else file.File.PRIORITY_NORMAL
+            for x in xrange(len(t.writer.files))
+        ])
+    t.start()
+    total = t.downloader.total()
+    completed = False
+    try:
+        while time.time() - started_at < options.timeout:
+            busy = torrent.session.message()
+            if torrent.Torrent.listener.message():
+                busy = True
+            if t.downloader.progress() == 1.0:
+                completed = True
+                break
+            if not busy:
+                time.sleep(0.001)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.time() - started_at
+    cpu = sum(os.times()[:2]) - cpu_started
+    torrent.collected.remove(t)
+    torrent.session.remove(t)
+    for n in t.peer.nodes:
+        if n.conn:
+            n.close()
+
+    return {
+        "completed": completed,
+        "seconds": elapsed,
+        "size": total,
+        "speed": t.downloader.verified() / elapsed / 1024 / 1024,
+        "cpu": cpu,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "downloaded": t.downloader.downloaded(),
+        "verified": t.downloader.verified(),
+        "banned": len(t.peer.banned),
+        "memory_peak": torrent.session.memory.peak,
+        "valid": completed and _same_files(seed_path, t.download_path, t.meta, t.writer.files)
+    }
+
+
+def _same_files(seed_path, download_path, meta, files):
+    """Compare downloaded files with seeded ones. Skipped files
+    must not exist.
+
+    """
+    if "files" not in meta["info"]:
+        seed_path = os.path.join(seed_path, meta["info"]["name"])
+        download_path = os.path.join(download_path, meta["info"]["name"])
+        paths = [(seed_path, download_path)]
+    else:
+        paths = []
+        for f in meta["info"]["files"]:
+            paths.append((
+                os.path.join(seed_path, meta["info"]["name"], *f["path"]),
+                os.path.join(download_path, *f["path"])
+            ))
+    for (a, b), f in zip(paths, files):
+        if f.priority == file.File.PRIORITY_SKIP:
+            if os.path.exists(b):
+                return False
+            continue
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            if hashlib.sha1(fa.read()).digest() != hashlib.sha1(fb.read()).digest():
+                return False
+    return True
+
+
+def main(argv):
+    try:
+        opts, argv = getopt.gnu_getopt(argv, "", OPTIONS)
+        opts = dict((name[2:], value) for name, value in opts)
+        kwargs = {}
+        for name, value in opts.iteritems():
+            if name in ("json", "min-speed"):
+                continue
+            key = name.replace("-", "_")
+            kwargs[key] = int(value)
+        options = Options(**kwargs)
+        min_speed = float(opts.get("min-speed", 0))
+    except (getopt.GetoptError, ValueError, TypeError):
+        print __doc__
+        return 2
+
+    report = run(options)
+    if "json" in opts:
+        print json.dumps(report, sort_keys=True)
+    else:
+        print "[%s] [%.1f MB in %.2f s] [%.2f MB/s] [CPU: %.2f s] [Peak RSS: %.1f MB]" % (
+            "Completed" if report["completed"] else "Timed out",
+            report["size"] / 1024.0 / 1024,
+            report["seconds"],
+            report["speed"],
+            report["cpu"],
+            report["peak_rss"]
+        )
+        print "[Downloaded: %d B] [Verified: %d B] [Peak memory: %d KB] [Banned: %d] [Files are valid: %s]" % (
+            report["downloaded"],
+            report["verified"],
+            report["memory_peak"] / 1024,
+            report["banned"],
+            report["valid"]
+        )
+    if not report["completed"] or not report["valid"] or report["speed"] < min_speed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+"""
+Timers of the main loop.
+
+A hierarchical timer wheel (as in the Linux kernel) calls functions
+after a delay or periodically. Adding and cancelling a timer take
+O(1) and every tick touches one slot, so timers of thousands of
+peers cost nothing while they wait. Timers of the session are on
+the shared wheel that the session scheduler advances every loop
+iteration:
+
+    job = timer.wheel.call_every(10, func, arg)
+    ...
+    job.cancel()
+
+The wheel runs on a monotonic clock, so timers don't go mad when
+the system time changes. The time is read once per tick and cached
+in wheel.now for the code that runs in that iteration.
+
+Functions:
+
+    clock():
+        Return seconds of the monotonic clock.
+
+"""
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+__all__ = ["Timer", "Wheel", "clock", "wheel"]
+
+
+def _monotonic():
+    """Return clock_gettime(CLOCK_MONOTONIC) as a function
+    or None if it's not available.
+
+    """
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    name = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+    if os.name != "posix" or not name:
+        return None
+    try:
+        clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return None
+    ts = timespec()
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+clock = _monotonic() or time.time
+
+
+class Timer(object):
+    """A function call planned by Wheel.
+
+    Attributes:
+
+        active:
+            False when the timer has expired (if it's not periodic)
+            or was cancelled.
+
+        interval:
+            Period in seconds of a periodic timer or None.
+
+    Methods:
+
+        cancel():
+            Don't call the function any more.
+
+    """
+
+    __slots__ = ("active", "args", "expires", "func", "interval")
+
+    def __init__(self, expires, func, args, interval):
+        self.active = True
+        self.args = args
+        self.expires = expires
+        self.func = func
+        self.interval = interval
+
+    def cancel(self):
+        """Don't call the function any more."""
+        self.active = False
+
+
+class Wheel(object):
+    """Hierarchical timer wheel. Time is counted in ticks of TICK
+    seconds. There are LEVELS wheels of SLOTS slots, a slot of the
+    first wheel holds timers of one tick, a slot of every next one
+    holds timers of a whole turn of the previous wheel. When the
+    previous wheel completes a turn, the timers of the next slot
+    are spread over it. Timers farther than all wheels wait in the
+    last slot and are spread again. Cancelled timers are dropped
+    when their slot comes.
+
+    Timers expire in the first tick after their time, so they are
+    late by TICK seconds at most.
+
+    Attributes:
+
+        now:
+            Time of the clock at the current tick.
+
+    Methods:
+
+        call_later(delay, func=None, *args):
+            Call func(*args) in delay seconds. Return a Timer.
+            Without func the timer just turns inactive then.
+
+        call_every(interval, func, *args):
+            Call func(*args) every interval seconds. Return a Timer.
+
+        message():
+            You have to call this method in a loop. It reads the
+            clock and calls the expired timers. Return True if any
+            timer expired.
+
+    """
+
+    LEVELS = 4
+    SLOTS = 64
+    TICK = 0.05
+
+    def __init__(self):
+        self.now = clock()
+        self._bits = Wheel.SLOTS.bit_length() - 1
+        self._mask = Wheel.SLOTS - 1
+        self._started_at = self.now
+        self._tick = 0
+        self._wheels = [
+            [[] for _ in xrange(Wheel.SLOTS)]
+            for _ in xrange(Wheel.LEVELS)
+        ]
+
+    def call_later(self, delay, func=None, *args):
+        """Call func(*args) in delay seconds. Return a Timer.
+        Without func the timer just turns inactive then.
+
+        """
+        t = Timer(self._expires(delay), func, args, None)
+        self._add(t)
+        return t
+
+    def call_every(self, interval, func, *args):
+        """Call func(*args) every interval seconds. Return a Timer."""
+        t = Timer(self._expires(interval), func, args, interval)
+        self._add(t)
+        return t
+
+    def message(self):
+        """You have to call this method in a loop. It reads the clock
+        and calls the expired timers. Return True if any timer expired.
+
+        """
+        self.now = clock()
+        target = int((self.now - self._started_at) / Wheel.TICK)
+        result = False
+        while self._tick < target:
+            self._tick += 1
+            # Spread the next slots of upper wheels which turns come
+            for level in xrange(1, Wheel.LEVELS):
+                if self._tick & ((1 << (self._bits * level)) - 1):
+                    break
+                index = (self._tick >> (self._bits * level)) & self._mask
+                slot = self._wheels[level][index]
+                self._wheels[level][index] = []
+                for t in slot:
+                    if t.active:
+                        self._add(t)
+            index = self._tick & self._mask
+            slot = self._wheels[0][index]
+            if not slot:
+                continue
+            self._wheels[0][index] = []
+            for t in slot:
+                if not t.active:
+                    continue
+                result = True
+                if t.interval is None:
+                    t.active = False
+                else:
+                    t.expires = self._expires(t.interval)
+                    self._add(t)
+                if t.func:
+                    t.func(*t.args)
+        return result
+
+    def _expires(self, delay):
+        """Return the first tick after delay seconds from now."""
+        return max(int((self.now - self._started_at + delay) / Wheel.TICK) + 1, self._tick + 1)
+
+    def _add(self, t):
+        """Put the timer into the slot of its tick."""
+        expires = t.expires
+        ticks = expires - self._tick
+        level = 0
+        while level < Wheel.LEVELS - 1 and ticks >> (self._bits * (level + 1)):
+            level += 1
+        if ticks >> (self._bits * Wheel.LEVELS):
+            # Farther than all wheels, wait in the farthest slot
+            expires = self._tick + (1 << (self._bits * Wheel.LEVELS)) - 1
+        index = (expires >> (self._bits * level)) & self._mask
+        self._wheels[level][index].append(t)
+
+
+wheel = Wheel()
@@ -1,32 +1,51 @@
+import array
 import hashlib
-import math
 import os
 import socket
+import threading
 import time
 
 import bcode
+import bitfield
+import choker
 import convert
+import dht
 import downloader
 import file
+import listener
+import metrics
 import node
 import piece
 import peer
+import pex
+import profiler
+import recorder
+import scheduler
+import scorer
+import storage
+import timer
 import tracker
+import udp
+import utp
 import version
 import writer
 
 collected = []
+metrics_path = None
+session = scheduler.Scheduler()
 
 
 def collect(cls):
     """Decorator that collect all created Torrent objects
     to call their message() methods in main loop.
+    Collected torrents are added to the session scheduler.
 
     """
     class Collector(cls):
         def __init__(self, *args, **kwargs):
             super(Collector, self).__init__(*args, **kwargs)
             collected.append(self)
+            session.add(self)
     return Collector
 
 
@@ -67,24 +86,83 @@ def gen_port(start=6881, end=6890):
     raise socket.error("Unable to listen any BitTorrent port")
 
 
+def read_meta(torrent_path):
+    """Load a .torrent file. Return a tuple (meta, info-hash).
+    Raise IOError if the file can't be read or decoded.
+
+    """
+    with open(torrent_path, "rb") as f:
+        meta = bcode.decode(f.read())
+    if not isinstance(meta, dict) or "info" not in meta:
+        raise IOError("Invalid .torrent file")
+    hash = hashlib.sha1(bcode.encode(meta["info"])).digest()
+    return meta, hash
+
+
+def tracker_urls(meta):
+    """Return a list of all tracker URLs of the torrent."""
+    trackers = []
+    if "announce" in meta:
+        trackers.append(meta["announce"])
+    if "announce-list" in meta:
+        for item in meta["announce-list"]:
+            trackers.append(item[0])
+    return trackers
+
+
+def accept(info_hash, conn, address, data):
+    """Give an incoming connection to the torrent with info_hash.
+    Return False if there is no such active torrent or it's full.
+
+    """
+    for t in session.active():
+        if t.hash == info_hash:
+            return t.peer.append_incoming_node(conn, address, data)
+    return False
+
+
+def message():
+    """Run one iteration of the session: all active torrents,
+    incoming connections and DHT. Return False if there is nothing to do.
+
+    """
+    busy = session.message()
+    if Torrent.listener and Torrent.listener.message():
+        busy = True
+    if Torrent.udp:
+        if Torrent.udp.message():
+            busy = True
+        if Torrent.utp and Torrent.utp.message():
+            busy = True
+        Torrent.dht.message()
+    return busy
+
+
+def show_progress():
+    """Print status of all active torrents."""
+    for obj in session.active():
+        print obj
+    if profiler.enabled:
+        print profiler.to_string()
+
+
 def main_loop():
     SHOW_PROGRESS_EVERY = 2
+    EXPORT_METRICS_EVERY = 10
 
-    ts = time.time()
+    jobs = [timer.wheel.call_every(SHOW_PROGRESS_EVERY, show_progress)]
+    if metrics_path:
+        jobs.append(timer.wheel.call_every(EXPORT_METRICS_EVERY, metrics.export, metrics_path))
     try:
         while True:
-            wait = True
-            for obj in collected:
-                result = obj.message()
-                if not result:
-                    wait = True
-                if time.time() - ts >= SHOW_PROGRESS_EVERY:
-                    print obj
-                    ts = time.time()
-            if wait:
+            if not message():
                 time.sleep(0.001)
     except KeyboardInterrupt:
         pass
+    for job in jobs:
+        job.cancel()
+    if metrics_path:
+        metrics.export(metrics_path)
 
 
 @collect
@@ -98,44 +176,77 @@ class Torrent(object):
     MESSAGE_REQUEST = 6
     MESSAGE_PIECE = 7
     MESSAGE_CANCEL = 8
-
-    RECONNECT_AFTER = 30
-
+    MESSAGE_SUGGEST = 13
+    MESSAGE_HAVE_ALL = 14
+    MESSAGE_HAVE_NONE = 15
+    MESSAGE_REJECT = 16
+    MESSAGE_ALLOWED_FAST = 17
+    MESSAGE_EXTENDED = 20
+
+    EXTENDED_HANDSHAKE = 0
+    EXTENSIONS = {pex.PEX.NAME: 1}
+    RESERVED_EXTENSION_PROTOCOL = (5, 0x10)
+    RESERVED_FAST = (7, 0x04)
+
+    CHECK_PEERS_EVERY = 1
+    MAX_REQUEST_LENGTH = 1 << 17
+
+    dht = None
     id = None
+    listener = None
     port = None
+    udp = None
+    utp = None
 
     def __init__(self, torrent_path, download_path):
         if not Torrent.id:
             Torrent.id = gen_id()
         if not Torrent.port:
             Torrent.port = gen_port()
+        if Torrent.listener is None:
+            Torrent.listener = listener.Listener(Torrent.port)
+            Torrent.listener.on_handshake(accept)
+        if not Torrent.udp:
+            Torrent.udp = udp.Socket(Torrent.port)
+            Torrent.utp = utp.Transport(Torrent.udp)
+            Torrent.utp.on_accept(Torrent.listener.add)
+            Torrent.dht = dht.DHT(Torrent.udp, cache_path=storage.path("dht"))
+            Torrent.dht.bootstrap()
 
         # Attributes declaration
+        self.choker = choker.Choker()
         self.download_path = download_path
         self.downloader = None
         self.hash = ""
         self.meta = {}
         self.peer = peer.Peer()
-        self.pieces = []
+        self.pex = pex.PEX()
+        self.pieces = None
+        self.scorer = scorer.Scorer()
         self.torrent_path = torrent_path
         self.tracker = None
         self.writer = writer.Writer()
+        self._announced = []
+        self._jobs = []
+        self._partial = None
+        self._tracker_urls = None
 
         # Load meta data from .torrent
-        with open(self.torrent_path, "rb") as f:
-            self.meta = bcode.decode(f.read())
-        self.hash = hashlib.sha1(bcode.encode(self.meta["info"])).digest()
+        self.meta, self.hash = read_meta(self.torrent_path)
+        if recorder.enabled:
+            recorder.meta(self.meta["info"])
 
         # Load pieces info
-        piece_count = len(self.meta["info"]["pieces"]) / 20
         piece_length = self.meta["info"]["piece length"]
-        for x in xrange(piece_count):
-            hash = self.meta["info"]["pieces"][x*20:x*20+20]
-            p = piece.Piece(hash, piece_length, len(self.pieces))
-            self.pieces.append(p)
+        if "files" in self.meta["info"]:
+            total = sum(f["length"] for f in self.meta["info"]["files"])
+        else:
+            total = self.meta["info"]["length"]
+        self.pieces = piece.PieceList(self.meta["info"]["pieces"], piece_length, total)
 
         # Init downloader
         self.downloader = downloader.Downloader(self.peer.nodes, self.pieces)
+        self.downloader.memory = session.memory
 
         # Load files info
         # Multifile mode
@@ -163,67 +274,275 @@ class Torrent(object):
             )
             self.writer.append_file(f)
 
-        # Load trackers list and select available
-        trackers = []
-        if "announce" in self.meta:
-            trackers.append(self.meta["announce"])
-        if "announce-list" in self.meta:
-            for item in self.meta["announce-list"]:
-                trackers.append(item[0])
-        self.tracker = tracker.get(trackers)
+        # Load trackers list, the available one is selected by start()
+        self._tracker_urls = tracker_urls(self.meta)
+
+        # Metrics labels
+        name = self.torrent_path.split(os.sep)[-1]
+        self.downloader.label = name
+        self.peer.label = name
+        self.writer.label = name
+        if metrics.enabled:
+            metrics.on_collect(self.collect_metrics)
 
         # Events handlers
+        self.peer.on_connect(self.send_message_handshake)
         self.peer.on_recv(self.handle_message)
         self.peer.on_recv_handshake(self.handle_message_handshake)
+        Torrent.dht.event_connect("peers", self.on_dht_peers)
         self.downloader.event_connect("piece", self.on_piece)
         self.downloader.event_connect("cancel", self.on_cancel)
+        self.downloader.event_connect("ban", self.on_ban)
 
     def __str__(self):
         return self._to_string()
 
-    def start(self):
+    def start(self, background=False):
+        """Announce the torrent and connect peers. With background
+        flag start() doesn't wait for trackers and peers: trackers are
+        probed and announced in a thread, peers of the response are
+        connected by the main loop.
+
+        """
         self.writer.create_files()
-        response = self.tracker.request(
-            hash=self.hash,
-            id=Torrent.id,
-            port=Torrent.port,
-            uploaded=0,
-            downloaded=0,
-            left=0,
-            event="started"
-        )
-        if type(response["peers"]) is str:
-            for x in xrange(0, len(response["peers"]), 6):
-                ip = ".".join((str(ord(byte)) for byte in response["peers"][x:x+4]))
-                port = convert.uint_ord(response["peers"][x+4:x+6])
-                self.peer.append_node(ip, port)
-        self.peer.connect_all()
+        Torrent.dht.get_peers(self.hash, Torrent.port)
+        if background:
+            def announce():
+                self._announced.append(self._announce("started"))
+
+            thread = threading.Thread(target=announce)
+            thread.daemon = True
+            thread.start()
+        else:
+            self.handle_tracker_response(self._announce("started"))
+        self.peer.connect_all(background)
         for n in self.peer.nodes:
             self.send_message_handshake(n)
-
-    def stop(self):
-        self.tracker.request(
-            hash=self.hash,
-            id=Torrent.id,
-            port=Torrent.port,
-            uploaded=0,
-            downloaded=0,
-            left=0,
-            event="stopped"
-        )
+        self._jobs.append(timer.wheel.call_every(Torrent.CHECK_PEERS_EVERY, self.check_peers))
+
+    def stop(self, background=False):
+        """Cancel jobs, drop requests and announce that the torrent is
+        stopped. With background flag the tracker request is sent in
+        a thread.
+
+        """
+        for job in self._jobs:
+            job.cancel()
+        self._jobs = []
+        self.downloader.close()
+        # Nothing was announced if no tracker is selected yet
+        if not self.tracker:
+            return
+        if background:
+            thread = threading.Thread(target=self._announce, args=("stopped",))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._announce("stopped")
+
+    def pause(self, background=False):
+        """Disconnect all peers and stop until resume()."""
+        session.pause(self)
+        self.peer.disconnect_all()
+        self.stop(background)
+
+    def resume(self, background=False):
+        """Connect peers again and go on after pause()."""
+        session.resume(self)
+        self.start(background)
+
+    def close(self, background=False):
+        """Stop the torrent and remove it from the session for good."""
+        session.remove(self)
+        if self in collected:
+            collected.remove(self)
+        self.peer.disconnect_all()
+        self.stop(background)
+        Torrent.dht.event_disconnect("peers", self.on_dht_peers)
+        if metrics.enabled:
+            metrics.off_collect(self.collect_metrics)
+            metrics.remove(torrent=self.peer.label)
+
+    def set_file_priorities(self, priorities):
+        """Set priorities (file.File.PRIORITY_*) of files in the order
+        of the torrent. A piece gets the highest priority of the files
+        it belongs to. Skipped files are not created, pieces shared
+        with them are not uploaded because they're stored partly.
+
+        """
+        pieces_priority = array.array("B", [file.File.PRIORITY_SKIP]) * len(self.pieces)
+        for f, priority in zip(self.writer.files, priorities):
+            if f.priority == file.File.PRIORITY_SKIP and priority != f.priority:
+                # Edge pieces were written without the part of this file
+                first, last = self._file_pieces(f)
+                for index in xrange(first, last + 1):
+                    self.downloader.forget(index)
+                if self.writer.files_created:
+                    f.create()
+            f.priority = priority
+        self._partial = None
+        # Higher priorities are set later and win on shared pieces
+        for f in sorted(self.writer.files, key=lambda f: f.priority):
+            if not f.size:
+                continue
+            first, last = self._file_pieces(f)
+            if f.priority == file.File.PRIORITY_SKIP:
+                if self._partial is None:
+                    self._partial = bitfield.Bitfield(len(self.pieces))
+                for index in xrange(first, last + 1):
+                    self._partial.set(index)
+                continue
+            count = last - first + 1
+            pieces_priority[first:last+1] = array.array("B", [f.priority]) * count
+        self.downloader.set_priorities(pieces_priority)
+        for n in self.peer.nodes:
+            self.update_interest(n)
+
+    def read(self, offset, length, timeout=None):
+        """Return length bytes of the torrent from offset as soon as
+        their pieces are verified. Streaming mode is switched on with
+        the cursor at offset, so the pieces are downloaded first.
+        The session runs until the data is ready, so this must be
+        called from the thread of the main loop instead of it.
+        Raise IOError on timeout.
+
+        """
+        length = max(0, min(length, self.pieces.total - offset))
+        if not length:
+            return ""
+        if self.writer.skipped(offset, length):
+            raise IOError("Reading of a skipped file")
+        first = offset / self.pieces.piece_length
+        last = (offset + length - 1) / self.pieces.piece_length
+        self.downloader.stream(first)
+        started_at = time.time()
+        for index in xrange(first, last + 1):
+            while not self.downloader.have(index):
+                if timeout is not None and time.time() - started_at > timeout:
+                    raise IOError("Timeout of reading piece %d" % index)
+                if not message():
+                    time.sleep(0.001)
+        return self.writer.read(offset, length)
+
+    def stats(self):
+        """Return a dict of torrent state for reports."""
+        requested_nodes, all_nodes = self.downloader.nodes_count()
+        return {
+            "name": self.torrent_path.split(os.sep)[-1],
+            "hash": self.hash,
+            "progress": self.downloader.progress(),
+            "downloaded": self.downloader.downloaded(),
+            "verified": self.downloader.verified(),
+            "total": self.downloader.total(),
+            "memory": self.downloader.reserved(),
+            "requested_peers": requested_nodes,
+            "peers": all_nodes
+        }
+
+    def collect_metrics(self):
+        """Update gauges of the torrent before metrics export."""
+        name = self.peer.label
+        outbox = 0
+        inbox = 0
+        for n in self.peer.nodes:
+            inbox += n.inbox.length
+            for chunk in n.outbox:
+                if type(chunk) is str:
+                    outbox += len(chunk)
+        requested_nodes, all_nodes = self.downloader.nodes_count()
+        values = {
+            "cbt_peers": (all_nodes, "Connected peers"),
+            "cbt_peers_requested": (requested_nodes, "Peers with requests in flight"),
+            "cbt_peers_potential": (self.peer.registry.candidates(), "Peers waiting for connection"),
+            "cbt_peers_known": (len(self.peer.registry), "Known peers"),
+            "cbt_requests_in_flight": (self.downloader.requests_count(), "Chunk requests in flight"),
+            "cbt_active_pieces": (self.downloader.active_count(), "Pieces being downloaded"),
+            "cbt_memory_reserved_bytes": (self.downloader.reserved(), "Memory reserved for piece data"),
+            "cbt_outbox_bytes": (outbox, "Bytes queued for sending"),
+            "cbt_inbox_bytes": (inbox, "Bytes received but not handled"),
+            "cbt_verified_bytes": (self.downloader.verified(), "Bytes that passed SHA1 check"),
+            "cbt_progress_ratio": (self.downloader.progress(), "Downloaded pieces ratio")
+        }
+        for key, (value, help) in values.iteritems():
+            metrics.gauge(key, help, torrent=name).set(value)
 
     def message(self):
-        self.peer.message()
-        self.downloader.message()
+        """Return False if there is nothing to do."""
+        # Responses of trackers announced in background
+        while self._announced:
+            self.handle_tracker_response(self._announced.pop(0))
+        result = self.peer.message()
+        if profiler.enabled:
+            profiler.begin("schedule")
+        # Overdue chunks go to other peers too
+        if self.downloader.message():
+            self.download_chunks()
+        # All wanted pieces are done, skipped ones are never downloaded
+        seeding = self.downloader.progress() == 1.0
+        choke, unchoke = self.choker.message(self.peer.nodes, seeding)
+        for n in choke:
+            self.send_message_choke(n)
+        for n in unchoke:
+            self.send_message_unchoke(n)
+        if choke or unchoke:
+            for n in self.peer.nodes:
+                self.update_interest(n)
+        for n, payload in self.pex.updates(self.peer.nodes):
+            self.send_message_extended(n, n.extensions[pex.PEX.NAME], payload)
+        if profiler.enabled:
+            profiler.end()
+        return result
+
+    def check_peers(self):
+        """Release requests of snubbed peers and disconnect the peers
+        the scorer drops. It's called every CHECK_PEERS_EVERY seconds.
+
+        """
+        released = False
+        for n in self.scorer.snubbed(self.peer.nodes):
+            # Its chunks go to other peers
+            if self.downloader.release(n):
+                released = True
+        for n in self.scorer.message(self.peer.nodes, self.peer.registry.candidates()):
+            if self.downloader.release(n):
+                released = True
+            if n.conn:
+                n.close()
+        if released:
+            self.download_chunks()
+
+    def handle_tracker_response(self, response):
+        """Add peers of the tracker response to the peers list."""
+        if recorder.enabled:
+            recorder.tracker(response)
+        if isinstance(response, dict) and type(response.get("peers")) is str:
+            for ip, port in dht.decode_peers(response["peers"]):
+                self.peer.append_node(ip, port)
 
     def download_chunks(self):
+        if profiler.enabled:
+            profiler.begin("schedule")
         for request in self.downloader.next():
-            if request.node.p_choke == node.Node.TRUE:
-                self.send_message_unchoke(request.node)
+            if not request.node.c_interested:
                 self.send_message_interested(request.node)
-                request.node.wait_for_unchoke()
-                request.node.p_choke = node.Node.WAITING
-            self.send_message_request(request.node, request.piece, request.chunk * piece.Piece.CHUNK, piece.Piece.CHUNK)
+            begin = request.chunk * piece.Piece.CHUNK
+            length = min(piece.Piece.CHUNK, self.pieces.size(request.piece) - begin)
+            self.send_message_request(request.node, request.piece, begin, length)
+        if profiler.enabled:
+            profiler.end()
+
+    def update_interest(self, n):
+        """Send INTERESTED or NOT_INTERESTED if the peer has or
+        doesn't have pieces that we need anymore.
+
+        """
+        if not n.handshaked or not n.conn:
+            return
+        wanted = n.active > 0 or self.downloader.interesting(n) > 0
+        if wanted and not n.c_interested:
+            self.send_message_interested(n)
+        elif not wanted and n.c_interested:
+            self.send_message_notinterested(n)
 
     def handle_message(self, n, buf):
         if not n.handshaked:
@@ -249,8 +568,20 @@ class Torrent(object):
             self.handle_message_have(n, buf[5:])
         elif m_type == Torrent.MESSAGE_BITFIELD:
             self.handle_message_bitfield(n, buf[5:])
+        elif m_type == Torrent.MESSAGE_REQUEST:
+            self.handle_message_request(n, buf[5:])
         elif m_type == Torrent.MESSAGE_PIECE:
             self.handle_message_piece(n, buf[5:])
+        elif m_type == Torrent.MESSAGE_HAVE_ALL and n.fast:
+            self.handle_message_have_all(n)
+        elif m_type == Torrent.MESSAGE_HAVE_NONE and n.fast:
+            self.handle_message_have_none(n)
+        elif m_type == Torrent.MESSAGE_REJECT and n.fast:
+            self.handle_message_reject(n, buf[5:])
+        elif m_type == Torrent.MESSAGE_ALLOWED_FAST and n.fast:
+            self.handle_message_allowed_fast(n, buf[5:])
+        elif m_type == Torrent.MESSAGE_EXTENDED:
+            self.handle_message_extended(n, buf[5:])
 
     def handle_message_handshake(self, n, buf):
         if n.handshaked:
@@ -267,12 +598,22 @@ class Torrent(object):
             return
         n.id = buf[29+pstr_len:49+pstr_len]
         n.handshaked = True
+        reserved = buf[1+pstr_len:9+pstr_len]
+        byte, mask = Torrent.RESERVED_FAST
+        n.fast = bool(ord(reserved[byte]) & mask)
+        self.send_message_bitfield(n)
+        byte, mask = Torrent.RESERVED_EXTENSION_PROTOCOL
+        if ord(reserved[byte]) & mask:
+            self.send_message_extended_handshake(n)
 
     def handle_message_choke(self, n):
         n.p_choke = node.Node.TRUE
+        if self.downloader.choke(n):
+            self.download_chunks()
 
     def handle_message_unchoke(self, n):
         n.p_choke = node.Node.FALSE
+        self.download_chunks()
 
     def handle_message_interested(self, n):
         n.p_interested = True
@@ -282,46 +623,165 @@ class Torrent(object):
 
     def handle_message_have(self, n, buf):
         index = convert.uint_ord(buf[0:4])
+        if index >= len(self.pieces):
+            n.errors += 1
+            return
         n.set_piece(index)
+        self.update_interest(n)
         self.download_chunks()
 
     def handle_message_bitfield(self, n, buf):
-        n.bitfield = []
-        for byte in buf:
-            mask = 0x80
-            byte = ord(byte)
-            for x in xrange(8):
-                bit = bool(byte & mask)
-                mask >>= 1
-                n.bitfield.append(bit)
+        if len(buf) != (len(self.pieces) + 7) / 8:
+            n.errors += 1
+        n.bitfield = bitfield.Bitfield.from_bytes(buf)
+        self.update_interest(n)
+        self.download_chunks()
+
+    def handle_message_have_all(self, n):
+        n.have_all = True
+        self.update_interest(n)
         self.download_chunks()
 
+    def handle_message_have_none(self, n):
+        n.have_all = False
+        n.bitfield = bitfield.Bitfield()
+
+    def handle_message_reject(self, n, buf):
+        index = convert.uint_ord(buf[0:4])
+        begin = convert.uint_ord(buf[4:8])
+        chunk = int(begin / piece.Piece.CHUNK)
+        if self.downloader.reject(n, index, chunk):
+            self.download_chunks()
+
+    def handle_message_allowed_fast(self, n, buf):
+        index = convert.uint_ord(buf[0:4])
+        n.allowed_fast.add(index)
+        if n.get_piece(index):
+            self.download_chunks()
+
+    def handle_message_request(self, n, buf):
+        index = convert.uint_ord(buf[0:4])
+        begin = convert.uint_ord(buf[4:8])
+        length = convert.uint_ord(buf[8:12])
+        piece_length = self.meta["info"]["piece length"]
+        if (
+            index >= len(self.pieces)
+            or length > Torrent.MAX_REQUEST_LENGTH
+            or begin + length > self.pieces.size(index)
+        ):
+            n.errors += 1
+        if (
+            n.c_choke
+            or not self._can_upload(index)
+            or length > Torrent.MAX_REQUEST_LENGTH
+            or begin + length > self.pieces.size(index)
+        ):
+            # Fast peers are told at once, others just don't get it
+            if n.fast:
+                self.send_message_reject(n, index, begin, length)
+            return
+        data = self.writer.read(index * piece_length + begin, length)
+        self.send_message_piece(n, index, begin, data)
+
     def handle_message_piece(self, n, buf):
         index = convert.uint_ord(buf[0:4])
         begin = convert.uint_ord(buf[4:8])
         chunk = int(begin / piece.Piece.CHUNK)
         data = buf[8:]
+        if (
+            index >= len(self.pieces)
+            or begin % piece.Piece.CHUNK
+            or begin + len(data) > self.pieces.size(index)
+        ):
+            n.errors += 1
+            return
+        n.downloaded += len(data)
+        n.last_piece = time.time()
+        n.snubbed = False
         self.downloader.finish(n, index, chunk, data)
         self.download_chunks()
 
+    def handle_message_extended(self, n, buf):
+        if not buf:
+            return
+        ext_id = ord(buf[0])
+        payload = buf[1:]
+        if ext_id == Torrent.EXTENDED_HANDSHAKE:
+            try:
+                msg = bcode.decode(payload)
+            except (IOError, ValueError):
+                n.errors += 1
+                return
+            if not isinstance(msg, dict):
+                n.errors += 1
+                return
+            if isinstance(msg.get("m"), dict):
+                n.extensions = {}
+                for name, value in msg["m"].iteritems():
+                    if type(value) is int and 0 < value < 256:
+                        n.extensions[name] = value
+            if type(msg.get("p")) is int and 0 < msg["p"] < 0x10000:
+                n.listen_port = msg["p"]
+        elif ext_id == Torrent.EXTENSIONS[pex.PEX.NAME]:
+            for ip, port in self.pex.parse(n, payload):
+                self.peer.append_potential_node(ip, port)
+
+    def on_dht_peers(self, info_hash, peers):
+        if info_hash != self.hash:
+            return
+        for ip, port in peers:
+            self.peer.append_potential_node(ip, port)
+
     def on_piece(self, n, index, data):
-        self.writer.write(index * len(data), data)
+        self.writer.write(index * self.meta["info"]["piece length"], data)
+        can_upload = self._can_upload(index)
+        for other in self.peer.nodes:
+            if other.handshaked and other.conn:
+                if can_upload:
+                    self.send_message_have(other, index)
+                self.update_interest(other)
+
+    def on_ban(self, n):
+        self.downloader.release(n)
+        self.peer.ban(n)
 
     def on_cancel(self, n, index, chunk):
         if n in self.peer.nodes:
-            self.send_message_cancel(n, index, chunk * piece.Piece.CHUNK, piece.Piece.CHUNK)
+            begin = chunk * piece.Piece.CHUNK
+            length = min(piece.Piece.CHUNK, self.pieces.size(index) - begin)
+            self.send_message_cancel(n, index, begin, length)
         self.download_chunks()
 
     def send_message_handshake(self, n):
+        reserved = [0] * 8
+        for byte, mask in (Torrent.RESERVED_EXTENSION_PROTOCOL, Torrent.RESERVED_FAST):
+            reserved[byte] |= mask
+        reserved = [chr(byte) for byte in reserved]
         buf = "".join((
             chr(len(peer.Peer.PROTOCOL)),
             peer.Peer.PROTOCOL,
-            convert.uint_chr(0, 8),
+            "".join(reserved),
             self.hash,
             Torrent.id
         ))
         n.send(buf)
 
+    def send_message_extended(self, n, ext_id, payload):
+        buf = "".join((
+            chr(Torrent.MESSAGE_EXTENDED),
+            chr(ext_id),
+            payload
+        ))
+        self.send_message(n, buf)
+
+    def send_message_extended_handshake(self, n):
+        payload = bcode.encode({
+            "m": Torrent.EXTENSIONS,
+            "p": Torrent.port,
+            "v": "CBT %s" % version.VERSION
+        })
+        self.send_message_extended(n, Torrent.EXTENDED_HANDSHAKE, payload)
+
     def send_message(self, n, message):
         buf = "".join((
             convert.uint_chr(len(message)),
@@ -353,11 +813,29 @@ class Torrent(object):
         self.send_message(n, buf)
 
     def send_message_bitfield(self, n):
-        count = int(math.ceil(len(self.pieces) / 8))
-        buf = [chr(Torrent.MESSAGE_BITFIELD)]
-        for _ in xrange(count):
-            buf.append(chr(0))
-        self.send_message(n, "".join(buf))
+        """Send our pieces. Fast peers get HAVE ALL or HAVE NONE
+        instead of a bitfield if it's possible.
+
+        """
+        completed = self.downloader.completed
+        have_count = self.downloader.have_count()
+        if self._partial is not None:
+            completed = completed.difference(self._partial)
+            have_count = completed.count()
+        if n.fast and have_count == 0:
+            self.send_message(n, chr(Torrent.MESSAGE_HAVE_NONE))
+            return
+        if n.fast and have_count == len(self.pieces):
+            self.send_message(n, chr(Torrent.MESSAGE_HAVE_ALL))
+            return
+        if have_count == 0:
+            # Bitfield message is optional
+            return
+        buf = "".join((
+            chr(Torrent.MESSAGE_BITFIELD),
+            completed.tostring()
+        ))
+        self.send_message(n, buf)
 
     def send_message_request(self, n, index, begin, length):
         buf = "".join((
@@ -367,6 +845,26 @@ class Torrent(object):
             convert.uint_chr(length)
         ))
         self.send_message(n, buf)
+        n.last_request = time.time()
+
+    def send_message_reject(self, n, index, begin, length):
+        buf = "".join((
+            chr(Torrent.MESSAGE_REJECT),
+            convert.uint_chr(index),
+            convert.uint_chr(begin),
+            convert.uint_chr(length)
+        ))
+        self.send_message(n, buf)
+
+    def send_message_piece(self, n, index, begin, data):
+        buf = "".join((
+            chr(Torrent.MESSAGE_PIECE),
+            convert.uint_chr(index),
+            convert.uint_chr(begin),
+            data
+        ))
+        self.send_message(n, buf)
+        n.uploaded += len(data)
 
     def send_message_cancel(self, n, index, begin, length):
         buf = "".join((
@@ -377,12 +875,45 @@ class Torrent(object):
         ))
         self.send_message(n, buf)
 
+    def _announce(self, event):
+        """Send the event to the tracker and return its response or
+        None. Trackers are probed and the available one is selected
+        on the first call. It may be called from a thread, so only
+        the tracker is touched.
+
+        """
+        urls, self._tracker_urls = self._tracker_urls, None
+        if urls is not None:
+            self.tracker = tracker.get(urls)
+        if not self.tracker:
+            return None
+        return self.tracker.request(
+            hash=self.hash,
+            id=Torrent.id,
+            port=Torrent.port,
+            uploaded=0,
+            downloaded=0,
+            left=0,
+            event=event
+        )
+
+    def _can_upload(self, index):
+        """Return True if the piece is downloaded and stored in full."""
+        if self._partial is not None and self._partial.get(index):
+            return False
+        return self.downloader.have(index)
+
+    def _file_pieces(self, f):
+        """Return indexes of the first and the last pieces of the file."""
+        piece_length = self.pieces.piece_length
+        return f.offset / piece_length, (f.offset + max(f.size, 1) - 1) / piece_length
+
     def _to_string(self):
         requested_nodes, all_nodes = self.downloader.nodes_count()
         string = "[%s] [%.1f%%] [%d KB / %d KB] [Peers: %d / %d]" % (
             self.torrent_path.split(os.sep)[-1],
             self.downloader.progress() * 100.0,
-            self.downloader.downloaded() / 1024.0,
+            self.downloader.verified() / 1024.0,
             self.downloader.total() / 1024.0,
             requested_nodes,
             all_nodes
@@ -1,11 +1,190 @@
+import Queue
+import httplib
+import os
+import random
+import socket
+import threading
+import time
 import urllib
 import urllib2
-import re
-import socket
+import urlparse
 
 import bcode
+import convert
+import storage
+
+__all__ = ["get", "scrape"]
+
+
+class DNSCache(object):
+    """Thread-safe cache of resolved tracker addresses.
+    Successful answers live TTL seconds, failures live
+    NEGATIVE_TTL seconds so dead hosts are not resolved
+    again on every probe.
+
+    Methods:
+
+        resolve(host, port):
+            Return (family, sockaddr) for the host or raise socket.error.
+
+    """
+
+    TTL = 300
+    NEGATIVE_TTL = 60
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Return (family, sockaddr) for the host or raise socket.error."""
+        key = (host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[1] > time.time():
+            if entry[0] is None:
+                raise socket.error("Unable to resolve %s" % host)
+            return entry[0]
+        try:
+            info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            with self._lock:
+                self._entries[key] = (None, time.time() + DNSCache.NEGATIVE_TTL)
+            raise
+        result = (info[0][0], info[0][4])
+        with self._lock:
+            self._entries[key] = (result, time.time() + DNSCache.TTL)
+        return result
+
+
+class Health(object):
+    """Latency and failures of trackers remembered between runs.
+    The state is stored bencoded in the client data directory.
+
+    Each record is a dict:
+
+        latency:
+            Smoothed connection time in milliseconds
+            or -1 if the tracker has never answered.
+
+        failures:
+            Number of failed probes in a row.
+
+        checked:
+            Timestamp of the last probe.
+
+    Methods:
+
+        record(url, latency):
+            Remember probe result. latency is None if the probe failed.
+
+        save():
+            Write records to the disk.
+
+        sort(trackers):
+            Return a new list of trackers, the healthiest first.
+
+    """
+
+    FILENAME = "trackers"
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        if self.path is None:
+            self.path = storage.path(Health.FILENAME)
+        try:
+            with open(self.path, "rb") as f:
+                records = bcode.decode(f.read())
+        except IOError:
+            records = None
+        if isinstance(records, dict):
+            self.records.update(records)
+
+    def record(self, url, latency):
+        """Remember probe result. latency is None if the probe failed."""
+        with self._lock:
+            item = self.records.setdefault(url, {"latency": -1, "failures": 0})
+            if latency is None:
+                item["failures"] += 1
+            else:
+                ms = int(latency * 1000)
+                if item["latency"] >= 0:
+                    ms = (item["latency"] * 3 + ms) / 4
+                item["latency"] = ms
+                item["failures"] = 0
+            item["checked"] = int(time.time())
+
+    def save(self):
+        """Write records to the disk. Probe threads save concurrently
+        and workers share the file, so it's written to a temporary
+        file of the process under the lock and renamed then: readers
+        see the old or the new file, never a partial one.
+
+        """
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with self._lock:
+            data = bcode.encode(self.records)
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                if os.name != "posix" and os.path.exists(self.path):
+                    # rename() doesn't replace files on Windows
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError):
+                pass
+
+    def sort(self, trackers):
+        """Return a new list of trackers, the healthiest first.
+        Trackers with known latency go before unknown ones.
+
+        """
+        def key(t):
+            item = self.records.get(t.host)
+            if not item:
+                return (0, 1, 0)
+            unknown = int(item["latency"] < 0)
+            return (item["failures"], unknown, item["latency"])
+        return sorted(trackers, key=key)
+
+class ScrapeCache(object):
+    """Scrape results of (tracker URL, info-hash) pairs
+    that are considered fresh for TTL seconds.
+
+    Methods:
 
-__all__ = ["get"]
+        get(url, hash):
+            Return cached result or None.
+
+        put(url, hash, result):
+            Remember result.
+
+    """
+
+    TTL = 300
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, hash):
+        """Return cached result or None."""
+        with self._lock:
+            entry = self._entries.get((url, hash))
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def put(self, url, hash, result):
+        """Remember result."""
+        with self._lock:
+            self._entries[(url, hash)] = (result, time.time() + ScrapeCache.TTL)
+
+dns_cache = DNSCache()
+health = None
+scrape_cache = ScrapeCache()
 
 
 class Tracker(object):
@@ -15,37 +194,52 @@ class Tracker(object):
     """
 
     DEFAULT_PORT = None
+    PROBE_TIMEOUT = 2
+    SCRAPE_BATCH = 1
 
     def __init__(self, host):
         assert self.DEFAULT_PORT is not None
         self.host = host
+        self.latency = None
 
     def request(self, hash, id, port, uploaded, downloaded, left, event):
         """Overridden methods should return a dictionary of params or None."""
         return None
 
+    def scrape(self, hashes):
+        """Overridden methods should return a dict
+        {info-hash: {"complete": int, "incomplete": int, "downloaded": int}}
+        for the hashes the tracker knows, fields the tracker doesn't
+        tell are absent. At most SCRAPE_BATCH hashes are passed at once.
+
+        """
+        return {}
+
     def is_available(self):
         """Try to connect to tracker through TCP/IP. Return True if connection
-        successful and False if not.
+        successful and False if not. Connection time is stored in latency.
 
         """
-        pattern = re.compile("^[a-z]+://([a-z0-9.\-]+):?([0-9]*)/?")
-        info = pattern.split(self.host)
-        address = info[1]
-        port = info[2]
-        result = True
+        url = urlparse.urlparse(self.host)
         try:
-            port = int(port)
+            port = url.port or self.DEFAULT_PORT
         except ValueError:
             port = self.DEFAULT_PORT
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)
+        started_at = time.time()
+        sock = None
+        result = True
         try:
-            sock.connect((address, port))
-        except socket.timeout:
+            family, address = dns_cache.resolve(url.hostname, port)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.PROBE_TIMEOUT)
+            sock.connect(address)
+        except (socket.error, TypeError):
             result = False
         finally:
-            sock.close()
+            if sock:
+                sock.close()
+        if result:
+            self.latency = time.time() - started_at
         return result
 
 
@@ -57,6 +251,8 @@ class HTTPTracker(Tracker):
     """
 
     DEFAULT_PORT = 80
+    SCRAPE_BATCH = 50
+    TIMEOUT = 15
 
     def request(self, hash, id, port, uploaded, downloaded, left, event):
         url = self.host
@@ -78,11 +274,51 @@ class HTTPTracker(Tracker):
         url = "".join((url, sep, param))
         response = ""
         try:
-            response = urllib2.urlopen(url).read()
-        except urllib2.URLError:
+            response = urllib2.urlopen(url, timeout=HTTPTracker.TIMEOUT).read()
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
             pass
-        result = bcode.decode(response)
-        return result
+        try:
+            return bcode.decode(response)
+        except (IOError, ValueError):
+            return None
+
+    def scrape(self, hashes):
+        """Send all hashes in one GET request to the scrape URL.
+        The scrape URL is made by replacing "announce" in the last
+        part of the announce URL. Trackers without such URL don't
+        support scrape.
+
+        """
+        head, _, tail = self.host.rpartition("/")
+        if not tail.startswith("announce"):
+            return {}
+        url = "".join((head, "/", tail.replace("announce", "scrape", 1)))
+        sep = "?"
+        if sep in url:
+            sep = "&"
+        param = urllib.urlencode([("info_hash", hash) for hash in hashes])
+        url = "".join((url, sep, param))
+        response = ""
+        try:
+            response = urllib2.urlopen(url, timeout=HTTPTracker.TIMEOUT).read()
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            pass
+        try:
+            result = bcode.decode(response)
+        except (IOError, ValueError):
+            result = None
+        if not isinstance(result, dict) or not isinstance(result.get("files"), dict):
+            return {}
+        files = {}
+        for hash, info in result["files"].iteritems():
+            if hash in hashes and isinstance(info, dict):
+                # Fields that aren't integers are dropped
+                files[hash] = dict(
+                    (key, info[key])
+                    for key in ("complete", "incomplete", "downloaded")
+                    if type(info.get(key)) in (int, long)
+                )
+        return files
 
 
 class UDPTracker(Tracker):
@@ -91,39 +327,200 @@ class UDPTracker(Tracker):
 
     """
 
+    ACTION_CONNECT = 0
+    ACTION_ANNOUNCE = 1
+    ACTION_SCRAPE = 2
+    ACTION_ERROR = 3
+
+    CONNECTION_ID_TTL = 60
     DEFAULT_PORT = 2710
+    PROTOCOL_ID = 0x41727101980
+    RETRIES = 2
+    SCRAPE_BATCH = 74
+    TIMEOUT = 3
+
+    def __init__(self, host):
+        super(UDPTracker, self).__init__(host)
+        self._connection_id = None
+        self._connected_at = 0
 
     def request(self, hash, id, port, uploaded, downloaded, left, event):
         # TODO: XBTT Tracker request
         return ""
 
+    def scrape(self, hashes):
+        """Send up to SCRAPE_BATCH hashes in one scrape datagram."""
+        try:
+            connection_id = self._connect()
+            buf = self._transaction(
+                connection_id,
+                UDPTracker.ACTION_SCRAPE,
+                "".join(hashes)
+            )
+        except socket.error:
+            return {}
+        files = {}
+        for x, hash in enumerate(hashes):
+            item = buf[x*12:x*12+12]
+            if len(item) < 12:
+                break
+            files[hash] = {
+                "complete": convert.uint_ord(item[0:4]),
+                "downloaded": convert.uint_ord(item[4:8]),
+                "incomplete": convert.uint_ord(item[8:12])
+            }
+        return files
+
+    def _connect(self):
+        """Return a connection ID, request a new one if it's expired."""
+        elapsed = time.time() - self._connected_at
+        if self._connection_id and elapsed < UDPTracker.CONNECTION_ID_TTL:
+            return self._connection_id
+        buf = self._transaction(UDPTracker.PROTOCOL_ID, UDPTracker.ACTION_CONNECT, "")
+        if len(buf) < 8:
+            raise socket.error("Invalid connect response")
+        self._connection_id = convert.uint_ord(buf[0:8])
+        self._connected_at = time.time()
+        return self._connection_id
+
+    def _transaction(self, connection_id, action, payload):
+        """Send a request and return the payload of the response
+        with the same transaction ID. Raise socket.error if the
+        tracker doesn't respond or responds with an error.
+
+        """
+        url = urlparse.urlparse(self.host)
+        try:
+            port = url.port or self.DEFAULT_PORT
+        except ValueError:
+            port = self.DEFAULT_PORT
+        transaction_id = random.getrandbits(32)
+        buf = "".join((
+            convert.uint_chr(connection_id, 8),
+            convert.uint_chr(action),
+            convert.uint_chr(transaction_id),
+            payload
+        ))
+        family, address = dns_cache.resolve(url.hostname, port)
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.settimeout(UDPTracker.TIMEOUT)
+        try:
+            for _ in xrange(UDPTracker.RETRIES):
+                sock.sendto(buf, address)
+                try:
+                    response = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if len(response) < 8:
+                    continue
+                if convert.uint_ord(response[4:8]) != transaction_id:
+                    continue
+                r_action = convert.uint_ord(response[0:4])
+                if r_action == UDPTracker.ACTION_ERROR:
+                    raise socket.error(response[8:])
+                if r_action != action:
+                    continue
+                return response[8:]
+        finally:
+            sock.close()
+        raise socket.timeout("Tracker doesn't respond")
+
 
 def get(url_list):
     """Returns an instance of appropriate tracker class.
-    Try to connect to trackers in url_list until one of them
-    does not respond.
+    All trackers in url_list are probed concurrently and the first
+    one that responds is returned, so startup takes as long as the
+    fastest healthy tracker. Probe results are remembered in Health
+    and the trackers that were healthy last time are started first.
 
     Args:
         url_list: a list of full URLs of all valid trackers for the torrent.
 
     Returns:
         An object of appropriate subclass of Tracker that sends requests to
-        the first available tracker in the list or None if there is no
-        available tracker.
+        the first available tracker. If no tracker is available the
+        healthiest one is returned, or None if url_list has no
+        supported trackers.
+
+    """
+    global health
+    if health is None:
+        health = Health()
+    trackers = []
+    urls = set()
+    for url in url_list:
+        TrackerClass = _tracker_class(url)
+        if not TrackerClass or url in urls:
+            continue
+        urls.add(url)
+        trackers.append(TrackerClass(url))
+    if not trackers:
+        return None
+    trackers = health.sort(trackers)
+
+    results = Queue.Queue()
+
+    def probe(t):
+        available = t.is_available()
+        health.record(t.host, t.latency if available else None)
+        health.save()
+        results.put((t, available))
+
+    for t in trackers:
+        thread = threading.Thread(target=probe, args=(t,))
+        thread.daemon = True
+        thread.start()
+    for _ in trackers:
+        t, available = results.get()
+        if available:
+            return t
+    return trackers[0]
+
+
+def scrape(url, hashes):
+    """Return swarm statistics of many torrents from one tracker.
+    Hashes are packed into as few requests as the protocol allows
+    (SCRAPE_BATCH per request) and results are cached in scrape_cache,
+    so only hashes without fresh results are requested.
+
+    Args:
+        url: announce URL of the tracker.
+        hashes: an iterable of 20-byte info-hashes.
+
+    Returns:
+        A dict {info-hash: {"complete": seeders, "incomplete": leechers,
+        "downloaded": completed downloads}}. Hashes unknown to the
+        tracker or not answered are absent, so are fields the tracker
+        doesn't tell.
 
     """
+    TrackerClass = _tracker_class(url)
+    if not TrackerClass:
+        return {}
+    result = {}
+    missing = []
+    for hash in hashes:
+        cached = scrape_cache.get(url, hash)
+        if cached is not None:
+            result[hash] = cached
+        elif hash not in missing:
+            missing.append(hash)
+    t = TrackerClass(url)
+    batch = TrackerClass.SCRAPE_BATCH
+    for x in xrange(0, len(missing), batch):
+        files = t.scrape(missing[x:x+batch])
+        for hash, info in files.iteritems():
+            scrape_cache.put(url, hash, info)
+        result.update(files)
+    return result
+
+
+def _tracker_class(url):
+    """Return Tracker subclass for the URL scheme or None."""
     tracker_classes = {
         "http": HTTPTracker,
         "https": HTTPTracker,
         "udp": UDPTracker
     }
-    tracker = None
-    for url in url_list:
-        protocol = url.split("://")[0]
-        if protocol not in tracker_classes:
-            continue
-        TrackerClass = tracker_classes[protocol]
-        tracker = TrackerClass(url)
-        if tracker.is_available():
-            break
-    return tracker
+    protocol = url.split("://")[0].lower()
+    return tracker_classes.get(protocol)
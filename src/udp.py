@@ -0,0 +1,81 @@
+import socket
+
+__all__ = ["Socket"]
+
+
+class Socket(object):
+    """Non-blocking UDP socket shared by all datagram protocols
+    of the client. Each protocol registers a handler with a match
+    function that recognizes its datagrams by the first bytes.
+
+    Attributes:
+
+        address:
+            (ip, port) the socket is bound to.
+
+        handlers:
+            A list of (match, handler) pairs.
+
+    Methods:
+
+        on_recv(match, func):
+            Call func(data, address) for each received datagram
+            for which match(data) is True.
+
+        sendto(data, address):
+            Send a datagram. Errors are ignored like lost datagrams.
+
+        message():
+            You have to call this method in a loop.
+
+        close():
+            Close the socket.
+
+    """
+
+    MAX_DATAGRAM = 65536
+    MAX_RECV_PER_MESSAGE = 256
+
+    def __init__(self, port=0, host="0.0.0.0"):
+        self.handlers = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+
+    def on_recv(self, match, func):
+        """Call func(data, address) for each received datagram
+        for which match(data) is True.
+
+        """
+        self.handlers.append((match, func))
+
+    def sendto(self, data, address):
+        """Send a datagram. Errors are ignored like lost datagrams."""
+        try:
+            self.sock.sendto(data, address)
+        except socket.error:
+            pass
+
+    def message(self):
+        """You have to call this method in a loop.
+        Return False if there is nothing to do.
+
+        """
+        received = False
+        for _ in xrange(Socket.MAX_RECV_PER_MESSAGE):
+            try:
+                data, address = self.sock.recvfrom(Socket.MAX_DATAGRAM)
+            except socket.error:
+                # Nothing to read or ICMP error of a previous datagram
+                break
+            received = True
+            for match, func in self.handlers:
+                if match(data):
+                    func(data, address)
+                    break
+        return received
+
+    def close(self):
+        """Close the socket."""
+        self.sock.close()
@@ -0,0 +1,640 @@
+"""
+uTP (BEP 29): reliable ordered streams over the shared UDP socket.
+
+A uTP connection looks like a non-blocking TCP socket to the rest
+of the client: send() queues data and returns how much was taken,
+recv() returns data, "" at the end of the stream or raises
+socket.error with EAGAIN if there is nothing yet. So Node, Peer and
+Listener use it in the same way as TCP.
+
+Congestion is controlled by LEDBAT: the window grows while the
+one-way queuing delay measured by the peer is below TARGET and
+shrinks when it's above, so uTP yields to other traffic of the link.
+Out of order packets are kept and reported with selective ACKs,
+lost packets are resent after three later packets are acknowledged
+or after a timeout that adapts to the round trip time.
+
+Usage:
+
+    transport = utp.Transport(udp_socket)
+    transport.on_accept(func)
+    conn = transport.connect((ip, port))
+
+Call udp_socket.message() and transport.message() in the main loop.
+
+"""
+
+import collections
+import errno
+import os
+import random
+import socket
+import struct
+import time
+
+__all__ = ["Connection", "Transport", "match"]
+
+HEADER = struct.Struct("!BBHIIIHH")
+
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+
+VERSION = 1
+EXTENSION_SACK = 1
+
+
+def match(data):
+    """Return True if the datagram looks like a uTP packet."""
+    if len(data) < HEADER.size:
+        return False
+    byte = ord(data[0])
+    return byte & 0x0f == VERSION and byte >> 4 <= ST_SYN
+
+
+def _micros():
+    return int(time.time() * 1000000) & 0xffffffff
+
+
+def _distance(a, b):
+    """Return how many sequence numbers b is ahead of a."""
+    return (b - a) & 0xffff
+
+
+class _Packet(object):
+    __slots__ = ("lost", "payload", "sent_at", "seq", "transmissions", "type")
+
+    def __init__(self, type, seq, payload):
+        self.lost = False
+        self.payload = payload
+        self.sent_at = 0
+        self.seq = seq
+        self.transmissions = 0
+        self.type = type
+
+
+class Connection(object):
+    """A uTP stream with the interface of a non-blocking socket.
+
+    Attributes:
+
+        address:
+            (ip, port) of the peer.
+
+        cwnd:
+            Congestion window in bytes.
+
+        delay:
+            The last queuing delay in seconds measured by the peer.
+
+        retransmits:
+            Number of resent packets.
+
+        rtt:
+            Smoothed round trip time in seconds.
+
+        state:
+            STATE_SYN_SENT, STATE_CONNECTED or STATE_CLOSED.
+
+    Methods:
+
+        send(data):
+            Queue data and return how many bytes were taken.
+
+        recv(size):
+            Return up to size bytes of the stream.
+
+        wait(timeout):
+            Wait until the connection is established.
+
+        close():
+            Send FIN and forget the connection.
+
+    """
+
+    STATE_SYN_SENT = 0
+    STATE_CONNECTED = 1
+    STATE_CLOSED = 2
+
+    DUPLICATE_ACKS = 3
+    GAIN = 1.0
+    IDLE_TIMEOUT = 60
+    INITIAL_TIMEOUT = 1.0
+    KEEPALIVE = 20
+    MAX_REORDER = 0x1000
+    MAX_RETRANSMISSIONS = 5
+    MAX_SACK_BYTES = 32
+    MAX_TIMEOUT = 16.0
+    MAX_WINDOW = 1 << 20
+    MIN_TIMEOUT = 0.5
+    PACKET_SIZE = 1400
+    RECV_BUFFER = 1 << 20
+    SEND_BUFFER = 1 << 20
+    TARGET = 0.1
+    BASE_DELAY_MINUTES = 2
+
+    def __init__(self, transport, address, recv_id, send_id):
+        self.address = address
+        self.cwnd = Connection.PACKET_SIZE * 4
+        self.delay = 0.0
+        self.error = None
+        self.recv_id = recv_id
+        self.retransmits = 0
+        self.rtt = 0.0
+        self.send_id = send_id
+        self.state = Connection.STATE_SYN_SENT
+        self.ack_nr = 0
+        self.seq_nr = 1
+        self.transport = transport
+        self._base_delays = collections.deque()
+        self._duplicate_acks = 0
+        self._eof = False
+        self._inflight = collections.OrderedDict()
+        self._inflight_bytes = 0
+        self._last_ack = None
+        self._last_recv = time.time()
+        self._last_send = time.time()
+        self._loss_at = 0
+        self._lost = 0
+        self._need_ack = False
+        self._peer_window = Connection.PACKET_SIZE * 4
+        self._recv_buf = collections.deque()
+        self._recv_length = 0
+        self._reorder = {}
+        self._reorder_length = 0
+        self._reply_micros = 0
+        self._rtt_var = 0.0
+        self._rto = Connection.INITIAL_TIMEOUT
+        self._send_buf = []
+        self._send_length = 0
+        self._ssthresh = Connection.MAX_WINDOW
+        self._timeouts = 0
+
+    def setblocking(self, flag):
+        """uTP connections never block."""
+
+    def send(self, data):
+        """Queue data and return how many bytes were taken.
+        Raise socket.error with EAGAIN if the send buffer is full.
+
+        """
+        if self.error:
+            raise socket.error(self.error, os.strerror(self.error))
+        if self.state == Connection.STATE_CLOSED:
+            raise socket.error(errno.EPIPE, os.strerror(errno.EPIPE))
+        free = Connection.SEND_BUFFER - self._send_length
+        if free <= 0:
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        data = data[:free]
+        self._send_buf.append(data)
+        self._send_length += len(data)
+        # Small remainders are sent by message(), full packets at once
+        if self.state == Connection.STATE_CONNECTED:
+            self._flush(full_only=True)
+        return len(data)
+
+    def recv(self, size):
+        """Return up to size bytes of the stream, "" at the end of it.
+        Raise socket.error with EAGAIN if there is nothing to read.
+
+        """
+        if self._recv_length:
+            chunk = self._recv_buf.popleft()
+            if len(chunk) > size:
+                self._recv_buf.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            was_full = self._window_left() < Connection.PACKET_SIZE
+            self._recv_length -= len(chunk)
+            if was_full:
+                # Tell the peer the window is open again
+                self._need_ack = True
+            return chunk
+        if self.error:
+            raise socket.error(self.error, os.strerror(self.error))
+        if self._eof or self.state == Connection.STATE_CLOSED:
+            return ""
+        raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+
+    def wait(self, timeout):
+        """Wait until the connection is established, the main loop
+        must run in another thread meanwhile. Return True on success.
+
+        """
+        deadline = time.time() + timeout
+        while self.state == Connection.STATE_SYN_SENT and not self.error:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return self.state == Connection.STATE_CONNECTED and not self.error
+
+    def close(self):
+        """Send FIN and forget the connection. Unsent data is dropped."""
+        if self.state == Connection.STATE_CONNECTED and not self.error:
+            self._send_packet(ST_FIN, self.seq_nr)
+        self.state = Connection.STATE_CLOSED
+        self.transport.connections.pop((self.address, self.recv_id), None)
+
+    def _fail(self, error):
+        self.error = error
+        self.state = Connection.STATE_CLOSED
+
+    def _window_left(self):
+        used = self._recv_length + self._reorder_length
+        return max(0, Connection.RECV_BUFFER - used)
+
+    def _send_packet(self, type, seq, payload=""):
+        sack = ""
+        if type == ST_STATE and self._reorder:
+            sack = self._sack()
+        conn_id = self.recv_id if type == ST_SYN else self.send_id
+        header = HEADER.pack(
+            type << 4 | VERSION,
+            EXTENSION_SACK if sack else 0,
+            conn_id,
+            _micros(),
+            self._reply_micros,
+            self._window_left(),
+            seq,
+            self.ack_nr
+        )
+        if sack:
+            header += "\0" + chr(len(sack)) + sack
+        self.transport.sock.sendto(header + payload, self.address)
+        self._last_send = time.time()
+        self._need_ack = False
+
+    def _sack(self):
+        """Return the selective ACK bitmask of received packets
+        after ack_nr + 1.
+
+        """
+        bits = bytearray(Connection.MAX_SACK_BYTES)
+        size = 0
+        for seq in self._reorder:
+            index = _distance(self.ack_nr, seq) - 2
+            if 0 <= index < Connection.MAX_SACK_BYTES * 8:
+                bits[index >> 3] |= 1 << (index & 7)
+                size = max(size, (index >> 5) + 1)
+        return str(bits[:size * 4])
+
+    def _transmit(self, p):
+        if p.transmissions:
+            self.retransmits += 1
+        p.transmissions += 1
+        p.sent_at = time.time()
+        self._send_packet(p.type, p.seq, p.payload)
+
+    def _syn(self):
+        p = _Packet(ST_SYN, self.seq_nr, "")
+        self.seq_nr = (self.seq_nr + 1) & 0xffff
+        self._inflight[p.seq] = p
+        self._transmit(p)
+
+    def _flush(self, full_only=False):
+        """Resend lost packets and send new data the window allows."""
+        window = max(min(self.cwnd, self._peer_window), Connection.PACKET_SIZE)
+        if self._lost:
+            for p in self._inflight.itervalues():
+                if not p.lost:
+                    continue
+                if self._inflight_bytes + len(p.payload) > window:
+                    return
+                p.lost = False
+                self._lost -= 1
+                self._inflight_bytes += len(p.payload)
+                self._transmit(p)
+        size = Connection.PACKET_SIZE - HEADER.size
+        if self._send_length < (size if full_only else 1):
+            return
+        buf = "".join(self._send_buf)
+        offset = 0
+        while offset < len(buf) and self._inflight_bytes + size <= window:
+            payload = buf[offset:offset+size]
+            if full_only and len(payload) < size:
+                break
+            offset += len(payload)
+            p = _Packet(ST_DATA, self.seq_nr, payload)
+            self.seq_nr = (self.seq_nr + 1) & 0xffff
+            self._inflight[p.seq] = p
+            self._inflight_bytes += len(payload)
+            self._transmit(p)
+        self._send_buf = [buf[offset:]] if offset < len(buf) else []
+        self._send_length = len(buf) - offset
+
+    def _on_packet(self, type, timestamp, delay, window, seq, ack, sack, payload):
+        now = time.time()
+        self._last_recv = now
+        self._reply_micros = (_micros() - timestamp) & 0xffffffff
+        if type == ST_RESET:
+            if self.state == Connection.STATE_SYN_SENT:
+                self._fail(errno.ECONNREFUSED)
+            else:
+                self._fail(errno.ECONNRESET)
+            return
+        if type == ST_SYN:
+            # Our STATE was lost, the peer asks again
+            self._need_ack = True
+            return
+        if self.state == Connection.STATE_SYN_SENT:
+            if type not in (ST_STATE, ST_DATA):
+                return
+            self.ack_nr = (seq - 1) & 0xffff
+            self.state = Connection.STATE_CONNECTED
+        self._peer_window = window
+        self._on_ack(ack, sack, delay, type == ST_STATE)
+        if type in (ST_DATA, ST_FIN):
+            self._on_data(type, seq, payload)
+
+    def _on_data(self, type, seq, payload):
+        self._need_ack = True
+        distance = _distance(self.ack_nr, seq)
+        if distance == 0 or distance > Connection.MAX_REORDER or self._eof:
+            # A duplicate or too far ahead
+            return
+        if distance > 1:
+            if seq not in self._reorder:
+                self._reorder[seq] = (type, payload)
+                self._reorder_length += len(payload)
+            return
+        self._deliver(type, payload)
+        while self._reorder and not self._eof:
+            next_seq = (self.ack_nr + 1) & 0xffff
+            if next_seq not in self._reorder:
+                break
+            type, payload = self._reorder.pop(next_seq)
+            self._reorder_length -= len(payload)
+            self._deliver(type, payload)
+
+    def _deliver(self, type, payload):
+        self.ack_nr = (self.ack_nr + 1) & 0xffff
+        if type == ST_FIN:
+            self._eof = True
+            self._reorder = {}
+            self._reorder_length = 0
+        elif payload:
+            self._recv_buf.append(payload)
+            self._recv_length += len(payload)
+
+    def _on_ack(self, ack, sack, delay, pure):
+        now = time.time()
+        acked = []
+        while self._inflight:
+            seq = next(iter(self._inflight))
+            if _distance(seq, ack) >= 0x8000:
+                break
+            acked.append(self._inflight.pop(seq))
+        if sack:
+            sacked = 0
+            # From the newest packet down, so later packets are counted
+            for index in xrange(len(sack) * 8 - 1, -1, -1):
+                seq = (ack + 2 + index) & 0xffff
+                if ord(sack[index >> 3]) & (1 << (index & 7)):
+                    sacked += 1
+                    if seq in self._inflight:
+                        acked.append(self._inflight.pop(seq))
+                elif sacked >= Connection.DUPLICATE_ACKS:
+                    self._mark_lost(seq, now)
+            if sacked >= Connection.DUPLICATE_ACKS:
+                self._mark_lost((ack + 1) & 0xffff, now)
+        if not acked:
+            if pure and ack == self._last_ack and self._inflight:
+                self._duplicate_acks += 1
+                if self._duplicate_acks == Connection.DUPLICATE_ACKS:
+                    self._mark_lost((ack + 1) & 0xffff, now)
+            self._last_ack = ack
+            return
+        self._last_ack = ack
+        self._duplicate_acks = 0
+        self._timeouts = 0
+        acked_bytes = 0
+        newest = None
+        for p in acked:
+            if p.lost:
+                p.lost = False
+                self._lost -= 1
+            else:
+                self._inflight_bytes -= len(p.payload)
+            acked_bytes += len(p.payload)
+            # Karn: resent packets don't tell the round trip time
+            if p.transmissions == 1 and (newest is None or p.sent_at > newest.sent_at):
+                newest = p
+        if newest is not None:
+            self._update_rtt(now - newest.sent_at)
+        if delay and acked_bytes:
+            self._ledbat(acked_bytes, delay)
+
+    def _mark_lost(self, seq, now):
+        p = self._inflight.get(seq)
+        if p is None or p.lost:
+            return
+        if now - p.sent_at < max(self.rtt, 0.01):
+            # It was resent recently
+            return
+        p.lost = True
+        self._lost += 1
+        self._inflight_bytes -= len(p.payload)
+        self._on_loss(now)
+
+    def _on_loss(self, now):
+        """Halve the window once a round trip."""
+        if now - self._loss_at > self.rtt:
+            self.cwnd = max(Connection.PACKET_SIZE * 2, self.cwnd / 2)
+            self._ssthresh = self.cwnd
+            self._loss_at = now
+
+    def _update_rtt(self, sample):
+        if not self.rtt:
+            self.rtt = sample
+            self._rtt_var = sample / 2
+        else:
+            self._rtt_var += (abs(self.rtt - sample) - self._rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self._rto = min(
+            Connection.MAX_TIMEOUT,
+            max(Connection.MIN_TIMEOUT, self.rtt + 4 * self._rtt_var)
+        )
+
+    def _ledbat(self, acked_bytes, delay):
+        """Grow or shrink the window by the queuing delay.
+        The base delay is the minimum of the last minutes, so
+        the clock offset between the hosts doesn't matter.
+
+        """
+        minute = int(time.time() / 60)
+        if not self._base_delays or self._base_delays[-1][0] != minute:
+            self._base_delays.append([minute, delay])
+            while len(self._base_delays) > Connection.BASE_DELAY_MINUTES:
+                self._base_delays.popleft()
+        elif delay < self._base_delays[-1][1]:
+            self._base_delays[-1][1] = delay
+        base = min(value for _, value in self._base_delays)
+        self.delay = (delay - base) / 1000000.0
+        off_target = (Connection.TARGET - self.delay) / Connection.TARGET
+        if self.cwnd < self._ssthresh and self.delay < Connection.TARGET / 2:
+            # Slow start until the first loss or the queue grows
+            self.cwnd += acked_bytes
+        else:
+            self._ssthresh = min(self._ssthresh, self.cwnd)
+            self.cwnd += Connection.GAIN * off_target * acked_bytes * Connection.PACKET_SIZE / self.cwnd
+        self.cwnd = int(min(
+            Connection.MAX_WINDOW,
+            max(Connection.PACKET_SIZE * 2, self.cwnd)
+        ))
+
+    def _message(self, now):
+        """Handle timeouts, send data and ACKs. Return True if
+        anything was sent.
+
+        """
+        if self.state == Connection.STATE_CLOSED:
+            return False
+        if now - self._last_recv > Connection.IDLE_TIMEOUT:
+            self._fail(errno.ETIMEDOUT)
+            return False
+        if self._inflight:
+            p = self._inflight[next(iter(self._inflight))]
+            if not p.lost and now - p.sent_at > self._rto:
+                self._timeouts += 1
+                if self._timeouts > Connection.MAX_RETRANSMISSIONS:
+                    self._fail(errno.ETIMEDOUT)
+                    return False
+                # Everything in flight is resent as the window allows
+                for p in self._inflight.itervalues():
+                    if not p.lost:
+                        p.lost = True
+                        self._lost += 1
+                self._inflight_bytes = 0
+                self._rto = min(Connection.MAX_TIMEOUT, self._rto * 2)
+                self._ssthresh = max(Connection.PACKET_SIZE * 2, self.cwnd / 2)
+                self.cwnd = Connection.PACKET_SIZE * 2
+        if self.state == Connection.STATE_SYN_SENT:
+            # Nothing but the SYN is sent until the peer answers,
+            # so it's resent here on timeout
+            if not self._lost:
+                return False
+            for p in self._inflight.itervalues():
+                if p.lost:
+                    p.lost = False
+                    self._lost -= 1
+                    self._transmit(p)
+            return True
+        if self.state != Connection.STATE_CONNECTED:
+            return False
+        sent_at = self._last_send
+        self._flush()
+        if self._need_ack or now - self._last_send > Connection.KEEPALIVE:
+            self._send_packet(ST_STATE, self.seq_nr)
+        return self._last_send != sent_at
+
+
+class Transport(object):
+    """uTP connections multiplexed over a udp.Socket.
+
+    Attributes:
+
+        connections:
+            {(address, receive connection id): Connection}.
+
+        sock:
+            The udp.Socket.
+
+    Events:
+
+        on_accept:
+            A peer has connected.
+            Prototype: on_accept(conn, address).
+            To add a handler use: transport.on_accept(function).
+            If there is no handler incoming connections are reset.
+
+    Methods:
+
+        connect(address):
+            Start to connect to the peer and return the Connection.
+
+        message():
+            You have to call this method in a loop.
+
+    """
+
+    def __init__(self, sock):
+        self.connections = {}
+        self.handlers = []
+        self.sock = sock
+        sock.on_recv(match, self._on_recv)
+
+    def on_accept(self, func):
+        """Add on_accept handler."""
+        if func not in self.handlers:
+            self.handlers.append(func)
+
+    def connect(self, address):
+        """Start to connect to the peer and return the Connection.
+        Use Connection.wait() or check its state later.
+
+        """
+        while True:
+            recv_id = random.getrandbits(16)
+            if (address, recv_id) not in self.connections:
+                break
+        conn = Connection(self, address, recv_id, (recv_id + 1) & 0xffff)
+        self.connections[(address, recv_id)] = conn
+        conn._syn()
+        return conn
+
+    def message(self):
+        """You have to call this method in a loop.
+        Return False if there is nothing to do.
+
+        """
+        now = time.time()
+        busy = False
+        for key, conn in self.connections.items():
+            if conn._message(now):
+                busy = True
+            if conn.state == Connection.STATE_CLOSED and conn.error:
+                # Failed connections are kept by their owners only
+                self.connections.pop(key, None)
+        return busy
+
+    def _on_recv(self, data, address):
+        type_version, extension, conn_id, timestamp, delay, window, seq, ack = \
+            HEADER.unpack(data[:HEADER.size])
+        type = type_version >> 4
+        # Extensions
+        offset = HEADER.size
+        sack = ""
+        while extension and offset + 2 <= len(data):
+            next_extension = ord(data[offset])
+            length = ord(data[offset+1])
+            if extension == EXTENSION_SACK:
+                sack = data[offset+2:offset+2+length]
+            offset += 2 + length
+            extension = next_extension
+        payload = data[offset:]
+
+        if type == ST_SYN:
+            key = (address, (conn_id + 1) & 0xffff)
+            if key not in self.connections:
+                self._accept(address, conn_id, seq, timestamp)
+                return
+        else:
+            key = (address, conn_id)
+        conn = self.connections.get(key)
+        if conn:
+            conn._on_packet(type, timestamp, delay, window, seq, ack, sack, payload)
+
+    def _accept(self, address, conn_id, seq, timestamp):
+        conn = Connection(self, address, (conn_id + 1) & 0xffff, conn_id)
+        conn.seq_nr = random.getrandbits(16)
+        conn.ack_nr = seq
+        conn.state = Connection.STATE_CONNECTED
+        conn._reply_micros = (_micros() - timestamp) & 0xffffffff
+        if not self.handlers:
+            conn._send_packet(ST_RESET, conn.seq_nr)
+            return
+        self.connections[(address, conn.recv_id)] = conn
+        conn._send_packet(ST_STATE, conn.seq_nr)
+        for func in self.handlers:
+            func(conn, address)
@@ -1,9 +1,15 @@
+import time
+
 import file
+import metrics
+import profiler
 
 
 class Writer(object):
     def __init__(self):
         self.files = []
+        self.files_created = False
+        self.label = ""
 
     def append_file(self, f):
         assert isinstance(f, file.File)
@@ -11,9 +17,26 @@ class Writer(object):
 
     def create_files(self):
         for f in self.files:
-            f.create()
+            if f.priority != file.File.PRIORITY_SKIP:
+                f.create()
+        self.files_created = True
+
+    def skipped(self, offset, length):
+        """Return True if the range touches a skipped file."""
+        for f in self.files:
+            if (
+                f.priority == file.File.PRIORITY_SKIP
+                and f.offset < offset + length
+                and offset < f.offset + f.size
+            ):
+                return True
+        return False
 
     def write(self, offset, data):
+        if profiler.enabled:
+            profiler.begin("disk")
+        started_at = time.time()
+        length = len(data)
         while len(data):
             f = self._get_file(offset)
             if not f:
@@ -23,9 +46,42 @@ class Writer(object):
             if border > len(data):
                 border = len(data)
             this_file_data = data[:border]
-            self._write_to_file(f, offset_inside, this_file_data)
+            # Edge pieces contain parts of skipped files
+            if f.priority != file.File.PRIORITY_SKIP:
+                self._write_to_file(f, offset_inside, this_file_data)
             data = data[border:]
             offset += border
+        if metrics.enabled:
+            metrics.histogram(
+                "cbt_disk_write_seconds",
+                "Time to write a verified piece",
+                torrent=self.label
+            ).observe(time.time() - started_at)
+            metrics.counter(
+                "cbt_disk_written_bytes_total",
+                "Bytes written to disk",
+                torrent=self.label
+            ).inc(length)
+        if profiler.enabled:
+            profiler.end()
+
+    def read(self, offset, length):
+        """Return up to length bytes of the torrent from offset."""
+        if profiler.enabled:
+            profiler.begin("disk")
+        data = []
+        while length > 0:
+            f = self._get_file(offset)
+            if not f:
+                break
+            offset_inside = offset - f.offset
+            border = min(f.size - offset_inside, length)
+            data.append(self._read_from_file(f, offset_inside, border))
+            offset += border
+            length -= border
+        if profiler.enabled:
+            profiler.end()
+        return "".join(data)
 
     def _get_file(self, offset):
         for f in self.files:
@@ -37,3 +93,8 @@ class Writer(object):
         with open(f.name, "r+b") as fd:
             fd.seek(offset)
             fd.write(data)
+
+    def _read_from_file(self, f, offset, length):
+        with open(f.name, "rb") as fd:
+            fd.seek(offset)
+            return fd.read(length)